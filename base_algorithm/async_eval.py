@@ -0,0 +1,41 @@
+import queue
+from concurrent.futures import ThreadPoolExecutor
+from .scoring import evaluate_splits
+
+
+class AsyncEvaluator:
+    """
+    后台评估: submit 的是 embedding 表的快照 (Model.snapshot 里 clone 的), 线程池里的线程按 splits 打分算指标,
+    训练线程不用等; 每个 epoch 的报告 {评估集: 指标} 交给 callback(epoch, report),
+    同时 (epoch, report) 放进 results 队列
+    矩阵乘法和排序在 torch/numpy 里都会释放 GIL, 和训练是真正并行的
+    评估比训练慢时最多积压 max_pending 个快照, 再 submit 就先等最早的那个做完
+    """
+    def __init__(self, splits, callback=None, workers=1, chunk_size=2048, max_pending=2):
+        self.splits = splits
+        self.callback = callback
+        self.chunk_size = chunk_size
+        self.max_pending = max(1, max_pending)
+        self.results = queue.Queue()
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.pending = []
+
+    def _evaluate(self, epoch, user_table, item_table, item_table_cold):
+        report = evaluate_splits(self.splits, user_table, item_table, item_table_cold, self.chunk_size)
+        if self.callback is not None:
+            self.callback(epoch, report)
+        self.results.put((epoch, report))
+
+    def submit(self, epoch, user_table, item_table, item_table_cold=None):
+        while len(self.pending) >= self.max_pending:
+            self.pending.pop(0).result()
+        self.pending.append(self.pool.submit(self._evaluate, epoch, user_table, item_table, item_table_cold))
+
+    def wait(self):
+        """等已经提交的评估都做完, 后台线程里的异常在这里抛出来"""
+        while self.pending:
+            self.pending.pop(0).result()
+
+    def close(self):
+        self.wait()
+        self.pool.shutdown()
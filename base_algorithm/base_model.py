@@ -1,125 +1,161 @@
+import threading
 import torch
 import torch.nn as nn
 import numpy as np
-from sklearn.metrics import roc_auc_score, ndcg_score
+from .scoring import score_candidates, recommend, evaluate_split, evaluate_splits
+from .metrics import ranking_metrics, auc_score
+from .export import export_embeddings
+from .metrics_sink import MetricsSink
+from .profiling import DISABLED
+
+
+# 保护 Model.metrics_sink 的懒创建
+_sink_lock = threading.Lock()
 
 
 class Model(nn.Module):
 
+    # 评估时每次打分的user数, 控制 (chunk, c, dim) 的显存占用
+    eval_chunk_size = 2048
+    # 训练循环在评估前设置, val()/test() 写的记录用它标 epoch
+    epoch = None
+    sink = None
+
+    def metrics_sink(self):
+        """
+        JSON-lines 的指标日志 (见 metrics_sink.py), 第一次用到时打开 self.filename, 之后一直用这一个句柄
+        AsyncEvaluator 的线程 (log_report) 和训练线程 (log_timings) 都可能第一个用到, 加锁保证只打开一个
+        """
+        if self.sink is None:
+            with _sink_lock:
+                if self.sink is None:
+                    self.sink = MetricsSink(self.filename)
+        return self.sink
+
+    def close_metrics(self):
+        """把还在队列里的记录写完并关掉文件, 训练结束时调用"""
+        if self.sink is not None:
+            self.sink.close()
+            self.sink = None
+
+    def log_timings(self, epoch, profiler):
+        """profiler 开着时把这个 epoch 的分阶段耗时写进指标日志, 终端上打印一行"""
+        if not profiler.enabled:
+            return
+        print(f'=={epoch}===> {profiler}')
+        self.metrics_sink().log_timings(epoch, profiler.epoch_timings())
+
+    def user_table(self):
+        return self.user_matrix
+
+    def item_table(self):
+        return self.item_matrix
+
+    def item_table_cold(self):
+        raise Exception('no implementation')
+
     def compute_results(self, u, test_samples):
-        u = u.cuda()
-        if type(test_samples) != torch.Tensor:
-            test_samples = torch.from_numpy(test_samples)
-        test_samples = test_samples.cuda()
-        rs = []
-        for i in test_samples.T:
-            # lt = torch.LongTensor(i)
-            lt = i
-            res_temp = self.predict(u, lt).detach()
-            res_temp = res_temp.cpu()
-            res_temp = res_temp.numpy()
-            rs.append(res_temp)
-        results = np.vstack(rs).T
+        with torch.no_grad():
+            results = score_candidates(self.user_table(), self.item_table(), u, test_samples,
+                                       self.eval_chunk_size)
         if np.isnan(results).any():
             raise Exception('nan')
         return results
 
     def compute_results_cold(self, u, test_samples):
-        u = u.cuda()
-        if type(test_samples) != torch.Tensor:
-            test_samples = torch.from_numpy(test_samples)
-        test_samples = test_samples.cuda()
-        rs = []
-        for i in test_samples.T:
-            # lt = torch.LongTensor(i)
-            lt = i
-            res_temp = self.predict_cold(u, lt).detach()
-            res_temp = res_temp.cpu()
-            res_temp = res_temp.numpy()
-            rs.append(res_temp)
-        results = np.vstack(rs).T
+        with torch.no_grad():
+            results = score_candidates(self.user_table(), self.item_table_cold(), u, test_samples,
+                                       self.eval_chunk_size)
         if np.isnan(results).any():
             raise Exception('nan')
         return results
 
-    @staticmethod
-    def auc_calculate(labels, pre_ds):
-        print('.auc')
-        labels = (torch.from_numpy(labels)).double()
-        labels = labels.cuda()
-        pre_ds = (torch.from_numpy(pre_ds)).double()
-        pre_ds = pre_ds.cuda()
-        # 计算tp，阈值设置为0.0，即预测集中，值大于0的样例设置为1，小于0的样例 设置为0
-        one = torch.ones_like(pre_ds)
-        zero = torch.zeros_like(pre_ds)
-        boundary = torch.mean(pre_ds)
-        pre_ds = torch.where(pre_ds > boundary, one, zero)
-        positive_lens = torch.sum(labels, dim=1)
-        negative_lens = torch.abs(torch.sum(labels - 1, dim=1))
-        positive_samples = torch.einsum('ij, ij->i', [labels, pre_ds])
-        negative_samples = torch.einsum('ij, ij->i', [torch.abs(labels - 1), pre_ds])
-        positive_results = positive_samples / positive_lens
-        negative_results = negative_samples / negative_lens
-        results = torch.mean((negative_results + positive_results) / 2.0)
-        results = results.cpu()
-        return np.array(results)
+    def ranking_scores(self, u, test_samples, gt, cold=False):
+        """流式算 auc 和 top-K 指标, 每块user打完分就更新, 不保留整个 results 矩阵"""
+        with torch.no_grad():
+            item_table = self.item_table_cold() if cold else self.item_table()
+            return evaluate_split(self.user_table(), item_table, u, test_samples, gt, self.eval_chunk_size)
+
+    def eval_splits(self):
+        """(名字, user, 候选, gt, 是否用冷启动的 item 表), 和 val(), test(), test_warm(), test_cold() 一一对应"""
+        d = self.data_list
+        all_u = torch.arange(self.user_size)
+        return [('val', all_u, d.val_samples, d.val_gt, False),
+                ('test', all_u, d.test_samples, d.test_gt, False),
+                ('test_warm', d.test_warm_u, d.test_warm_samples, d.test_warm_gt, False),
+                ('test_cold', d.test_cold_u, d.test_cold_samples, d.test_cold_gt, True)]
+
+    def eval_tables(self):
+        """评估用的 (user 表, item 表, 冷启动 item 表), 没有冷启动表的模型最后一个是 None"""
+        with torch.no_grad():
+            overridden = type(self).item_table_cold is not Model.item_table_cold
+            return (self.user_table().detach(), self.item_table().detach(),
+                    self.item_table_cold().detach() if overridden else None)
+
+    def snapshot(self):
+        """eval_tables 各 clone 一份, 之后训练原地更新参数不影响快照"""
+        return tuple(None if t is None else t.clone() for t in self.eval_tables())
+
+    def evaluate(self, profiler=DISABLED):
+        """val/test/test_warm/test_cold 各自算完, 返回 {评估集: 指标}"""
+        return evaluate_splits(self.eval_splits(), *self.eval_tables(), self.eval_chunk_size, profiler)
+
+    def log_report(self, epoch, report, timings=None):
+        """一个 epoch 的评估报告 (和可选的 {阶段: 秒数}) 写进指标日志, 终端上打印一份"""
+        print(f'epoch is {epoch}-----')
+        for name, scores in report.items():
+            print(f'----- {name}: ' + ' '.join(['%s: %s' % (m, str(scores[m])) for m in sorted(scores)]))
+        sink = self.metrics_sink()
+        sink.log_report(epoch, report)
+        if timings:
+            sink.log_timings(epoch, timings)
+
+    def recommend(self, user_ids, n, exclude_seen=True, cold=False):
+        """
+        user_ids 在全部 item 里的 top-n 推荐, 返回 (len(user_ids), n) 的 int32 item id
+        exclude_seen 时去掉训练集里交互过的 item, cold=True 时 item 用 item_mlp(item_features)
+        """
+        interactions = self.data_list.interactions() if exclude_seen else None
+        with torch.no_grad():
+            item_table = self.item_table_cold() if cold else self.item_table()
+            return recommend(self.user_table(), item_table, user_ids, n, interactions, self.eval_chunk_size)
 
     def compute_scores(self, gt, preds):
-        ret = {
-            'auc':  self.auc_calculate(gt, preds),
-            'ndcg': Metric.ndcg(gt, preds)
+        return ranking_metrics(gt, preds)
 
-        }
-        return ret
-
-    def __logscore(self, scores):
+    def __logscore(self, name, scores):
         metrics = list(scores.keys())
         metrics.sort()
-        file_path = open(self.filename, 'a')
         print(' '.join(['%s: %s' % (m, str(scores[m])) for m in metrics]))
-        print(' '.join(['%s: %s' % (m, str(scores[m])) for m in metrics]), file=file_path)  #
+        self.metrics_sink().log_scores(self.epoch, name, scores)
         # self.logging.info(' '.join(['%s: %s' % (m,str(scores[m])) for m in metrics]))
 
     def test(self):
-        file_path = open(self.filename, 'a')
-        print('----- test', file=file_path)
         u = torch.LongTensor(range(self.user_size))
-        u = u.cuda()
-        test_arr = self.data_list.test_samples
-        test_tensor = torch.from_numpy(test_arr)
-        test_tensor = test_tensor.cuda()
-        results = self.compute_results(u, test_tensor)
-        scores = self.compute_scores(self.data_list.test_gt, results)
-        self.__logscore(scores)
+        u = u.to(self.device)
+        scores = self.ranking_scores(u, self.data_list.test_samples, self.data_list.test_gt)
+        self.__logscore('test', scores)
         print('----- test -----end-----')
 
     def val(self):
-        file_path = open(self.filename, 'a')
-        print('----- val', file=file_path)
         u = torch.LongTensor(range(self.user_size))
-        results = self.compute_results(u, self.data_list.val_samples)
-        scores = self.compute_scores(self.data_list.val_gt, results)
-        self.__logscore(scores)
+        scores = self.ranking_scores(u, self.data_list.val_samples, self.data_list.val_gt)
+        self.__logscore('val', scores)
         print('----- val -----end-----')
 
     def test_warm(self):
-        file_path = open(self.filename, 'a')
-        print('----- test_warm', file=file_path)
         u = self.data_list.test_warm_u
-        u = u.cuda()
-        results = self.compute_results(u, self.data_list.test_warm_samples)
-        scores = self.compute_scores(self.data_list.test_warm_gt, results)
-        self.__logscore(scores)
+        u = u.to(self.device)
+        scores = self.ranking_scores(u, self.data_list.test_warm_samples, self.data_list.test_warm_gt)
+        self.__logscore('test_warm', scores)
         print('----- test_warm -----end-----')
 
     def test_cold(self):
-        file_path = open(self.filename, 'a')
-        print('----- test_cold', file=file_path)
         u = self.data_list.test_cold_u
-        u = u.cuda()
-        results = self.compute_results_cold(u, self.data_list.test_cold_samples)  # _cold
-        scores = self.compute_scores(self.data_list.test_cold_gt, results)
-        self.__logscore(scores)
+        u = u.to(self.device)
+        scores = self.ranking_scores(u, self.data_list.test_cold_samples, self.data_list.test_cold_gt,
+                                     cold=True)  # _cold
+        self.__logscore('test_cold', scores)
         print('----- test_cold -----end-----')
 
     def train(self):
@@ -134,8 +170,12 @@ class Model(nn.Module):
     def predict_cold(self):
         raise Exception('no implementation')
 
-    def save(self):
-        raise Exception('no implementation')
+    def save(self, path, dtype='float32'):
+        """user/item embedding 和冷启动的 item 投影导出成可以 mmap 的文件 (float32/float16/int8), 见 export.py"""
+        with torch.no_grad():
+            overridden = type(self).item_table_cold is not Model.item_table_cold
+            export_embeddings(path, self.user_table(), self.item_table(),
+                              self.item_table_cold() if overridden else None, dtype)
 
 
 class Metric:
@@ -153,16 +193,10 @@ class Metric:
     @staticmethod
     def ndcg(gt, preds):
         print('.ndcg')
-        gt = torch.from_numpy(gt)
-        preds = torch.from_numpy(preds)
         K = [5, 10, 20]
-        return [ndcg_score(gt, preds, k=k) for k in K]  # 看这个地方具体怎么写的 修改这个地方的具体实现
+        return ranking_metrics(gt, preds, K)['ndcg']  # 一次 argpartition 同时得到所有 K
 
     @staticmethod
     def auc(gt, preds):
         print('.auc')
-        gt = torch.from_numpy(gt)
-        # gt = gt.cuda()
-        preds = torch.from_numpy(preds)
-        # preds = preds.cuda()
-        return roc_auc_score(gt, preds, average='samples')  # 两个nd-array 进行auc计算
\ No newline at end of file
+        return auc_score(gt, preds)  # 每个user秩和算精确的auc, 再平均
\ No newline at end of file
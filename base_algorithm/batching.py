@@ -0,0 +1,67 @@
+import numpy as np
+
+
+class BatchPlanner:
+    """
+    每个 epoch 只抽一次行下标的排列, batch 用 fancy indexing 直接 gather 到 int64 buffer 里,
+    默认每个 batch 新分配 buffer; reuse(n) 之后第 i 个 batch 用 n 个预先分配的 buffer 里的第 i % n 个,
+    调用方 (BatchPrefetcher) 要保证同时活着的 batch 不超过 n 个
+    rows (train_list) 本身从不修改, 可以是只读的 memmap, 多个进程共享同一份
+    drop_last=False 时最后一个不满的 batch 用本 epoch 排列开头的行补满
+    同一个 seed 每个 epoch 的排列序列都一样
+    """
+    def __init__(self, rows, batch_size, drop_last=True, seed=None):
+        self.rows = rows
+        self.batch_size = batch_size
+        self.drop_last = drop_last
+        self.rng = np.random.default_rng(seed)
+        self.order = np.arange(len(rows))
+        self.ring = 0
+        self.buffers = {}
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.rows) // self.batch_size
+        return -(-len(self.rows) // self.batch_size)
+
+    def shuffle(self):
+        """开始一个新 epoch"""
+        self.order = self.rng.permutation(len(self.rows))
+        return self
+
+    def reuse(self, n):
+        """之后的 gather 轮流复用 n 个 buffer, n = 0 时恢复每次新分配"""
+        if n != self.ring:
+            self.ring = n
+            self.buffers = {}
+        return self
+
+    def _buffer(self, i, n, width):
+        if not self.ring:
+            return np.empty((n, width), dtype=np.int64)
+        key = (i % self.ring, width)
+        out = self.buffers.get(key)
+        if out is None or len(out) != n:
+            out = self.buffers[key] = np.empty((n, width), dtype=np.int64)
+        return out
+
+    def indices(self, i):
+        idx = self.order[i * self.batch_size:(i + 1) * self.batch_size]
+        if len(idx) < self.batch_size:
+            idx = np.concatenate([idx, self.order[:self.batch_size - len(idx)]])
+        return idx
+
+    def gather(self, i, width=None):
+        """
+        第 i 个 batch, 返回 (B, width) 的 int64 数组, 前 rows.shape[1] 列是 gather 出来的行
+        width 更大时多出来的列留给调用方填 (比如负样本)
+        """
+        idx = self.indices(i)
+        cols = self.rows.shape[1]
+        out = self._buffer(i, len(idx), width or cols)
+        if self.rows.dtype == np.int64:
+            # 下标都在范围内, mode='clip' 让 take 直接写进 out, 不经过临时数组
+            np.take(self.rows, idx, axis=0, out=out[:, :cols], mode='clip')
+        else:
+            out[:, :cols] = self.rows[idx]
+        return out
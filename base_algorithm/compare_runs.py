@@ -0,0 +1,49 @@
+import argparse
+import math
+from .metrics_sink import read_records
+
+parser = argparse.ArgumentParser(description='compare runs of a hyperparameter sweep from their metrics logs')
+parser.add_argument('paths', nargs='+', metavar='path', help='JSON-lines files written by MetricsSink')
+parser.add_argument('--split', default='val', type=str, metavar='split',
+                    help='split used to pick the best epoch of every run', dest='split')
+parser.add_argument('--metric', default='ndcg@10', type=str, metavar='metric',
+                    help='metric used to pick the best epoch of every run', dest='metric')
+parser.add_argument('--report', default='test,test_warm,test_cold', type=str, metavar='report',
+                    help='comma separated splits whose metric is shown at the best epoch', dest='report')
+
+
+def best_epochs(records, split, metric):
+    """{run: (最好的 epoch, 值)}, 按 split 上的 metric 选, 越大越好; nan 不参与"""
+    best = {}
+    for r in records:
+        if r['split'] != split or r['metric'] != metric or r['value'] is None or math.isnan(r['value']):
+            continue
+        if r['run'] not in best or r['value'] > best[r['run']][1]:
+            best[r['run']] = (r['epoch'], r['value'])
+    return best
+
+
+def compare(records, split='val', metric='ndcg@10', report=('test', 'test_warm', 'test_cold')):
+    """每个 run 一行: (run, 最好的 epoch, 该 epoch 上 split 和 report 里每个评估集的 metric), 按 split 的值降序"""
+    values = {(r['run'], r['epoch'], r['split']): r['value'] for r in records if r['metric'] == metric}
+    rows = []
+    for run, (epoch, value) in best_epochs(records, split, metric).items():
+        rows.append((run, epoch, [value] + [values.get((run, epoch, s), float('nan')) for s in report]))
+    rows.sort(key=lambda row: -row[2][0])
+    return rows
+
+
+def main():
+    args = parser.parse_args()
+    records = [r for path in args.paths for r in read_records(path)]
+    report = [s for s in args.report.split(',') if s]
+    rows = compare(records, args.split, args.metric, report)
+    width = max([len('run')] + [len(run) for run, _, _ in rows])
+    print(f'{"run":<{width}}  {"epoch":>5}  ' + '  '.join(f'{s:>10}' for s in [args.split] + report)
+          + f'   ({args.metric})')
+    for run, epoch, values in rows:
+        print(f'{run:<{width}}  {epoch:>5}  ' + '  '.join(f'{v:10.4f}' for v in values))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,17 @@
+import time
 import numpy as np
 import torch.nn as nn
 import torch
 import torch.nn.functional as fun
 from .base_model import Model
+from .sampler import NegativeSampler, HardNegativeSampler, PopularityNegativeSampler, epoch_batches
+from .batching import BatchPlanner
+from .projection import ProjectionCache
+from .device import Backend
+from .losses import squared_distance_sums
+from .optim import lookup, SplitOptimizer
+from .async_eval import AsyncEvaluator
+from .profiling import Profiler
 from tensorboardX import SummaryWriter
 
 
@@ -15,29 +24,46 @@ class CR(Model):
         self.batch_size = self.args.bsz
         self.filename = filename
         self.data_list = dataset
+        self.backend = Backend.from_args(args)
+        self.device = self.backend.device
         self.user_size = len(self.data_list.user_set)
         self.item_size = len(self.data_list.item_set)
         self.sz = self.data_list.train_list.shape[0]
+        self.planner = BatchPlanner(self.data_list.train_list, self.batch_size, seed=self.args.seed)
+        # --sparse: embedding 表的梯度只含 batch 碰到的行, 用 SparseAdam 按行更新
+        self.sparse = getattr(self.args, 'sparse', False)
+        if self.args.ih:
+            # 按 hard_ratio 混合 co_items 里的 hard negative 和均匀负样本
+            self.sampler = HardNegativeSampler(self.data_list.interactions(), self.data_list.co_items(),
+                                               self.args.hard_ratio, seed=self.args.seed)
+        elif self.args.neg_alpha is not None:
+            # 按 item 流行度 degree^neg_alpha 抽负样本
+            counts = np.bincount(np.asarray(self.data_list.train_list[:, 1]), minlength=self.item_size)
+            self.sampler = PopularityNegativeSampler(self.data_list.interactions(), counts, self.args.neg_alpha,
+                                                     seed=self.args.seed)
+        else:
+            self.sampler = NegativeSampler(self.data_list.interactions(), seed=self.args.seed)
 
         # user id embedding
         self.user_matrix = nn.Embedding(self.user_size, self.args.dim)
-        self.user_matrix = self.user_matrix.cuda()
+        self.user_matrix = self.user_matrix.to(self.device)
         self.user_matrix = nn.init.normal_(self.user_matrix.weight, std=0.01)
 
         # item id embedding
         self.item_matrix = nn.Embedding(self.item_size, self.args.dim)
-        self.item_matrix = self.item_matrix.cuda()
+        self.item_matrix = self.item_matrix.to(self.device)
         self.item_matrix = nn.init.normal_(self.item_matrix.weight, std=0.01)
 
         # item feature vectors 需要对这个加一层mlp 和 relu函数，使输出后的结果尽可能靠近embedding
         # positive sample 是 item_matrix里面
         self.item_features = torch.from_numpy(self.data_list.item_set)
         self.item_features.requires_grad = False
-        self.item_features = self.item_features.cuda()
+        self.item_features = self.item_features.to(self.device)
         dim_mlp = self.item_features.shape[1]
         self.item_features = self.item_features.float()
         self.item_mlp = nn.Sequential(nn.Linear(dim_mlp, dim_mlp), nn.LeakyReLU(), nn.Linear(dim_mlp, dim_mlp))  #
-        self.item_mlp = self.item_mlp.cuda()
+        self.item_mlp = self.item_mlp.to(self.device)
+        self.projection = ProjectionCache(self.item_mlp, self.item_features)
 
     def predict(self, uid, iid):
         """
@@ -45,8 +71,8 @@ class CR(Model):
         iid of item_matrix
         :return:
         """
-        p1 = self.user_matrix[uid]
-        p2 = self.item_matrix[iid]
+        p1 = lookup(self.user_matrix, uid, self.sparse)
+        p2 = lookup(self.item_matrix, iid, self.sparse)
         return torch.sum(p1 * p2, dim=1)
 
     def predict_cold(self, uid, iid):
@@ -56,10 +82,13 @@ class CR(Model):
         :return:
         """
         p1 = self.user_matrix[uid]
-        item_fixed = self.item_mlp(self.item_features)
+        item_fixed = self.projection.full()
         p2 = item_fixed[iid]
         return torch.sum(p1 * p2, dim=1)
 
+    def item_table_cold(self):
+        return self.projection.full()
+
     def bpr_loss(self, uid, iid, jid):
         """
         bpr的算法是，对一个用户u求i和j两个item的分数，然后比较更喜欢哪个，
@@ -76,9 +105,12 @@ class CR(Model):
         """
         pos_ids = torch.unique(iid)
         neg_ids = torch.unique(jid)
-        anchor_feature = torch.einsum('ni, ci -> nc', [item_fixed[pos_ids], self.user_matrix[uid]])  # 得到 is * us
-        pos_embedding = torch.einsum('ni, ci -> nc', [self.item_matrix[pos_ids], self.user_matrix[uid]])  # is * us
-        neg_embedding = torch.einsum('ni, ci -> nc', [self.item_matrix[neg_ids], self.user_matrix[uid]])  # 得到 js * us
+        user_embedding = lookup(self.user_matrix, uid, self.sparse)
+        anchor_feature = torch.einsum('ni, ci -> nc', [item_fixed[pos_ids], user_embedding])  # 得到 is * us
+        pos_embedding = torch.einsum('ni, ci -> nc', [lookup(self.item_matrix, pos_ids, self.sparse),
+                                                      user_embedding])  # is * us
+        neg_embedding = torch.einsum('ni, ci -> nc', [lookup(self.item_matrix, neg_ids, self.sparse),
+                                                      user_embedding])  # 得到 js * us
         anchor_feature_squeeze = anchor_feature.unsqueeze(1)  # 升维用于跟 neg_embedding的广播机制运算 点乘
 
         anchor_fea_norm = torch.norm(anchor_feature, dim=1, keepdim=True)  # 求二范数
@@ -108,14 +140,13 @@ class CR(Model):
         pos_ids = torch.unique(iid)
         neg_ids = torch.unique(jid)
         pos_feature = item_fixed[pos_ids]  # 得到 is * 64矩阵
-        pos_embedding = self.item_matrix[pos_ids]
-        neg_embedding = self.item_matrix[neg_ids]  # 得到 js * 64矩阵
+        pos_embedding = lookup(self.item_matrix, pos_ids, self.sparse)
+        neg_embedding = lookup(self.item_matrix, neg_ids, self.sparse)  # 得到 js * 64矩阵
         pos_pos_dif = pos_feature - pos_embedding
         pos_scores = torch.einsum('ni, ni -> n', [pos_pos_dif, pos_pos_dif])  # 得到1 * is 的矩阵
-        pos_feature_squeeze = pos_feature.unsqueeze(1)  # 将pos_feature升维成is * 1 * 64方便广播计算
-        pos_neg_dif = pos_feature_squeeze - neg_embedding  # 得到的差值是一个 is * js * 64的矩阵
-        neg_scores = torch.einsum('nij, nij -> ni', [pos_neg_dif, pos_neg_dif])  # 得到 is * js 的平方和矩阵 i 与 j个neg
-        neg_scores_sum = torch.sum(neg_scores, dim=1)  # 得到 1 * is的矩阵
+        # 每个 pos_feature 到所有 neg_embedding 的距离平方和, 不再构造 is * js * 64 的差值张量
+        neg_scores_sum = squared_distance_sums(pos_feature, neg_embedding,
+                                               getattr(self.args, 'dist_tile', 0))  # 得到 1 * is的矩阵
         """
           对于每一个item求 -log(pos / (pos + neg))， 然后所有item加和
         """
@@ -126,9 +157,9 @@ class CR(Model):
     def regs(self, uid, iid, jid):
         # regs:  default value is 0
         reg = self.args.reg
-        uid_v = self.user_matrix[uid]
-        iid_v = self.item_matrix[iid]
-        jid_v = self.item_matrix[jid]
+        uid_v = lookup(self.user_matrix, uid, self.sparse)
+        iid_v = lookup(self.item_matrix, iid, self.sparse)
+        jid_v = lookup(self.item_matrix, jid, self.sparse)
         emb_regs = torch.sum(uid_v * uid_v) + torch.sum(iid_v * iid_v) + torch.sum(jid_v * jid_v)
         return reg * emb_regs
 
@@ -136,8 +167,18 @@ class CR(Model):
 
         print('cr is training')
         lr = self.args.lr
-        optimizer = torch.optim.Adam(self.parameters(), lr=lr, weight_decay=0)
+        if self.sparse:
+            optimizer = SplitOptimizer([self.user_matrix, self.item_matrix], self.parameters(), lr)
+        else:
+            optimizer = torch.optim.Adam(self.parameters(), lr=lr, weight_decay=0)
         epochs = self.args.epochs
+        # --async_eval: 评估在后台线程里对 embedding 快照做, 训练不停
+        evaluator = None
+        if getattr(self.args, 'async_eval', False):
+            evaluator = AsyncEvaluator(self.eval_splits(), self.log_report, chunk_size=self.eval_chunk_size)
+        # --timing / --profile: 每个阶段计时, 每个 epoch 的分阶段耗时写进指标日志
+        profiler = Profiler.from_args(self.args, self.device)
+        profiler.start()
         for epoch in range(epochs):
 
             generator = self.sample()  # 这里生成的
@@ -145,44 +186,45 @@ class CR(Model):
             while True:
 
                 optimizer.zero_grad()
-                item_fixed = self.item_mlp(self.item_features)
 
-                s = next(generator)
+                with profiler.stage('sample'):
+                    s = next(generator)
                 if s is None:
                     break
 
                 uid, iid, jid = s[:, 0], s[:, 1], s[:, 2]
-                uid = uid.cuda()
-                iid = iid.cuda()
-                jid = jid.cuda()
-                loss_bpr = self.bpr_loss(uid, iid, jid) + self.regs(uid, iid, jid)
-                # loss_con = self.con_loss_matmul(item_fixed, iid, jid)
-                loss_con = self.con_loss(item_fixed, uid, iid, jid)  # con_loss 训练到0.00应该是显然存在问题的
-                loss = loss_con + loss_bpr
+                with profiler.stage('item_mlp'):
+                    item_fixed = self.projection.batch(torch.cat([iid, jid]))
+                with profiler.stage('loss'):
+                    loss_bpr = self.bpr_loss(uid, iid, jid) + self.regs(uid, iid, jid)
+                    # loss_con = self.con_loss_matmul(item_fixed, iid, jid)
+                    loss_con = self.con_loss(item_fixed, uid, iid, jid)  # con_loss 训练到0.00应该是显然存在问题的
+                    loss = loss_con + loss_bpr
                 # current_loop += 1
 
-                loss.backward()
-                optimizer.step()
+                with profiler.stage('backward'):
+                    loss.backward()
+                with profiler.stage('step'):
+                    optimizer.step()
+                    self.projection.invalidate()
+                profiler.step(len(s))
             # if epoch % 10 == 0 and epoch > 1:
-            #     torch.save(item_fixed, f'.\\crpt\\exp9\\epoch{epoch}-item_fixed.pt')
+            #     torch.save(self.projection.full(), f'.\\crpt\\exp9\\epoch{epoch}-item_fixed.pt')
 
             if epoch % 2 == 0 and epoch > 1:  #
                 print(f'=={epoch}===>loss_bpr is {loss_bpr}===loss_con is {loss_con}')
-                file_path = open(self.filename, 'a')
-                print(f'epoch is {epoch}-----', file=file_path)
-                self.val(), self.test(), self.test_warm(), self.test_cold()
+                if evaluator is not None:
+                    evaluator.submit(epoch, *self.snapshot())
+                else:
+                    # val/test/test_warm/test_cold 合成一份报告写进指标日志
+                    start = time.perf_counter()
+                    report = self.evaluate(profiler)
+                    self.log_report(epoch, report, {'eval': time.perf_counter() - start})
+            self.log_timings(epoch, profiler)
+        profiler.stop()
+        if evaluator is not None:
+            evaluator.close()
+        self.close_metrics()
 
     def sample(self):
-        np.random.shuffle(self.data_list.train_list)
-        loop_size = self.sz // self.batch_size
-        for i in range(loop_size):
-            pairs = []
-            sub_train_list = self.data_list.train_list[i * self.batch_size:(i + 1) * self.batch_size, :]
-            for m, j in sub_train_list:
-                m_neg = j
-                while m_neg in self.data_list.train_pt[m]:
-                    m_neg = np.random.randint(self.item_size)
-                pairs.append((m, j, m_neg))
-
-            yield torch.LongTensor(pairs)
-        yield None
+        return epoch_batches(self.planner, self.sampler, self.backend, self.args)
@@ -1,15 +1,25 @@
 import argparse
 import torch
-import os
 import numpy as np
 import torch.nn as nn
 import torch.nn.functional as fun
 from tensorboardX import SummaryWriter
-from sklearn.metrics import roc_auc_score, ndcg_score
+from base_algorithm.sampler import NegativeSampler, HardNegativeSampler, epoch_batches
+from base_algorithm.batching import BatchPlanner
+from base_algorithm.interactions import InteractionIndex
+from base_algorithm.projection import ProjectionCache
+from base_algorithm.device import Backend
+from base_algorithm.losses import squared_distance_sums
+from base_algorithm.metrics import ranking_metrics, auc_score
+from base_algorithm.packed import load_dataset
+from base_algorithm.export import export_embeddings
+from base_algorithm.metrics_sink import MetricsSink
 
 parser = argparse.ArgumentParser(description='contrastive training for recommendation')
 parser.add_argument('--ih', '--if_hard', default=False, type=bool,
                     metavar='IH', help='whether use hard negative samples', dest='ih')
+parser.add_argument('--hard_ratio', default=0.5, type=float,
+                    metavar='hard_ratio', help='share of negatives drawn from co_items with --ih', dest='hard_ratio')
 parser.add_argument('--dim', '--dim_fea', default=64, type=int,
                     metavar='dim', help='the dim for item and user', dest='dim')
 parser.add_argument('--lr', '--learning_rate_bpr', default=0.01, type=float,
@@ -19,11 +29,22 @@ parser.add_argument('--reg', '--regular', default=0.01, type=float,
 parser.add_argument('--epochs', '--epoch_number', default=200, type=int,
                     metavar='epochs', help='training epochs', dest='epochs')
 parser.add_argument('--dp', '--data_path', default='/home/share/liqi/amazon/pt', type=str,
-                    metavar='dp', help='the path of dataset', dest='dp')
+                    metavar='dp', help='dataset directory of *.pt files or a packed dataset file', dest='dp')
 parser.add_argument('--gpu', default=0, type=int,
-                    metavar='GPU', help='gpu number to use', dest='gpu')
+                    metavar='GPU', help='gpu number to use, -1 for cpu', dest='gpu')
+parser.add_argument('--threads', default=None, type=int,
+                    metavar='threads', help='torch intra-op threads when running on cpu', dest='threads')
+parser.add_argument('--workers', default=2, type=int,
+                    metavar='workers', help='background threads preparing training batches', dest='workers')
+parser.add_argument('--prefetch', default=8, type=int,
+                    metavar='prefetch', help='max number of prepared batches waiting in the queue', dest='prefetch')
+parser.add_argument('--seed', default=None, type=int,
+                    metavar='seed', help='seed of the per-epoch batch order and the negative sampling', dest='seed')
 parser.add_argument('--bsz', default=64, type=int,
                     metavar='bsz', help='batch_size', dest='bsz')
+parser.add_argument('--dist_tile', default=0, type=int,
+                    metavar='dist_tile', help='negatives per tile in con_loss_matmul distances, 0 for the closed form',
+                    dest='dist_tile')
 """
 如果是随机选择negative samples，那么neg__num不能为None
 """
@@ -31,11 +52,27 @@ parser.add_argument('--bsz', default=64, type=int,
 
 class Model(nn.Module):
 
+    # 训练循环在评估前设置, val()/test() 写的记录用它标 epoch
+    epoch = None
+    sink = None
+
+    def metrics_sink(self):
+        """JSON-lines 的指标日志 (见 metrics_sink.py), 第一次用到时打开 self.filename, 之后一直用这一个句柄"""
+        if self.sink is None:
+            self.sink = MetricsSink(self.filename)
+        return self.sink
+
+    def close_metrics(self):
+        """把还在队列里的记录写完并关掉文件, 训练结束时调用"""
+        if self.sink is not None:
+            self.sink.close()
+            self.sink = None
+
     def compute_results(self, u, test_samples):
-        u = u.cuda()
+        u = u.to(self.device)
         if type(test_samples) != torch.Tensor:
             test_samples = torch.from_numpy(test_samples)
-        test_samples = test_samples.cuda()
+        test_samples = test_samples.to(self.device)
         rs = []
         for i in test_samples.T:
             # lt = torch.LongTensor(i)
@@ -50,10 +87,10 @@ class Model(nn.Module):
         return results
 
     def compute_results_cold(self, u, test_samples):
-        u = u.cuda()
+        u = u.to(self.device)
         if type(test_samples) != torch.Tensor:
             test_samples = torch.from_numpy(test_samples)
-        test_samples = test_samples.cuda()
+        test_samples = test_samples.to(self.device)
         rs = []
         for i in test_samples.T:
             # lt = torch.LongTensor(i)
@@ -67,83 +104,48 @@ class Model(nn.Module):
             raise Exception('nan')
         return results
 
-    @staticmethod
-    def auc_calculate(labels, pre_ds):
-        print('.auc')
-        labels = (torch.from_numpy(labels)).double()
-        labels = labels.cuda()
-        pre_ds = (torch.from_numpy(pre_ds)).double()
-        pre_ds = pre_ds.cuda()
-        # 计算tp，阈值设置为0.0，即预测集中，值大于0的样例设置为1，小于0的样例 设置为0
-        one = torch.ones_like(pre_ds)
-        zero = torch.zeros_like(pre_ds)
-        boundary = torch.mean(pre_ds) * 0.3
-        pre_ds = torch.where(pre_ds > boundary, one, zero)
-        positive_lens = torch.sum(labels, dim=1)
-        negative_lens = torch.abs(torch.sum(labels - 1, dim=1))
-        positive_samples = torch.einsum('ij, ij->i', [labels, pre_ds])
-        negative_samples = torch.einsum('ij, ij->i', [torch.abs(labels - 1), pre_ds])
-        positive_results = positive_samples / positive_lens
-        negative_results = negative_samples / negative_lens
-        results = torch.mean((negative_results + positive_results) / 2.0)
-        results = results.cpu()
-        return np.array(results)
-
     def compute_scores(self, gt, preds):
-        ret = {
-            'auc':  self.auc_calculate(gt, preds),
-            'ndcg': Metric.ndcg(gt, preds)
+        return ranking_metrics(gt, preds)
 
-        }
-        return ret
-
-    def __logscore(self, scores):
+    def __logscore(self, name, scores):
         metrics = list(scores.keys())
         metrics.sort()
-        file_path = open(self.filename, 'a')
-        print(' '.join(['%s: %s' % (m, str(scores[m])) for m in metrics]), file=file_path)  #
+        print(' '.join(['%s: %s' % (m, str(scores[m])) for m in metrics]))
+        self.metrics_sink().log_scores(self.epoch, name, scores)
         # self.logging.info(' '.join(['%s: %s' % (m,str(scores[m])) for m in metrics]))
 
     def test(self):
-        file_path = open(self.filename, 'a')
-        print('----- test', file=file_path)
         u = torch.LongTensor(range(self.user_size))
-        u = u.cuda()
+        u = u.to(self.device)
         test_arr = self.data_list.test_samples
         test_tensor = torch.from_numpy(test_arr)
-        test_tensor = test_tensor.cuda()
+        test_tensor = test_tensor.to(self.device)
         results = self.compute_results(u, test_tensor)
         scores = self.compute_scores(self.data_list.test_gt, results)
-        self.__logscore(scores)
+        self.__logscore('test', scores)
         print('----- test -----end-----')
 
     def val(self):
-        file_path = open(self.filename, 'a')
-        print('----- val', file=file_path)
         u = torch.LongTensor(range(self.user_size))
         results = self.compute_results(u, self.data_list.val_samples)
         scores = self.compute_scores(self.data_list.val_gt, results)
-        self.__logscore(scores)
+        self.__logscore('val', scores)
         print('----- val -----end-----')
 
     def test_warm(self):
-        file_path = open(self.filename, 'a')
-        print('----- test_warm', file=file_path)
         u = self.data_list.test_warm_u
-        u = u.cuda()
+        u = u.to(self.device)
         results = self.compute_results(u, self.data_list.test_warm_samples)
         scores = self.compute_scores(self.data_list.test_warm_gt, results)
-        self.__logscore(scores)
+        self.__logscore('test_warm', scores)
         print('----- test_warm -----end-----')
 
     def test_cold(self):
-        file_path = open(self.filename, 'a')
-        print('----- test_cold', file=file_path)
         u = self.data_list.test_cold_u
-        u = u.cuda()
+        u = u.to(self.device)
         results = self.compute_results_cold(u, self.data_list.test_cold_samples)  # _cold
         scores = self.compute_scores(self.data_list.test_cold_gt, results)
-        self.__logscore(scores)
+        self.__logscore('test_cold', scores)
         print('----- test_cold -----end-----')
 
     def train(self):
@@ -158,8 +160,10 @@ class Model(nn.Module):
     def predict_cold(self):
         raise Exception('no implementation')
 
-    def save(self):
-        raise Exception('no implementation')
+    def save(self, path, dtype='float32'):
+        """user/item embedding 和冷启动的 item 投影导出成可以 mmap 的文件 (float32/float16/int8), 见 base_algorithm.export"""
+        with torch.no_grad():
+            export_embeddings(path, self.user_matrix, self.item_matrix, self.projection.full(), dtype)
 
 
 class Metric:
@@ -177,19 +181,13 @@ class Metric:
     @staticmethod
     def ndcg(gt, preds):
         print('.ndcg')
-        gt = torch.from_numpy(gt)
-        preds = torch.from_numpy(preds)
         K = [5, 10, 20]
-        return [ndcg_score(gt, preds, k=k) for k in K]  # 看这个地方具体怎么写的 修改这个地方的具体实现
+        return ranking_metrics(gt, preds, K)['ndcg']  # 一次 argpartition 同时得到所有 K
 
     @staticmethod
     def auc(gt, preds):
         print('.auc')
-        gt = torch.from_numpy(gt)
-        # gt = gt.cuda()
-        preds = torch.from_numpy(preds)
-        # preds = preds.cuda()
-        return roc_auc_score(gt, preds, average='samples')  # 两个nd-array 进行auc计算
+        return auc_score(gt, preds)  # 每个user秩和算精确的auc, 再平均
 
 
 # 没有想到好的名字就用contrastive recommendation来代表这个model吧
@@ -201,29 +199,39 @@ class CR(Model):
         self.batch_size = self.args.bsz
         self.filename = filename
         self.data_list = dataset
+        self.backend = Backend.from_args(args)
+        self.device = self.backend.device
         self.user_size = len(self.data_list.user_set)
         self.item_size = len(self.data_list.item_set)
         self.sz = self.data_list.train_list.shape[0]
+        self.planner = BatchPlanner(self.data_list.train_list, self.batch_size, seed=self.args.seed)
+        if self.args.ih:
+            # 按 hard_ratio 混合 co_items 里的 hard negative 和均匀负样本
+            self.sampler = HardNegativeSampler(self.data_list.interactions(), self.data_list.co_items(),
+                                               self.args.hard_ratio, seed=self.args.seed)
+        else:
+            self.sampler = NegativeSampler(self.data_list.interactions(), seed=self.args.seed)
 
         # user id embedding
         self.user_matrix = nn.Embedding(self.user_size, self.args.dim)
-        self.user_matrix = self.user_matrix.cuda()
+        self.user_matrix = self.user_matrix.to(self.device)
         self.user_matrix = nn.init.normal_(self.user_matrix.weight, std=0.01)
 
         # item id embedding
         self.item_matrix = nn.Embedding(self.item_size, self.args.dim)
-        self.item_matrix = self.item_matrix.cuda()
+        self.item_matrix = self.item_matrix.to(self.device)
         self.item_matrix = nn.init.normal_(self.item_matrix.weight, std=0.01)
 
         # item feature vectors 需要对这个加一层mlp 和 relu函数，使输出后的结果尽可能靠近embedding
         # positive sample 是 item_matrix里面
         self.item_features = torch.from_numpy(self.data_list.item_set)
         self.item_features.requires_grad = False
-        self.item_features = self.item_features.cuda()
+        self.item_features = self.item_features.to(self.device)
         dim_mlp = self.item_features.shape[1]
         self.item_features = self.item_features.float()
         self.item_mlp = nn.Sequential(nn.Linear(dim_mlp, dim_mlp), nn.Linear(dim_mlp, dim_mlp))  # nn.LeakyReLU()
-        self.item_mlp = self.item_mlp.cuda()
+        self.item_mlp = self.item_mlp.to(self.device)
+        self.projection = ProjectionCache(self.item_mlp, self.item_features)
 
     def predict(self, uid, iid):
         """
@@ -242,7 +250,7 @@ class CR(Model):
         :return:
         """
         p1 = self.user_matrix[uid]
-        item_fixed = self.item_mlp(self.item_features)
+        item_fixed = self.projection.full()
         p2 = item_fixed[iid]
         return torch.sum(p1 * p2, dim=1)
 
@@ -278,10 +286,9 @@ class CR(Model):
         neg_embedding = self.item_matrix[neg_ids]  # 得到 js * 64矩阵
         pos_pos_dif = pos_feature - pos_embedding
         pos_scores = torch.einsum('ni, ni -> n', [pos_pos_dif, pos_pos_dif])  # 得到1 * is 的矩阵
-        pos_feature_squeeze = pos_feature.unsqueeze(1)  # 将pos_feature升维成is * 1 * 64方便广播计算
-        pos_neg_dif = pos_feature_squeeze - neg_embedding  # 得到的差值是一个 is * js * 64的矩阵
-        neg_scores = torch.einsum('nij, nij -> ni', [pos_neg_dif, pos_neg_dif])  # 得到 is * js 的平方和矩阵 i 与 j个neg
-        neg_scores_sum = torch.sum(neg_scores, dim=1)  # 得到 1 * is的矩阵
+        # 每个 pos_feature 到所有 neg_embedding 的距离平方和, 不再构造 is * js * 64 的差值张量
+        neg_scores_sum = squared_distance_sums(pos_feature, neg_embedding,
+                                               getattr(self.args, 'dist_tile', 0))  # 得到 1 * is的矩阵
         """
           对于每一个item求 -log(pos / (pos + neg))， 然后所有item加和
         """
@@ -311,16 +318,13 @@ class CR(Model):
             while True:
 
                 optimizer.zero_grad()
-                item_fixed = self.item_mlp(self.item_features)
 
                 s = next(generator)
                 if s is None:
                     break
 
                 uid, iid, jid = s[:, 0], s[:, 1], s[:, 2]
-                uid = uid.cuda()
-                iid = iid.cuda()
-                jid = jid.cuda()
+                item_fixed = self.projection.batch(torch.cat([iid, jid]))
                 loss_bpr = self.bpr_loss(uid, iid, jid) + self.regs(uid, iid, jid)
                 loss_con = self.con_loss_matmul(item_fixed, iid, jid)
                 # loss_con = self.con_loss(item_fixed, iid, jid)  # con_loss 训练到0.00应该是显然存在问题的
@@ -329,32 +333,22 @@ class CR(Model):
 
                 loss.backward()
                 optimizer.step()
+                self.projection.invalidate()
             if epoch % 10 == 0 and epoch > 1:
-                torch.save(item_fixed, f'./1/epoch{epoch}-item_fixed.pt')
+                # 原来只 torch.save 了 item_fixed, 现在整个模型导出成一个可以 mmap 的文件
+                self.save(f'./1/epoch{epoch}.emb')
                 writer = SummaryWriter('./runs/cr/exp_loss_mul_0.07', epoch)
                 # writer.add_embedding(self.item_matrix, global_step=epoch)
-                writer.add_embedding(self.item_mlp(self.item_features), global_step=epoch)
+                writer.add_embedding(self.projection.full(), global_step=epoch)
                 writer.flush()
             if epoch % 2 == 0 and epoch > 1:  #
                 print(f'=={epoch}===>loss_bpr is {loss_bpr}===loss_con is {loss_con}')
-                file_path = open(self.filename, 'a')
-                print(f'epoch is {epoch}-----', file=file_path)
+                self.epoch = epoch
                 self.val(), self.test(), self.test_warm(), self.test_cold()
+        self.close_metrics()
 
     def sample(self):
-        np.random.shuffle(self.data_list.train_list)
-        loop_size = self.sz // self.batch_size
-        for i in range(loop_size):
-            pairs = []
-            sub_train_list = self.data_list.train_list[i * self.batch_size:(i + 1) * self.batch_size, :]
-            for m, j in sub_train_list:
-                m_neg = j
-                while m_neg in self.data_list.train_pt[m]:
-                    m_neg = np.random.randint(self.item_size)
-                pairs.append((m, j, m_neg))
-
-            yield torch.LongTensor(pairs)
-        yield None
+        return epoch_batches(self.planner, self.sampler, self.backend, self.args)
 
 
 class LoadData:
@@ -400,6 +394,30 @@ class LoadData:
         self.val_samples = val_samples
         self.val_gt = val_gt
         self.test_gt = test_gt
+        self.hard_negatives = hard_negatives
+        # train_pt / hard_negatives 的 CSR 索引, 第一次用到时才建
+        self.index_cache = None
+        self.index_source = None
+        self.interaction_index = None
+        self.co_item_index = None
+
+    def interactions(self):
+        """train_pt 的 InteractionIndex, 只建一次; index_cache 是路径时缓存到磁盘, 下次直接 mmap"""
+        if self.interaction_index is None:
+            user_size, item_size = len(self.user_set), len(self.item_set)
+            if self.index_cache:
+                self.interaction_index = InteractionIndex.cached(self.index_cache, self.train_pt,
+                                                                 user_size, item_size, self.index_source)
+            else:
+                self.interaction_index = InteractionIndex.build(self.train_pt, user_size, item_size)
+        return self.interaction_index
+
+    def co_items(self):
+        """hard_negatives (co_items.pt) 的 item -> 共现item CSR 索引, 给 HardNegativeSampler 用"""
+        if self.co_item_index is None:
+            item_size = len(self.item_set)
+            self.co_item_index = InteractionIndex.build(self.hard_negatives, item_size, item_size)
+        return self.co_item_index
 
 
 def main():
@@ -407,69 +425,17 @@ def main():
     lr_params = f'lr-{args.lr}-'
     reg_params = f'reg-{args.reg}-'
     bsz_params = f'bsz-{args.bsz}-'
-    filename = f'cr-{lr_params}-{reg_params}-{bsz_params}.txt'
-
-    if not os.path.exists(filename):
-        open(filename, 'x')
+    filename = f'cr-{lr_params}-{reg_params}-{bsz_params}.jsonl'
 
     if args.gpu is None:
         args.gpu = 0
-    torch.cuda.set_device(args.gpu)
-
-    base_path = args.dp
-    # 读取预处理的数据
-    user_set = torch.load(base_path + '/user_set.pt')
-    item_set = torch.load(base_path + '/item_set.pt')
-    train_pt = torch.load(base_path + '/train.pt')
-    train_list = torch.load(base_path + '/train_list_as_array.pt')
-
-    test_cold_gt = torch.load(base_path + '/test_cold_gt.pt')
-    test_cold_samples = torch.load(base_path + '/test_cold_samples.pt')
-    test_cold_u = torch.load(base_path + '/test_cold_u.pt')
-    test_samples = torch.load(base_path + '/test_samples.pt')
-    test_set = torch.load(base_path + '/test_set.pt')
-    test_warm_gt = torch.load(base_path + '/test_warm_gt.pt')
-    test_warm_samples = torch.load(base_path + '/test_warm_samples.pt')
-    test_warm_u = torch.load(base_path + '/test_warm_u.pt')
-    val_cold_gt = torch.load(base_path + '/val_cold_gt.pt')
-    val_cold_samples = torch.load(base_path + '/val_cold_samples.pt')
-    val_cold_u = torch.load(base_path + '/val_cold_u.pt')
-
-    val_set = torch.load(base_path + '/val_set.pt')
-    val_warm_gt = torch.load(base_path + '/val_warm_gt.pt')
-    val_warm_samples = torch.load(base_path + '/val_warm_samples.pt')
-    val_warm_u = torch.load(base_path + '/val_warm_u.pt')
-
-    val_samples = torch.load(base_path + '/val_samples.pt')
-    val_gt = torch.load(base_path + '/val_gt.pt')
-    test_gt = torch.load(base_path + '/test_gt.pt')
-
-    hard_negatives = torch.load(base_path + '/co_items.pt')
-
-    data = LoadData(user_set,
-                    item_set,
-                    train_pt,
-                    train_list,
-                    test_cold_gt,
-                    test_cold_samples,
-                    test_cold_u,
-                    test_samples,
-                    test_warm_gt,
-                    test_warm_samples,
-                    test_warm_u,
-                    val_cold_gt,
-                    val_cold_samples,
-                    val_cold_u,
-                    val_warm_gt,
-                    val_warm_samples,
-                    val_warm_u,
-                    val_samples,
-                    val_gt,
-                    test_gt,
-                    hard_negatives)
+
+    # dp 是目录就逐个 torch.load *.pt, 是 python -m base_algorithm.packed 打包出来的文件就直接 mmap
+    data = load_dataset(args.dp, LoadData)
     print('data is ready')
     cr_model = CR(args, data, filename)
-    cr_model = cr_model.cuda()
+    cr_model = cr_model.to(cr_model.device)
+    print(f'cr is running on {cr_model.backend}')
     cr_model.train()
 
 
@@ -1,8 +1,12 @@
-import numpy as np
 import torch.nn as nn
 import torch
 import torch.nn.functional as fun
 from .base_model import Model
+from .sampler import NegativeSampler, HardNegativeSampler, epoch_batches
+from .batching import BatchPlanner
+from .projection import ProjectionCache
+from .device import Backend
+from .losses import squared_distance_sums
 from tensorboardX import SummaryWriter
 
 
@@ -14,29 +18,39 @@ class CR(Model):
         self.args = args
         self.batch_size = self.args.bsz
         self.data_list = dataset
+        self.backend = Backend.from_args(args)
+        self.device = self.backend.device
         self.user_size = len(self.data_list.user_set)
         self.item_size = len(self.data_list.item_set)
         self.sz = self.data_list.train_list.shape[0]
+        self.planner = BatchPlanner(self.data_list.train_list, self.batch_size, seed=self.args.seed)
+        if self.args.ih:
+            # 按 hard_ratio 混合 co_items 里的 hard negative 和均匀负样本
+            self.sampler = HardNegativeSampler(self.data_list.interactions(), self.data_list.co_items(),
+                                               self.args.hard_ratio, seed=self.args.seed)
+        else:
+            self.sampler = NegativeSampler(self.data_list.interactions(), seed=self.args.seed)
 
         # user is embedding
         self.user_matrix = nn.Embedding(self.user_size, self.args.dim)
-        self.user_matrix = self.user_matrix.cuda()
+        self.user_matrix = self.user_matrix.to(self.device)
         self.user_matrix = nn.init.normal_(self.user_matrix.weight, std=0.01)
 
         # item id embedding
         self.item_matrix = nn.Embedding(self.item_size, self.args.dim)
-        self.item_matrix = self.item_matrix.cuda()
+        self.item_matrix = self.item_matrix.to(self.device)
         self.item_matrix = nn.init.normal_(self.item_matrix.weight, std=0.01)
 
         # item feature vectors 需要对这个加一层mlp 和 relu函数，使输出后的结果尽可能靠近embedding
         # positive sample 是 item_matrix里面
         self.item_features = torch.from_numpy(self.data_list.item_set)
         self.item_features.requires_grad = False
-        self.item_features = self.item_features.cuda()
+        self.item_features = self.item_features.to(self.device)
         dim_mlp = self.item_features.shape[1]
         self.item_features = self.item_features.float()
         self.item_mlp = nn.Sequential(nn.Linear(dim_mlp, dim_mlp), nn.LeakyReLU())  #
-        self.item_mlp = self.item_mlp.cuda()
+        self.item_mlp = self.item_mlp.to(self.device)
+        self.projection = ProjectionCache(self.item_mlp, self.item_features)
 
     def predict(self, uid, iid):
         """
@@ -55,10 +69,13 @@ class CR(Model):
         :return:
         """
         p1 = self.user_matrix[uid]
-        item_fixed = self.item_mlp(self.item_features)
+        item_fixed = self.projection.full()
         p2 = item_fixed[iid]
         return torch.sum(p1 * p2, dim=1)
 
+    def item_table_cold(self):
+        return self.projection.full()
+
     def bpr_loss(self, uid, iid, jid):
         """
         bpr的算法是，对一个用户u求i和j两个item的分数，然后比较更喜欢哪个，
@@ -91,10 +108,9 @@ class CR(Model):
         neg_embedding = self.item_matrix[neg_ids]  # 得到 js * 64矩阵
         pos_pos_dif = pos_feature - pos_embedding
         pos_scores = torch.einsum('ni, ni -> n', [pos_pos_dif, pos_pos_dif])  # 得到1 * is 的矩阵
-        pos_feature_squeeze = pos_feature.unsqueeze(1)  # 将pos_feature升维成is * 1 * 64方便广播计算
-        pos_neg_dif = pos_feature_squeeze - neg_embedding  # 得到的差值是一个 is * js * 64的矩阵
-        neg_scores = torch.einsum('nij, nij -> ni', [pos_neg_dif, pos_neg_dif])  # 得到 is * js 的平方和矩阵 i 与 j个neg
-        neg_scores_sum = torch.sum(neg_scores, dim=1)  # 得到 1 * is的矩阵
+        # 每个 pos_feature 到所有 neg_embedding 的距离平方和, 不再构造 is * js * 64 的差值张量
+        neg_scores_sum = squared_distance_sums(pos_feature, neg_embedding,
+                                               getattr(self.args, 'dist_tile', 0))  # 得到 1 * is的矩阵
         """
           对于每一个item求 -log(pos / (pos + neg))， 然后所有item加和
         """
@@ -126,16 +142,13 @@ class CR(Model):
             while True:
 
                 optimizer.zero_grad()
-                item_fixed = self.item_mlp(self.item_features)
 
                 s = next(generator)
                 if s is None:
                     break
 
                 uid, iid, jid = s[:, 0], s[:, 1], s[:, 2]
-                uid = uid.cuda()
-                iid = iid.cuda()
-                jid = jid.cuda()
+                item_fixed = self.projection.batch(torch.cat([iid, jid]))
                 loss_bpr = self.bpr_loss(uid, iid, jid) + self.regs(uid, iid, jid)
                 loss_con = self.con_loss_matmul(item_fixed, iid, jid)
                 # loss_con = self.con_loss(item_fixed, iid, jid)
@@ -145,26 +158,17 @@ class CR(Model):
 
                 loss.backward()
                 optimizer.step()
+                self.projection.invalidate()
             if epoch % 10 == 0 and epoch > 1:
                 writer.add_embedding(self.item_matrix, global_step=epoch)
-                writer.add_embedding(self.item_mlp(self.item_features), global_step=epoch)
+                writer.add_embedding(self.projection.full(), global_step=epoch)
                 writer.flush()
 
             if epoch % 2 == 0:  # and epoch > 1
                 print(f'=={epoch}===>loss_bpr is {loss_bpr}===loss_con is {loss_con}')
+                self.epoch = epoch
                 self.val(), self.test(), self.test_warm(), self.test_cold()
+        self.close_metrics()
 
     def sample(self):
-        np.random.shuffle(self.data_list.train_list)
-        loop_size = self.sz // self.batch_size
-        for i in range(loop_size):
-            pairs = []
-            sub_train_list = self.data_list.train_list[i * self.batch_size:(i + 1) * self.batch_size, :]
-            for m, j in sub_train_list:
-                m_neg = j
-                while m_neg in self.data_list.train_pt[m]:
-                    m_neg = np.random.randint(self.item_size)
-                pairs.append((m, j, m_neg))
-
-            yield torch.LongTensor(pairs)
-        yield None
+        return epoch_batches(self.planner, self.sampler, self.backend, self.args)
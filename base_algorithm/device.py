@@ -0,0 +1,39 @@
+import torch
+
+
+class Backend:
+    """
+    模型跑在哪个设备上
+    gpu >= 0 且有cuda就用 cuda:gpu, 否则用cpu (--gpu -1 强制cpu)
+    cpu 下按 threads 设置 torch 的 intra-op 线程数, pinned memory 只在有加速卡时才用
+    """
+    def __init__(self, gpu=0, threads=None):
+        if gpu is not None and gpu >= 0 and torch.cuda.is_available():
+            self.device = torch.device('cuda', gpu)
+            torch.cuda.set_device(self.device)
+        else:
+            self.device = torch.device('cpu')
+            if threads:
+                torch.set_num_threads(threads)
+        self.accelerated = self.device.type != 'cpu'
+
+    @classmethod
+    def from_args(cls, args):
+        return cls(args.gpu, getattr(args, 'threads', None))
+
+    def pin(self, tensor):
+        """host 上的 buffer, 有加速卡时放到 pinned memory 里"""
+        if self.accelerated and not tensor.is_pinned():
+            return tensor.pin_memory()
+        return tensor
+
+    def to(self, tensor):
+        """host -> device, 有加速卡时是 pinned + non_blocking 的拷贝"""
+        if not self.accelerated:
+            return tensor
+        return self.pin(tensor).to(self.device, non_blocking=True)
+
+    def __repr__(self):
+        if self.accelerated:
+            return f'Backend({self.device})'
+        return f'Backend(cpu, threads={torch.get_num_threads()})'
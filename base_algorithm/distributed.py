@@ -0,0 +1,125 @@
+import numpy as np
+import torch
+import torch.distributed as dist
+from .batching import BatchPlanner
+
+
+def init_process(rank, world_size, dist_url='tcp://127.0.0.1:23456', threads=1):
+    """
+    gloo 后端, 本机多进程的 cpu 数据并行
+    每个 rank 默认只用 1 个 intra-op 线程, 几个 rank 同时跑时不会互相抢核
+    """
+    torch.set_num_threads(max(1, threads))
+    dist.init_process_group('gloo', init_method=dist_url, world_size=world_size, rank=rank)
+
+
+def shard_planner(rows, batch_size, rank, world_size, seed=None):
+    """
+    rank 只拿 rows[rank::world_size], 而且每个 rank 截成一样长,
+    保证每个 epoch 的 batch 数相同 (每个 batch 一次 all_reduce, 次数对不上就会卡住)
+    rows 不拷贝, memmap 的 train_list 各个进程还是共享同一份 page cache
+    """
+    per_rank = len(rows) // world_size
+    shard = rows[rank:per_rank * world_size:world_size]
+    return BatchPlanner(shard, batch_size, seed=None if seed is None else seed + rank)
+
+
+def broadcast_parameters(module, src=0):
+    """让所有 rank 从 src 的同一份初始参数开始"""
+    with torch.no_grad():
+        for tensor in list(module.parameters()) + list(module.buffers()):
+            dist.broadcast(tensor, src)
+
+
+def allreduce_gradients(parameters, world_size):
+    """
+    backward 之后所有 rank 的梯度取平均
+    dense 梯度拼成一个 flat buffer 只做一次 all_reduce;
+    稀疏梯度 (nn.Embedding(sparse=True) 的) gloo 可以直接 all_reduce, 只传这个batch碰到的行
+    """
+    dense, sparse = [], []
+    for p in parameters:
+        if p.grad is not None:
+            (sparse if p.grad.is_sparse else dense).append(p)
+    if dense:
+        flat = torch.cat([p.grad.reshape(-1) for p in dense])
+        dist.all_reduce(flat)
+        flat /= world_size
+        offset = 0
+        for p in dense:
+            n = p.grad.numel()
+            p.grad.copy_(flat[offset:offset + n].view_as(p.grad))
+            offset += n
+    for p in sparse:
+        grad = p.grad.coalesce()
+        dist.all_reduce(grad)
+        # 各个 rank 的行拼在一起, 同一行可能出现多次, 合并一下
+        p.grad = grad.coalesce() / world_size
+
+
+def _row_counts(rows):
+    """每个 rank 的行数, 各 rank 的 unique 集合大小不一样"""
+    counts = [torch.zeros(1, dtype=torch.long) for _ in range(dist.get_world_size())]
+    dist.all_gather(counts, torch.tensor([rows.shape[0]]))
+    return [int(c) for c in counts]
+
+
+def _gather_padded(rows, counts):
+    """all_gather 要求形状一致, 先补到最长的行数, 拼起来再去掉补的行"""
+    padded = rows.new_zeros((max(counts),) + tuple(rows.shape[1:]))
+    padded[:rows.shape[0]] = rows
+    parts = [torch.empty_like(padded) for _ in counts]
+    dist.all_gather(parts, padded)
+    return torch.cat([part[:n] for part, n in zip(parts, counts)])
+
+
+class _GatherRows(torch.autograd.Function):
+    """
+    前向把所有 rank 的行按 rank 顺序拼起来; 反向每个 rank 的 loss 都对别的 rank 的行有梯度,
+    把拼接结果的梯度 all_reduce 求和, 再切出自己那几行, 回传给本 rank 算出这些行的参数
+    """
+    @staticmethod
+    def forward(ctx, rows, counts):
+        ctx.counts = counts
+        return _gather_padded(rows, counts)
+
+    @staticmethod
+    def backward(ctx, grad):
+        grad = grad.contiguous()
+        dist.all_reduce(grad)
+        start = sum(ctx.counts[:dist.get_rank()])
+        return grad[start:start + ctx.counts[dist.get_rank()]], None
+
+
+def gather_unique(ids, rows):
+    """
+    各 rank 的 (ids, rows) 拼成全局的再按 id 去重, 等价于单进程在整个全局 batch 上取 unique;
+    同一个 id 在几个 rank 上的行是同一组参数算出来的, 取第一次出现的那行. rows 的梯度会传回各自的 rank
+    返回 (全局 ids, 对应的行)
+    """
+    counts = _row_counts(ids)
+    all_ids = _gather_padded(ids, counts)
+    all_rows = _GatherRows.apply(rows, counts)
+    unique_ids, inverse = torch.unique(all_ids, return_inverse=True)
+    first = torch.full((unique_ids.shape[0],), all_ids.shape[0], dtype=torch.long, device=all_ids.device)
+    first.scatter_reduce_(0, inverse, torch.arange(all_ids.shape[0], device=all_ids.device), 'amin')
+    return unique_ids, all_rows[first]
+
+
+def distribute(model, rank, world_size):
+    """
+    把单进程的模型 (CR 这类有 planner 的) 变成数据并行的一个 rank:
+    args.bsz 仍然是全局 batch, 每个 rank 在自己的分片上取 bsz // world_size 行, 参数从 rank 0 广播;
+    in-batch 负样本由模型用 gather_unique 拼回整个全局 batch 的
+    """
+    model.rank = rank
+    model.world_size = world_size
+    model.planner = shard_planner(model.data_list.train_list, max(1, model.batch_size // world_size),
+                                  rank, world_size, model.args.seed)
+    if getattr(model, 'sampler', None) is not None and model.args.seed is not None:
+        # 和 shard_planner 一样每个 rank 用 seed + rank, 各 rank 的负样本互不相关
+        model.sampler.rng = np.random.default_rng(model.args.seed + rank)
+    broadcast_parameters(model)
+    if getattr(model, 'projection', None) is not None:
+        model.projection.invalidate()
+    return model
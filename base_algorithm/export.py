@@ -0,0 +1,74 @@
+import numpy as np
+from .packed import write_packed, read_packed
+from .retrieval import as_vectors
+
+FORMAT = 'cr-embeddings'
+VERSION = 1
+DTYPES = ('float32', 'float16', 'int8')
+
+
+def quantize(matrix, dtype='float32'):
+    """
+    返回 {后缀: 数组}: float32 / float16 直接转, int8 是按行对称量化,
+    每行一个 float32 的 scale = max|row| / 127, 存在 '.scale' 里
+    """
+    if dtype not in DTYPES:
+        raise Exception(f'unsupported export dtype {dtype}')
+    if dtype != 'int8':
+        return {'': matrix.astype(dtype)}
+    scale = np.abs(matrix).max(axis=1) / 127
+    scale[scale == 0] = 1
+    q = np.clip(np.rint(matrix / scale[:, None]), -127, 127).astype(np.int8)
+    return {'': q, '.scale': scale.astype(np.float32)}
+
+
+def export_embeddings(path, user, item, item_cold=None, dtype='float32'):
+    """
+    把 user / item embedding 和冷启动的 item 投影 item_mlp(item_features) 写成一个 pack 文件 (见 packed.py),
+    每张表按 dtype 存, 文件头里记 format/version/dtype, 打开时校验
+    """
+    tables = {'user': user, 'item': item}
+    if item_cold is not None:
+        tables['item_cold'] = item_cold
+    arrays, shapes = {}, {}
+    for name, table in tables.items():
+        table = as_vectors(table)
+        shapes[name] = list(table.shape)
+        for suffix, a in quantize(table, dtype).items():
+            arrays[name + suffix] = a
+    write_packed(path, arrays, {'format': FORMAT, 'version': VERSION, 'dtype': dtype, 'tables': shapes})
+
+
+class Embeddings:
+    """
+    export_embeddings 导出的文件, 用只读的 np.memmap 打开, 不读也不拷贝数据,
+    多个打分进程打开同一个文件共享同一份物理页; 只有用到的行才会反量化成 float32
+    """
+    def __init__(self, path):
+        arrays, meta = read_packed(path, mode='r')
+        if meta.get('format') != FORMAT or meta.get('version') != VERSION:
+            raise Exception(f'{path} is not a version {VERSION} embedding export')
+        self.arrays = arrays
+        self.dtype = meta['dtype']
+        self.shapes = meta['tables']
+
+    def __contains__(self, name):
+        return name in self.shapes
+
+    def rows(self, name, ids):
+        """name 表里 ids 这些行, float32"""
+        values = np.asarray(self.arrays[name][ids], dtype=np.float32)
+        if self.dtype == 'int8':
+            values *= self.arrays[name + '.scale'][ids][..., None]
+        return values
+
+    def table(self, name):
+        """整张表, float32 的导出直接返回 memmap (零拷贝), 量化的导出要反量化一份"""
+        if self.dtype == 'float32':
+            return self.arrays[name]
+        return self.rows(name, slice(None))
+
+    def scores(self, user_ids, item_ids, cold=False):
+        """user_ids[k] 和 item_ids[k] 的内积"""
+        items = self.rows('item_cold' if cold else 'item', item_ids)
+        return np.sum(self.rows('user', user_ids) * items, axis=-1)
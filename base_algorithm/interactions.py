@@ -0,0 +1,140 @@
+import os
+import numpy as np
+import torch
+from .packed import read_packed, write_packed
+
+
+def build_csr(train_pt, user_size):
+    """
+    train_pt[u] 是用户u交互过的item集合, 转成按user排好序的CSR (indptr, indices)
+    每一行的indices是升序且去重的
+    """
+    if hasattr(train_pt, 'indptr'):
+        # 已经是 CSR 了 (pack 文件里读出来的 CSRRows), 末尾没有交互的用户补成空行
+        indptr = np.asarray(train_pt.indptr, dtype=np.int64)
+        indptr = np.concatenate([indptr, np.full(user_size + 1 - len(indptr), indptr[-1])])
+        return indptr, np.asarray(train_pt.indices, dtype=np.int64)
+    rows = train_pt.items() if isinstance(train_pt, dict) else enumerate(train_pt)
+    per_user = [np.empty(0, dtype=np.int64)] * user_size
+    for u, items in rows:
+        if isinstance(items, torch.Tensor):
+            items = items.numpy()
+        per_user[int(u)] = np.unique(np.asarray(list(items), dtype=np.int64))
+    indptr = np.zeros(user_size + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum([len(a) for a in per_user])
+    indices = np.concatenate(per_user) if user_size else np.empty(0, dtype=np.int64)
+    return indptr, indices
+
+
+class InteractionIndex:
+    """
+    训练集 user -> item 的 CSR 索引, indptr/indices 都是 int32 (交互数超过 int32 时 indptr 用 int64)
+    每行升序, 单次查询是行内二分 O(log d), contains 对整个batch同时二分
+    """
+    def __init__(self, indptr, indices, item_size):
+        self.indptr = indptr
+        self.indices = indices
+        self.user_size = len(indptr) - 1
+        self.item_size = item_size
+
+    @classmethod
+    def build(cls, train_pt, user_size, item_size):
+        indptr, indices = build_csr(train_pt, user_size)
+        ptr_dtype = np.int32 if indptr[-1] < 2 ** 31 else np.int64
+        return cls(indptr.astype(ptr_dtype), indices.astype(np.int32), item_size)
+
+    @classmethod
+    def load(cls, path):
+        arrays, meta = read_packed(path)
+        return cls(arrays['indptr'], arrays['indices'], meta['item_size'])
+
+    def save(self, path, meta=None):
+        write_packed(path, {'indptr': self.indptr, 'indices': self.indices},
+                     {'user_size': self.user_size, 'item_size': self.item_size, **(meta or {})})
+
+    @staticmethod
+    def fingerprint(train_pt, source=None):
+        """
+        判断磁盘上的缓存是不是这份 train_pt 建的: 交互数 (每个用户的 item 数加起来),
+        以及 train_pt 来源文件 (train.pt) 的大小和修改时间, 重新生成 train.pt 后缓存就会失效
+        """
+        if hasattr(train_pt, 'indptr'):
+            count = int(train_pt.indptr[-1])
+        else:
+            rows = train_pt.values() if isinstance(train_pt, dict) else train_pt
+            count = sum(len(items) for items in rows)
+        meta = {'interactions': count}
+        if source is not None and os.path.isfile(source):
+            stat = os.stat(source)
+            meta.update(source_size=stat.st_size, source_mtime=stat.st_mtime_ns)
+        return meta
+
+    @classmethod
+    def cached(cls, path, train_pt, user_size, item_size, source=None):
+        """
+        path 存在, 大小对得上且 fingerprint (交互数, source 文件的大小和修改时间) 一致就直接 mmap 读,
+        否则从 train_pt 建一次再写到 path
+        """
+        expected = {'user_size': user_size, 'item_size': item_size, **cls.fingerprint(train_pt, source)}
+        if os.path.isfile(path):
+            arrays, meta = read_packed(path)
+            if all(meta.get(k) == v for k, v in expected.items()):
+                return cls(arrays['indptr'], arrays['indices'], item_size)
+        index = cls.build(train_pt, user_size, item_size)
+        try:
+            index.save(path, expected)
+        except OSError:
+            # 数据目录只读时就不缓存了
+            pass
+        return index
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __contains__(self, pair):
+        u, i = pair
+        row = self.row(u)
+        pos = np.searchsorted(row, i)
+        return pos < len(row) and row[pos] == i
+
+    def row(self, u):
+        return self.indices[self.indptr[u]:self.indptr[u + 1]]
+
+    def degree(self, users):
+        users = np.asarray(users, dtype=np.int64)
+        return (self.indptr[users + 1] - self.indptr[users]).astype(np.int64)
+
+    def pairs(self, users):
+        """
+        users 这些行的全部交互, 返回 (rows, items): rows 是在 users 里的位置,
+        用来一次性 mask 一整块 (len(users), item_size) 的分数
+        """
+        users = np.asarray(users, dtype=np.int64)
+        starts = self.indptr[users].astype(np.int64)
+        lengths = self.indptr[users + 1].astype(np.int64) - starts
+        rows = np.repeat(np.arange(len(users)), lengths)
+        pos = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths) + np.repeat(starts, lengths)
+        return rows, self.indices[pos].astype(np.int64)
+
+    def contains(self, users, items):
+        """
+        users[k] 是否和 items[k] 交互过, 返回bool数组
+        每个查询在自己那一行 [indptr[u], indptr[u+1]) 里二分, 整个batch一起走, 循环 log2(最大度数) 次
+        """
+        users = np.asarray(users, dtype=np.int64)
+        items = np.asarray(items, dtype=np.int64)
+        lo = self.indptr[users].astype(np.int64)
+        hi = self.indptr[users + 1].astype(np.int64)
+        end = hi.copy()
+        while True:
+            active = lo < hi
+            if not active.any():
+                break
+            mid = (lo + hi) >> 1
+            # 不活跃的行 mid 可能等于 len(indices), 截断一下避免越界, 结果不会被用到
+            go_right = active & (self.indices[np.minimum(mid, len(self.indices) - 1)] < items)
+            lo = np.where(go_right, mid + 1, lo)
+            hi = np.where(active & ~go_right, mid, hi)
+        found = lo < end
+        found[found] = self.indices[lo[found]] == items[found]
+        return found
@@ -1,3 +1,6 @@
+from .interactions import InteractionIndex
+
+
 class LoadData:
     def __init__(self, user_set,
                  item_set,
@@ -41,3 +44,27 @@ class LoadData:
         self.val_samples = val_samples
         self.val_gt = val_gt
         self.test_gt = test_gt
+        self.hard_negatives = hard_negatives
+        # train_pt / hard_negatives 的 CSR 索引, 第一次用到时才建
+        self.index_cache = None
+        self.index_source = None
+        self.interaction_index = None
+        self.co_item_index = None
+
+    def interactions(self):
+        """train_pt 的 InteractionIndex, 只建一次; index_cache 是路径时缓存到磁盘, 下次直接 mmap"""
+        if self.interaction_index is None:
+            user_size, item_size = len(self.user_set), len(self.item_set)
+            if self.index_cache:
+                self.interaction_index = InteractionIndex.cached(self.index_cache, self.train_pt,
+                                                                 user_size, item_size, self.index_source)
+            else:
+                self.interaction_index = InteractionIndex.build(self.train_pt, user_size, item_size)
+        return self.interaction_index
+
+    def co_items(self):
+        """hard_negatives (co_items.pt) 的 item -> 共现item CSR 索引, 给 HardNegativeSampler 用"""
+        if self.co_item_index is None:
+            item_size = len(self.item_set)
+            self.co_item_index = InteractionIndex.build(self.hard_negatives, item_size, item_size)
+        return self.co_item_index
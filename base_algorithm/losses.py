@@ -0,0 +1,109 @@
+import torch
+
+
+class TiledLogSumExp(torch.autograd.Function):
+    """
+    lse_i = log sum_j exp(anchor_i · candidates_j / temp)
+    按 tile 个 candidate 一块做 online logsumexp (running max + 缩放后的和), 不会溢出,
+    backward 也按块重算 logits, 所以前向反向都只需要 B * tile 的显存, 而不是 B * U
+    """
+    @staticmethod
+    def forward(ctx, anchor, candidates, temp, tile):
+        running_max = anchor.new_full((anchor.shape[0],), float('-inf'))
+        running_sum = anchor.new_zeros(anchor.shape[0])
+        for start in range(0, candidates.shape[0], tile):
+            logits = torch.matmul(anchor, candidates[start:start + tile].t()) / temp
+            new_max = torch.maximum(running_max, logits.max(dim=1).values)
+            running_sum = running_sum * torch.exp(running_max - new_max) \
+                + torch.exp(logits - new_max.unsqueeze(1)).sum(dim=1)
+            running_max = new_max
+        lse = running_max + torch.log(running_sum)
+        ctx.save_for_backward(anchor, candidates, lse)
+        ctx.temp = temp
+        ctx.tile = tile
+        return lse
+
+    @staticmethod
+    def backward(ctx, grad_lse):
+        anchor, candidates, lse = ctx.saved_tensors
+        grad_anchor = torch.zeros_like(anchor) if ctx.needs_input_grad[0] else None
+        grad_candidates = torch.zeros_like(candidates) if ctx.needs_input_grad[1] else None
+        scale = (grad_lse / ctx.temp).unsqueeze(1)
+        for start in range(0, candidates.shape[0], ctx.tile):
+            tile = candidates[start:start + ctx.tile]
+            # d lse_i / d logits_ij = softmax_ij
+            weights = torch.exp(torch.matmul(anchor, tile.t()) / ctx.temp - lse.unsqueeze(1)) * scale
+            if grad_anchor is not None:
+                grad_anchor += torch.matmul(weights, tile)
+            if grad_candidates is not None:
+                grad_candidates[start:start + ctx.tile] = torch.matmul(weights.t(), anchor)
+        return grad_anchor, grad_candidates, None, None
+
+
+def logsumexp_scores(anchor, candidates, temp, tile=None):
+    """log sum_j exp(anchor · candidates_j / temp), candidates 比 tile 多时分块算"""
+    if tile and candidates.shape[0] > tile:
+        return TiledLogSumExp.apply(anchor, candidates, temp, tile)
+    return torch.logsumexp(torch.matmul(anchor, candidates.t()) / temp, dim=1)
+
+
+def info_nce(anchor, positive, candidates, temp, tile=None):
+    """
+    mean_i -log( exp(a_i·p_i / t) / sum_j exp(a_i·c_j / t) ), 在 log 空间算, 小温度也不会 inf/nan
+    tile: 每次参与 matmul 的 candidate 数, None/0 表示一次算完
+    """
+    pos_logits = torch.sum(anchor * positive, dim=1) / temp
+    return (logsumexp_scores(anchor, candidates, temp, tile) - pos_logits).mean()
+
+
+def squared_distances(a, b):
+    """(n, m) 的 ||a_i - b_j||^2, 展开成 ||a_i||^2 + ||b_j||^2 - 2 a_i·b_j, 只要一次 matmul, 不用 n * m * dim 的差值张量"""
+    a_sq = torch.sum(a * a, dim=1, keepdim=True)
+    b_sq = torch.sum(b * b, dim=1)
+    return torch.clamp(a_sq + b_sq - 2 * torch.matmul(a, b.t()), min=0)
+
+
+class TiledDistanceSums(torch.autograd.Function):
+    """
+    sums_i = sum_j max(||a_i - b_j||^2, 0), 按 tile 个 b 一块累加
+    直接对 squared_distances 的循环求导的话, autograd 会把每一块的 n * tile 中间结果都留到 backward, 合起来还是 n * m;
+    这里 backward 也按块重算距离 (只为了截断的 mask), 前向反向的峰值都是 n * tile
+    """
+    @staticmethod
+    def forward(ctx, a, b, tile):
+        sums = a.new_zeros(a.shape[0])
+        for start in range(0, b.shape[0], tile):
+            sums += squared_distances(a, b[start:start + tile]).sum(dim=1)
+        ctx.save_for_backward(a, b)
+        ctx.tile = tile
+        return sums
+
+    @staticmethod
+    def backward(ctx, grad_sums):
+        a, b = ctx.saved_tensors
+        grad_a = torch.zeros_like(a) if ctx.needs_input_grad[0] else None
+        grad_b = torch.zeros_like(b) if ctx.needs_input_grad[1] else None
+        a_sq = torch.sum(a * a, dim=1, keepdim=True)
+        for start in range(0, b.shape[0], ctx.tile):
+            tile = b[start:start + ctx.tile]
+            # d ||a_i - b_j||^2 / d a_i = 2 (a_i - b_j), 被截断到 0 的对没有梯度
+            raw = a_sq + torch.sum(tile * tile, dim=1) - 2 * torch.matmul(a, tile.t())
+            weights = (raw >= 0).to(a.dtype) * grad_sums.unsqueeze(1)
+            if grad_a is not None:
+                grad_a += 2 * (weights.sum(dim=1, keepdim=True) * a - torch.matmul(weights, tile))
+            if grad_b is not None:
+                grad_b[start:start + ctx.tile] = 2 * (weights.sum(dim=0).unsqueeze(1) * tile
+                                                      - torch.matmul(weights.t(), a))
+        return grad_a, grad_b, None
+
+
+def squared_distance_sums(a, b, tile=None):
+    """
+    sum_j ||a_i - b_j||^2, 返回 (n,)
+    默认直接用 m ||a_i||^2 + sum_j ||b_j||^2 - 2 a_i·sum_j b_j, 只要 O((n + m) dim)
+    给了 tile 就按块算 squared_distances 再累加 (TiledDistanceSums), 每一对都截断到 >= 0, 峰值是 n * tile
+    """
+    if not tile:
+        a_sq = torch.sum(a * a, dim=1)
+        return b.shape[0] * a_sq + torch.sum(b * b) - 2 * torch.matmul(a, b.sum(dim=0))
+    return TiledDistanceSums.apply(a, b, tile)
@@ -0,0 +1,138 @@
+import numpy as np
+import torch
+
+
+def _numpy(x):
+    if isinstance(x, torch.Tensor):
+        return x.detach().cpu().numpy()
+    return np.asarray(x)
+
+
+def rank_auc(gt, scores):
+    """
+    每个user精确的 AUC, 用 Mann-Whitney 秩和: (R_pos - P(P+1)/2) / (P * N)
+    沿候选维做一次 argsort, 分数相同的取平均秩, 在 scores 所在的设备上算 (cpu/cuda 都可以)
+    返回 (n,) 的 float64, 没有正样本或没有负样本的行是 nan
+    """
+    scores = torch.as_tensor(scores)
+    labels = (torch.as_tensor(gt, device=scores.device) > 0).to(torch.float64)
+    values, order = torch.sort(scores, dim=1)
+    labels = labels.gather(1, order)
+    n, c = values.shape
+    pos = torch.arange(c, device=values.device).expand(n, c)
+    # 每个位置所在的并列组的第一个和最后一个位置
+    first_of_group = torch.ones_like(values, dtype=torch.bool)
+    first_of_group[:, 1:] = values[:, 1:] != values[:, :-1]
+    last_of_group = torch.ones_like(first_of_group)
+    last_of_group[:, :-1] = first_of_group[:, 1:]
+    first = torch.cummax(torch.where(first_of_group, pos, 0), dim=1).values
+    last = c - 1 - torch.cummax(torch.where(last_of_group, c - 1 - pos, 0).flip(1), dim=1).values.flip(1)
+    rank = (first + last).to(torch.float64) / 2 + 1
+    n_pos = labels.sum(dim=1)
+    n_neg = c - n_pos
+    auc = (torch.sum(rank * labels, dim=1) - n_pos * (n_pos + 1) / 2) / (n_pos * n_neg)
+    return torch.where((n_pos > 0) & (n_neg > 0), auc, torch.full_like(auc, float('nan')))
+
+
+def auc_score(gt, preds, device='cpu'):
+    """所有有正负样本的user的平均 AUC"""
+    auc = rank_auc(gt, torch.as_tensor(preds).to(device))
+    return float(torch.nanmean(auc))
+
+
+class RankingMetrics:
+    """
+    流式的 top-K 指标: 每来一块 (chunk, c) 的 gt/分数就更新一次, 不需要整个 results 矩阵
+    每行只做一次 argpartition 取出前 max(ks) 个, 再只对这 max(ks) 个排序,
+    一遍算出 NDCG@K, Recall@K, HitRate@K 和 MRR, 同时用 rank_auc 在分数所在的设备上算 AUC
+    ndcg 和 sklearn.metrics.ndcg_score 一致 (gain 就是 gt 的值, 没有正样本的行记 0 并参与平均;
+    分数并列时和 sklearn 一样, 并列组里每个位置的 gain 取整组的平均, 不按下标先后),
+    recall / hit 的并列按下标先后,
+    recall / hit / mrr 只在有正样本的行上平均, auc 只在同时有正负样本的行上平均
+    """
+    def __init__(self, ks=(5, 10, 20)):
+        self.ks = list(ks)
+        self.rows = 0
+        self.pos_rows = 0
+        self.ndcg_sum = np.zeros(len(self.ks))
+        self.recall_sum = np.zeros(len(self.ks))
+        self.hit_sum = np.zeros(len(self.ks))
+        self.mrr_sum = 0.0
+        self.auc_sum = 0.0
+        self.auc_rows = 0
+
+    def update(self, gt, scores):
+        auc = rank_auc(gt, scores)
+        valid = ~torch.isnan(auc)
+        self.auc_sum += float(auc[valid].sum())
+        self.auc_rows += int(valid.sum())
+        gt = _numpy(gt).astype(np.float64)
+        scores = _numpy(scores)
+        n, c = scores.shape
+        if n == 0:
+            return
+        k_max = min(max(self.ks), c)
+        if k_max < c:
+            top = np.argpartition(-scores, k_max - 1, axis=1)[:, :k_max]
+        else:
+            top = np.broadcast_to(np.arange(c), (n, c))
+        order = np.argsort(-np.take_along_axis(scores, top, axis=1), axis=1, kind='stable')
+        top = np.take_along_axis(top, order, axis=1)
+        rel = np.take_along_axis(gt, top, axis=1)  # n * k_max, 按预测分数降序的 gain
+        rel_dcg = self._tie_averaged(gt, scores, np.take_along_axis(scores, top, axis=1), rel)
+        if k_max < c:
+            ideal = -np.sort(np.partition(-gt, k_max - 1, axis=1)[:, :k_max], axis=1)
+        else:
+            ideal = -np.sort(-gt, axis=1)
+        discount = 1.0 / np.log2(np.arange(2, k_max + 2))
+        dcg = np.cumsum(rel_dcg * discount, axis=1)
+        idcg = np.cumsum(ideal * discount, axis=1)
+        hits = np.cumsum(rel > 0, axis=1)
+        n_pos = np.sum(gt > 0, axis=1)
+        has_pos = n_pos > 0
+        for i, k in enumerate(self.ks):
+            col = min(k, k_max) - 1
+            with np.errstate(divide='ignore', invalid='ignore'):
+                self.ndcg_sum[i] += np.where(idcg[:, col] > 0, dcg[:, col] / idcg[:, col], 0).sum()
+            self.recall_sum[i] += (hits[has_pos, col] / n_pos[has_pos]).sum()
+            self.hit_sum[i] += (hits[has_pos, col] > 0).sum()
+        # 第一个正样本的排名 = 1 + 分数比最好的正样本还高的候选数
+        best_pos = np.where(gt > 0, scores, -np.inf).max(axis=1)
+        rank = 1 + np.sum(scores > best_pos[:, None], axis=1)
+        self.mrr_sum += (1.0 / rank[has_pos]).sum()
+        self.rows += n
+        self.pos_rows += int(has_pos.sum())
+
+    @staticmethod
+    def _tie_averaged(gt, scores, top_scores, rel):
+        """
+        dcg 用的 gain: 和别的候选分数并列的位置换成整行里同分数的候选 gain 的平均 (sklearn 的 _tie_averaged_dcg)
+        只有前 k_max 里有并列, 或者第 k_max 个和后面的候选并列的行才需要比较整行
+        """
+        tied = np.any(top_scores[:, 1:] == top_scores[:, :-1], axis=1) \
+            | (np.sum(scores == top_scores[:, -1:], axis=1) > 1)
+        if not tied.any():
+            return rel
+        equal = scores[tied][:, None, :] == top_scores[tied][:, :, None]  # tied * k_max * c
+        rel = rel.copy()
+        rel[tied] = np.sum(equal * gt[tied][:, None, :], axis=2) / np.sum(equal, axis=2)
+        return rel
+
+    def result(self):
+        rows = max(self.rows, 1)
+        pos_rows = max(self.pos_rows, 1)
+        return {
+            'auc': self.auc_sum / self.auc_rows if self.auc_rows else float('nan'),
+            'ndcg': (self.ndcg_sum / rows).tolist(),
+            'recall': (self.recall_sum / pos_rows).tolist(),
+            'hit': (self.hit_sum / pos_rows).tolist(),
+            'mrr': float(self.mrr_sum / pos_rows),
+        }
+
+
+def ranking_metrics(gt, preds, ks=(5, 10, 20), chunk_size=4096):
+    """整个 (n, c) 的 gt/预测矩阵一次算完, 内部仍然按 chunk_size 行分块"""
+    metrics = RankingMetrics(ks)
+    for start in range(0, len(preds), chunk_size):
+        metrics.update(gt[start:start + chunk_size], preds[start:start + chunk_size])
+    return metrics.result()
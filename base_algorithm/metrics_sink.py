@@ -0,0 +1,94 @@
+import atexit
+import json
+import os
+import queue
+import threading
+import time
+
+
+class MetricsSink:
+    """
+    JSON-lines 的指标日志, 一行一条 {"run", "epoch", "split", "metric", "value", "time"}
+    文件只打开一次 (带缓冲); write 只把记录放进队列, 后台线程每 flush_interval 秒批量写一次并 flush,
+    训练线程和 AsyncEvaluator 的线程都可以直接写; close (或者进程退出时) 把剩下的写完
+    run 默认是文件名去掉扩展名, compare_runs 用它区分一次超参数扫描里的各个 run
+    """
+    def __init__(self, path, run=None, flush_interval=1.0, ks=(5, 10, 20)):
+        self.path = path
+        self.run = run or os.path.splitext(os.path.basename(path))[0]
+        self.ks = list(ks)
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.file = open(path, 'a', buffering=1 << 16)
+        self.closed = threading.Event()
+        self.thread = threading.Thread(target=self._flush_loop, args=(flush_interval,), daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def write(self, epoch, split, metric, value):
+        self.queue.put({'run': self.run, 'epoch': epoch, 'split': split, 'metric': metric,
+                        'value': value, 'time': time.time()})
+
+    def log_scores(self, epoch, split, scores):
+        """一个评估集的 RankingMetrics.result(), 列表按 ks 展开成 ndcg@5, recall@10 这样的名字"""
+        for metric in sorted(scores):
+            value = scores[metric]
+            if isinstance(value, (list, tuple)):
+                for k, v in zip(self.ks, value):
+                    self.write(epoch, split, f'{metric}@{k}', float(v))
+            else:
+                self.write(epoch, split, metric, float(value))
+
+    def log_report(self, epoch, report):
+        """{评估集: 指标}, 即 Model.evaluate 的返回值"""
+        for split, scores in report.items():
+            self.log_scores(epoch, split, scores)
+
+    def log_timings(self, epoch, timings):
+        """{阶段: 秒数}, split 记为 'timing'"""
+        for stage, seconds in timings.items():
+            self.write(epoch, 'timing', stage, float(seconds))
+
+    def flush(self):
+        records = []
+        while True:
+            try:
+                records.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        with self.lock:
+            if records and not self.file.closed:
+                self.file.write(''.join(json.dumps(r) + '\n' for r in records))
+                self.file.flush()
+
+    def _flush_loop(self, interval):
+        while not self.closed.wait(interval):
+            self.flush()
+
+    def close(self):
+        if self.closed.is_set():
+            return
+        self.closed.set()
+        self.thread.join()
+        self.flush()
+        with self.lock:
+            self.file.close()
+        atexit.unregister(self.close)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def read_records(path):
+    """读回 MetricsSink 写的文件, 返回 dict 的列表; 写到一半的最后一行跳过"""
+    records = []
+    with open(path) as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                continue
+    return records
@@ -0,0 +1,44 @@
+import torch
+import torch.nn.functional as fun
+
+
+def lookup(table, ids, sparse=False):
+    """
+    table[ids], sparse=True 时反向传回 table 的是只含这些行的稀疏梯度,
+    optimizer 的代价就和 batch 大小成正比, 而不是和 user/item 总数成正比
+    """
+    return fun.embedding(ids, table, sparse=sparse)
+
+
+class SplitOptimizer:
+    """
+    embedding 表 (稀疏梯度) 用行级 lazy 的 SparseAdam, 只更新这个batch碰到的行的参数和一二阶矩;
+    其余 dense 参数 (item_mlp) 还是 Adam, 两个 optimizer 当一个用
+    注意 SparseAdam 不衰减没出现的行的动量, 和 dense Adam 不完全等价
+    """
+    def __init__(self, tables, params, lr):
+        table_ids = {id(t) for t in tables}
+        dense = [p for p in params if id(p) not in table_ids]
+        self.optimizers = [torch.optim.SparseAdam(list(tables), lr=lr)]
+        if dense:
+            self.optimizers.append(torch.optim.Adam(dense, lr=lr, weight_decay=0))
+
+    def zero_grad(self):
+        for optimizer in self.optimizers:
+            optimizer.zero_grad()
+
+    def step(self):
+        for optimizer in self.optimizers:
+            optimizer.step()
+
+
+def lazy_adagrad_(weight, accumulator, grad, lr, eps=1e-10):
+    """
+    和 torch.optim.Adagrad (weight_decay=0) 一样的更新, 但只碰稀疏梯度 grad 里出现的行
+    weight / accumulator 可以放在多个进程共享的内存里, 更新不加锁 (hogwild)
+    """
+    grad = grad.coalesce()
+    rows, values = grad.indices()[0], grad.values()
+    with torch.no_grad():
+        accumulator.index_add_(0, rows, values * values)
+        weight.index_add_(0, rows, values / (accumulator[rows].sqrt() + eps), alpha=-lr)
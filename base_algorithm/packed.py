@@ -0,0 +1,195 @@
+import argparse
+import inspect
+import json
+import os
+import numpy as np
+import torch
+
+parser = argparse.ArgumentParser(description='pack the *.pt dataset files into one memory-mapped file')
+parser.add_argument('src', metavar='SRC', help='directory with user_set.pt, train.pt, ...')
+parser.add_argument('dst', metavar='DST', help='output file, e.g. amazon.pack')
+
+MAGIC = b'CRPACK01'
+ALIGN = 64
+
+# LoadData 的参数名 -> 预处理生成的文件名
+PT_FILES = {
+    'train_pt': 'train.pt',
+    'train_list': 'train_list_as_array.pt',
+    'hard_negatives': 'co_items.pt',
+}
+# *.pt 目录下 train_pt 的 CSR 索引缓存 (见 LoadData.interactions)
+INDEX_CACHE = 'train_csr.pack'
+
+
+class CSRRows:
+    """
+    按行存的变长列表 (train_pt, co_items 这类 user/item -> 集合), rows[u] 返回一个升序的 numpy 切片,
+    原来的 `x in train_pt[u]` 写法不用改
+    """
+    def __init__(self, indptr, indices):
+        self.indptr = indptr
+        self.indices = indices
+
+    def __len__(self):
+        return len(self.indptr) - 1
+
+    def __getitem__(self, u):
+        return self.indices[self.indptr[u]:self.indptr[u + 1]]
+
+    def __iter__(self):
+        for u in range(len(self)):
+            yield self[u]
+
+
+def _align(n):
+    return (n + ALIGN - 1) // ALIGN * ALIGN
+
+
+def write_packed(path, arrays, meta=None):
+    """
+    arrays: name -> ndarray, 依次写成对齐到64字节的原始块
+    文件头: MAGIC, 8字节的 header 长度, json header (每个数组的 dtype/shape/offset, 以及 meta)
+    """
+    arrays = {name: np.ascontiguousarray(a) for name, a in arrays.items()}
+    index = {}
+    header = b''
+    # header 的长度会影响 offset, offset 又写在 header 里, 迭代到长度不变为止
+    while True:
+        offset = _align(len(MAGIC) + 8 + len(header))
+        for name, a in arrays.items():
+            index[name] = {'dtype': a.dtype.str, 'shape': list(a.shape), 'offset': offset}
+            offset = _align(offset + a.nbytes)
+        new_header = json.dumps({'arrays': index, 'meta': meta or {}}).encode('utf-8')
+        # 长度不变时 new_header 里的 offset 就是按它自己的长度算的, 写它而不是上一轮的
+        converged = len(new_header) == len(header)
+        header = new_header
+        if converged:
+            break
+    with open(path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(np.uint64(len(header)).tobytes())
+        f.write(header)
+        for name, a in arrays.items():
+            f.seek(index[name]['offset'])
+            f.write(a.tobytes())
+        f.truncate(_align(f.tell()))
+
+
+def read_packed(path, mode='c'):
+    """
+    返回 (name -> np.memmap, meta), 不读数据, 多个进程打开同一个文件共享 page cache
+    mode='c' 是 copy-on-write: 可以原地改 (比如 shuffle), 改动只在本进程可见
+    """
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise Exception(f'{path} is not a packed file')
+        size = int(np.frombuffer(f.read(8), dtype=np.uint64)[0])
+        header = json.loads(f.read(size).decode('utf-8'))
+    arrays = {}
+    for name, info in header['arrays'].items():
+        shape = tuple(info['shape'])
+        if int(np.prod(shape)) == 0:
+            arrays[name] = np.empty(shape, dtype=info['dtype'])
+        else:
+            arrays[name] = np.memmap(path, dtype=info['dtype'], mode=mode, offset=info['offset'], shape=shape)
+    return arrays, header['meta']
+
+
+def _to_rows(obj):
+    """dict / list 形式的 user -> 集合 转成 CSR"""
+    if isinstance(obj, dict):
+        n_rows = max((int(k) for k in obj.keys()), default=-1) + 1
+        rows = [()] * n_rows
+        for k, v in obj.items():
+            rows[int(k)] = v
+    else:
+        rows = list(obj)
+    rows = [np.asarray(r.numpy() if isinstance(r, torch.Tensor) else list(r), dtype=np.int64) for r in rows]
+    indptr = np.zeros(len(rows) + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum([len(r) for r in rows])
+    indices = np.concatenate([np.sort(r) for r in rows]) if rows else np.empty(0, dtype=np.int64)
+    return indptr, indices
+
+
+def _is_rows(obj):
+    if isinstance(obj, dict):
+        return True
+    if isinstance(obj, (list, tuple)) and len(obj) and not np.isscalar(obj[0]):
+        return True
+    return False
+
+
+def pack_fields(fields):
+    """LoadData 的各个字段 -> (arrays, meta), meta 里记录每个字段要怎么还原"""
+    arrays, kinds = {}, {}
+    for name, obj in fields.items():
+        if isinstance(obj, torch.Tensor):
+            arrays[name] = obj.numpy()
+            kinds[name] = 'tensor'
+        elif isinstance(obj, np.ndarray):
+            arrays[name] = obj
+            kinds[name] = 'array'
+        elif _is_rows(obj):
+            arrays[name + '.indptr'], arrays[name + '.indices'] = _to_rows(obj)
+            kinds[name] = 'csr'
+        else:
+            arrays[name] = np.asarray(sorted(obj) if isinstance(obj, set) else list(obj))
+            kinds[name] = 'array'
+    return arrays, {'fields': kinds}
+
+
+def unpack_fields(arrays, meta):
+    fields = {}
+    for name, kind in meta['fields'].items():
+        if kind == 'csr':
+            fields[name] = CSRRows(arrays[name + '.indptr'], arrays[name + '.indices'])
+        elif kind == 'tensor':
+            fields[name] = torch.from_numpy(arrays[name])
+        else:
+            fields[name] = arrays[name]
+    return fields
+
+
+def _field_names(cls):
+    return [p for p in inspect.signature(cls.__init__).parameters if p != 'self']
+
+
+def load_pt_fields(base_path, names):
+    """原来的读法: 每个字段一个 torch.load"""
+    return {name: torch.load(os.path.join(base_path, PT_FILES.get(name, name + '.pt'))) for name in names}
+
+
+def load_pt_dataset(base_path, cls):
+    return cls(**load_pt_fields(base_path, _field_names(cls)))
+
+
+def load_packed_dataset(path, cls):
+    """从 pack 文件构造 cls (LoadData 或者它的各个拷贝), 只 mmap 不拷贝数据"""
+    fields = unpack_fields(*read_packed(path))
+    return cls(**{name: fields[name] for name in _field_names(cls)})
+
+
+def load_dataset(path, cls):
+    """path 是文件就当 pack 文件读, 是目录就逐个 torch.load, 并把 train_pt 的 CSR 索引缓存在同一个目录"""
+    if os.path.isfile(path):
+        return load_packed_dataset(path, cls)
+    data = load_pt_dataset(path, cls)
+    if hasattr(data, 'index_cache'):
+        data.index_cache = os.path.join(path, INDEX_CACHE)
+        # 缓存记下 train.pt 的大小和修改时间, 重新生成 train.pt 后会重建
+        data.index_source = os.path.join(path, PT_FILES['train_pt'])
+    return data
+
+
+def main():
+    from base_algorithm.load import LoadData
+    args = parser.parse_args()
+    fields = load_pt_fields(args.src, _field_names(LoadData))
+    arrays, meta = pack_fields(fields)
+    write_packed(args.dst, arrays, meta)
+    print(f'packed {len(fields)} fields into {args.dst} ({os.path.getsize(args.dst) / 2 ** 20:.1f} MB)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+import queue
+import threading
+import torch
+
+
+class BatchPrefetcher:
+    """
+    后台线程准备训练batch: make_batch(i) 返回第 i 个batch的 (B, k) int64 numpy 数组,
+    workers 个线程轮流认领下标, 做好的 tensor (有加速卡时在 pinned memory 里) 放进长度为 depth 的有界队列
+    迭代时按顺序取出, 整个batch一次 non_blocking 拷到设备上, 并且先把下一个batch的拷贝发出去再交出当前这个,
+    所以采样, host -> device 拷贝和 loss 计算是重叠的
+    同时活着的 batch (已经认领但调用方还没用完的) 最多 capacity 个: 线程认领下标前先拿一个名额,
+    调用方来取下一个 batch 时才归还上一个的名额, 所以 make_batch 可以轮流复用 capacity 个 buffer
+    (BatchPlanner.reuse); cpu 上交出去的 tensor 和 buffer 共享内存, 只在调用方拿着它的时候有效
+    """
+    def __init__(self, make_batch, n_batches, backend, workers=2, depth=8):
+        self.make_batch = make_batch
+        self.n_batches = n_batches
+        self.backend = backend
+        self.workers = max(1, workers)
+        self.depth = max(1, depth)
+        # 队列 + 每个线程手上一个 + __iter__ 里的当前和下一个
+        self.capacity = self.depth + self.workers + 2
+
+    @classmethod
+    def from_args(cls, args, make_batch, n_batches, backend):
+        return cls(make_batch, n_batches, backend,
+                   getattr(args, 'workers', 2), getattr(args, 'prefetch', 8))
+
+    def _produce(self, next_index, lock, ready, stop, slots):
+        while not stop.is_set():
+            if not slots.acquire(timeout=0.1):
+                continue
+            with lock:
+                i = next_index[0]
+                next_index[0] += 1
+            if i >= self.n_batches:
+                return
+            try:
+                item = self.backend.pin(torch.from_numpy(self.make_batch(i)))
+            except Exception as e:
+                item = e
+            # 队列满了就等, 训练提前结束 (stop) 时退出
+            while not stop.is_set():
+                try:
+                    ready.put((i, item), timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+
+    def _ordered(self, slots):
+        next_index, lock = [0], threading.Lock()
+        ready, stop = queue.Queue(self.depth), threading.Event()
+        threads = [threading.Thread(target=self._produce, args=(next_index, lock, ready, stop, slots), daemon=True)
+                   for _ in range(self.workers)]
+        for t in threads:
+            t.start()
+        try:
+            pending = {}
+            for i in range(self.n_batches):
+                # 多个线程做完的顺序不定, 按下标重新排好, 这样每个epoch的batch顺序和 train_list 一致
+                while i not in pending:
+                    j, item = ready.get()
+                    pending[j] = item
+                item = pending.pop(i)
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+            for t in threads:
+                t.join()
+
+    def __iter__(self):
+        slots = threading.Semaphore(self.capacity)
+        batches = self._ordered(slots)
+        current = next(batches, None)
+        if current is not None:
+            current = self.backend.to(current)
+        while current is not None:
+            following = next(batches, None)
+            if following is not None:
+                following = self.backend.to(following)
+            yield current
+            # 调用方来取下一个了, current 用完, 它的 buffer 可以复用
+            slots.release()
+            current = following
+
+    def __len__(self):
+        return self.n_batches
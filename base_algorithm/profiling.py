@@ -0,0 +1,99 @@
+import contextlib
+import time
+from collections import defaultdict
+import torch
+
+_NULL = contextlib.nullcontext()
+
+
+class _Stage:
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.range = torch.profiler.record_function(name) if profiler.trace is not None else None
+
+    def __enter__(self):
+        if self.range is not None:
+            self.range.__enter__()
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        if self.profiler.sync is not None:
+            self.profiler.sync()  # cuda 是异步的, 不同步的话时间都记到下一个要等结果的阶段上
+        self.profiler.seconds[self.name] += time.perf_counter() - self.start
+        if self.range is not None:
+            self.range.__exit__(*exc)
+
+
+class Profiler:
+    """
+    训练循环里的分阶段计时: with profiler.stage('loss'): ... 累计每个阶段的秒数,
+    count 记计数器 (batch 数, 样本数), epoch_timings 取出这一个 epoch 的 {阶段: 秒数} 并清零
+    没开 (enabled=False) 时 stage 直接返回同一个空的 context manager, count/step 第一行就返回
+    trace_dir 不为空时另外用 torch.profiler 跟踪 trace_steps 个 batch (跳过前两个热身),
+    每个阶段同时是 trace 里的一段 record_function, 结果用 tensorboard 或 chrome://tracing 看
+    """
+    def __init__(self, enabled=False, device=None, trace_dir=None, trace_steps=20):
+        self.enabled = enabled or trace_dir is not None
+        cuda = device is not None and torch.device(device).type == 'cuda'
+        self.sync = torch.cuda.synchronize if self.enabled and cuda else None
+        self.trace = None
+        if trace_dir is not None:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if cuda:
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.trace = torch.profiler.profile(
+                activities=activities,
+                schedule=torch.profiler.schedule(wait=1, warmup=1, active=trace_steps, repeat=1),
+                on_trace_ready=torch.profiler.tensorboard_trace_handler(trace_dir))
+        self.seconds = defaultdict(float)
+        self.counters = defaultdict(int)
+
+    @classmethod
+    def from_args(cls, args, device=None):
+        return cls(getattr(args, 'timing', False), device,
+                   getattr(args, 'profile', None), getattr(args, 'profile_steps', 20))
+
+    def stage(self, name):
+        if not self.enabled:
+            return _NULL
+        return _Stage(self, name)
+
+    def count(self, name, n=1):
+        if not self.enabled:
+            return
+        self.counters[name] += n
+
+    def step(self, samples=0):
+        """每个 batch 结束时调用一次: 记 batch 数和样本数, torch.profiler 往前走一步"""
+        if not self.enabled:
+            return
+        self.counters['batches'] += 1
+        self.counters['samples'] += samples
+        if self.trace is not None:
+            self.trace.step()
+
+    def start(self):
+        if self.trace is not None:
+            self.trace.start()
+
+    def stop(self):
+        if self.trace is not None:
+            self.trace.stop()
+            self.trace = None
+
+    def epoch_timings(self):
+        """这一个 epoch 的 {阶段: 秒数, 计数器: 次数}, 取完清零"""
+        timings = dict(self.seconds)
+        timings.update(self.counters)
+        self.seconds.clear()
+        self.counters.clear()
+        return timings
+
+    def __str__(self):
+        total = sum(self.seconds.values()) or 1.0
+        return '  '.join(f'{name} {seconds:.3f}s ({seconds / total:.0%})' for name, seconds in self.seconds.items())
+
+
+# 不计时的地方 (没有传 profiler) 用它, 省得到处判断 None
+DISABLED = Profiler()
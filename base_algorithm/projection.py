@@ -0,0 +1,42 @@
+import torch
+
+
+class ProjectionCache:
+    """
+    item_mlp(item_features) 的缓存
+    key 是显式的版本号, 训练循环每次 optimizer.step() 之后调用 invalidate();
+    不用参数的 _version: 通过 .data 写或者 fused/foreach 的 optimizer 不一定会增加它, 缓存会悄悄过期
+    同一次评估里多次调用 full() 只会跑一次 mlp
+    """
+    def __init__(self, mlp, features):
+        self.mlp = mlp
+        self.features = features
+        self.version = 0
+        self._key = None
+        self._table = None
+
+    def invalidate(self):
+        """mlp 的参数被改过 (optimizer.step, 广播, 加载), 下次 full() 重新算"""
+        self.version += 1
+
+    def full(self):
+        """整个 item 表的 projection, 不带梯度, 评估用"""
+        if self._key != self.version:
+            with torch.no_grad():
+                self._table = self.mlp(self.features)
+            self._key = self.version
+        return self._table
+
+    def batch(self, ids):
+        """训练用, 只对 ids 里出现过的 item 做 projection"""
+        return BatchProjection(self.mlp, self.features, ids)
+
+
+class BatchProjection:
+    """只保存 unique(ids) 的 projection, 可以像完整的 item_fixed 一样用全局 item id 索引"""
+    def __init__(self, mlp, features, ids):
+        self.ids = torch.unique(ids)
+        self.table = mlp(features[self.ids])
+
+    def __getitem__(self, iid):
+        return self.table[torch.searchsorted(self.ids, iid.contiguous())]
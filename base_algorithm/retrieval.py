@@ -0,0 +1,150 @@
+import numpy as np
+import torch
+
+
+def as_vectors(table):
+    """embedding 表 (tensor 或 numpy) -> 连续的 float32 numpy 矩阵"""
+    if isinstance(table, torch.Tensor):
+        table = table.detach().cpu().numpy()
+    return np.ascontiguousarray(table, dtype=np.float32)
+
+
+def item_vectors(model, cold=False):
+    """训练好的 item_matrix, cold=True 时是冷启动用的 item_mlp(item_features)"""
+    with torch.no_grad():
+        return as_vectors(model.item_table_cold() if cold else model.item_table())
+
+
+def _block_topk(scores, ids, n):
+    """每行分数最大的 n 个 (不排序), ids 是每列对应的 item id"""
+    if scores.shape[1] <= n:
+        return scores, np.broadcast_to(ids, scores.shape)
+    top = np.argpartition(-scores, n - 1, axis=1)[:, :n]
+    return np.take_along_axis(scores, top, axis=1), ids[top]
+
+
+def _merge(best_scores, best_ids, scores, ids, n):
+    scores = np.concatenate([best_scores, scores], axis=1)
+    ids = np.concatenate([best_ids, ids], axis=1)
+    top = np.argpartition(-scores, n - 1, axis=1)[:, :n]
+    return np.take_along_axis(scores, top, axis=1), np.take_along_axis(ids, top, axis=1)
+
+
+def _sorted(best_scores, best_ids):
+    order = np.argsort(-best_scores, axis=1, kind='stable')
+    return np.take_along_axis(best_ids, order, axis=1), np.take_along_axis(best_scores, order, axis=1)
+
+
+def _empty(n_queries, n):
+    return np.full((n_queries, n), -np.inf, dtype=np.float32), np.full((n_queries, n), -1, dtype=np.int32)
+
+
+class ExactIndex:
+    """
+    精确的 top-N 内积检索: item 按 block 行一块, 每块对一批 query 做一次 matmul,
+    每块先 argpartition 出前 n 个再和已有的前 n 个合并, 内存只有 (query_chunk, block)
+    """
+    def __init__(self, items, block=16384, query_chunk=1024):
+        self.items = as_vectors(items)
+        self.block = block
+        self.query_chunk = query_chunk
+
+    def __len__(self):
+        return len(self.items)
+
+    def search(self, queries, n):
+        """返回 (ids, scores), 都是 (nq, n), 按分数降序, ids 是 int32"""
+        queries = as_vectors(queries)
+        n = min(n, len(self.items))
+        ids, scores = np.empty((len(queries), n), dtype=np.int32), np.empty((len(queries), n), dtype=np.float32)
+        for start in range(0, len(queries), self.query_chunk):
+            q = queries[start:start + self.query_chunk]
+            best_scores, best_ids = _empty(len(q), n)
+            for first in range(0, len(self.items), self.block):
+                block = self.items[first:first + self.block]
+                block_scores, block_ids = _block_topk(q @ block.T, np.arange(first, first + len(block),
+                                                                               dtype=np.int32), n)
+                best_scores, best_ids = _merge(best_scores, best_ids, block_scores, block_ids, n)
+            ids[start:start + len(q)], scores[start:start + len(q)] = _sorted(best_scores, best_ids)
+        return ids, scores
+
+
+def kmeans(x, k, iters=10, seed=0):
+    """Lloyd k-means, 每轮一次分块的最近中心分配, 中心用 bincount 逐维求和; 空簇保留上一轮的中心"""
+    rng = np.random.default_rng(seed)
+    centroids = x[rng.choice(len(x), size=k, replace=False)].copy()
+    for _ in range(iters):
+        assign = nearest(x, centroids)
+        counts = np.bincount(assign, minlength=k)
+        sums = np.stack([np.bincount(assign, weights=x[:, j], minlength=k) for j in range(x.shape[1])], axis=1)
+        filled = counts > 0
+        centroids[filled] = (sums[filled] / counts[filled, None]).astype(np.float32)
+    return centroids
+
+
+def nearest(x, centroids, chunk=65536):
+    """每行最近 (L2) 的中心下标, ||x - c||^2 = ||c||^2 - 2 x·c + 常数"""
+    norms = (centroids ** 2).sum(axis=1)
+    out = np.empty(len(x), dtype=np.int64)
+    for start in range(0, len(x), chunk):
+        out[start:start + chunk] = np.argmin(norms - 2 * x[start:start + chunk] @ centroids.T, axis=1)
+    return out
+
+
+class IVFIndex:
+    """
+    倒排 (IVF) 近似检索: item 用 k-means 分成 n_lists 个簇, 每个簇的向量在 list_items 里连续存放
+    查询时取内积最大的 n_probe 个中心, 只对这些簇里的 item 打分
+    一批 query 一起搜: 按簇分组, 每个簇只对探查到它的 query 做一次 matmul
+    n_probe = n_lists 时结果和 ExactIndex 一样
+    """
+    def __init__(self, items, n_lists=None, n_probe=8, iters=10, train_size=None, seed=0):
+        items = as_vectors(items)
+        self.n_lists = min(n_lists or max(1, int(np.sqrt(len(items)))), len(items))
+        self.n_probe = n_probe
+        # 和 faiss 一样, 每个中心最多用 256 个点训练
+        train_size = min(train_size or 256 * self.n_lists, len(items))
+        rng = np.random.default_rng(seed)
+        sample = items[rng.choice(len(items), size=train_size, replace=False)]
+        self.centroids = kmeans(sample, self.n_lists, iters, seed)
+        assign = nearest(items, self.centroids)
+        order = np.argsort(assign, kind='stable')
+        self.list_ids = order.astype(np.int32)
+        self.list_items = items[order]
+        self.list_ptr = np.zeros(self.n_lists + 1, dtype=np.int64)
+        self.list_ptr[1:] = np.cumsum(np.bincount(assign, minlength=self.n_lists))
+
+    def __len__(self):
+        return len(self.list_ids)
+
+    def search(self, queries, n, n_probe=None):
+        """返回 (ids, scores), 都是 (nq, n), 按分数降序; 探查到的 item 不够 n 个时补 -1"""
+        queries = as_vectors(queries)
+        n = min(n, len(self))
+        n_probe = min(n_probe or self.n_probe, self.n_lists)
+        probes = np.argpartition(-(queries @ self.centroids.T), n_probe - 1, axis=1)[:, :n_probe]
+        best_scores, best_ids = _empty(len(queries), n)
+        lists = probes.ravel()
+        query_of = np.repeat(np.arange(len(queries)), n_probe)
+        order = np.argsort(lists, kind='stable')
+        lists, query_of = lists[order], query_of[order]
+        bounds = np.flatnonzero(np.diff(lists)) + 1
+        for group in np.split(np.arange(len(lists)), bounds):
+            if len(group) == 0:
+                continue
+            cluster = lists[group[0]]
+            lo, hi = self.list_ptr[cluster], self.list_ptr[cluster + 1]
+            if lo == hi:
+                continue
+            qs = query_of[group]
+            block_scores, block_ids = _block_topk(queries[qs] @ self.list_items[lo:hi].T, self.list_ids[lo:hi], n)
+            best_scores[qs], best_ids[qs] = _merge(best_scores[qs], best_ids[qs], block_scores, block_ids, n)
+        return _sorted(best_scores, best_ids)
+
+
+def recall_at_n(found, truth):
+    """近似结果 found 和精确结果 truth (都是 (nq, n) 的 id) 的平均重合比例"""
+    found, truth = np.asarray(found, dtype=np.int64), np.asarray(truth, dtype=np.int64)
+    # 每行的 id 加上不同的偏移, 一次 isin 比较所有行 (found 里补的 -1 不会撞上别的行)
+    offset = np.arange(len(truth))[:, None] * (max(found.max(), truth.max()) + 2)
+    return np.isin(found + offset, truth + offset).sum() / truth.size
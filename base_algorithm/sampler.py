@@ -0,0 +1,199 @@
+import copy
+import numpy as np
+from .prefetch import BatchPrefetcher
+
+
+class NegativeSampler:
+    """
+    uniform negative sampler: 一次给整个batch抽negative, 用 InteractionIndex 做拒绝采样,
+    只重抽和用户交互过的item冲突的那些行
+    """
+    def __init__(self, interactions, seed=None):
+        self.interactions = interactions
+        self.user_size = interactions.user_size
+        self.item_size = interactions.item_size
+        self.rng = np.random.default_rng(seed)
+
+    def contains(self, users, items):
+        """users[k] 是否和 items[k] 交互过, 返回bool数组"""
+        return self.interactions.contains(users, items)
+
+    def draw(self, size):
+        """不管交互过没有, 先抽 size 个候选item"""
+        return self.rng.integers(self.item_size, size=size)
+
+    def sample(self, users, items=None):
+        """给每个user抽一个没有交互过的item, items 是对应的正样本 (均匀采样用不到)"""
+        users = np.asarray(users, dtype=np.int64)
+        neg = self.draw(len(users))
+        redraw = self.contains(users, neg)
+        while redraw.any():
+            rows = np.flatnonzero(redraw)
+            neg[rows] = self.draw(len(rows))
+            redraw[rows] = self.contains(users[rows], neg[rows])
+        return neg
+
+    def batch(self, pairs):
+        """pairs: (B, 2) 的 (user, pos_item), 返回 (B, 3) 的 (user, pos_item, neg_item)"""
+        pairs = np.asarray(pairs, dtype=np.int64)
+        out = np.empty((len(pairs), 3), dtype=np.int64)
+        out[:, :2] = pairs
+        return self.fill(out)
+
+    def fill(self, out):
+        """out: (B, 3), 前两列已经是 (user, pos_item), 原地填上第三列的 neg_item"""
+        out[:, 2] = self.sample(out[:, 0], out[:, 1])
+        return out
+
+    def streams(self):
+        """
+        一个 epoch 用的 f(i): 返回第 i 个 batch 专用的采样器, 随机数流是 default_rng([key, i])
+        预取线程是抢着认领 batch 下标的, 共享一个 rng (或者每个线程一个) 结果都取决于线程调度;
+        按 batch 下标分流以后几个线程并发采样也和单线程一样可复现. key 每个 epoch 从 self.rng 抽一次
+        """
+        key = int(self.rng.integers(2 ** 63))
+
+        def stream(i):
+            sampler = copy.copy(self)
+            sampler.rng = np.random.default_rng([key, i])
+            return sampler
+        return stream
+
+
+def epoch_batches(planner, sampler, backend, args=None):
+    """
+    训练循环的一个 epoch: 重新抽一次 planner 的下标排列 (train_list 本身不动),
+    后台线程把正样本对 gather 进 buffer, 有 sampler 时 gather 成 (B, 3) 再原地填上负样本, 没有时是 (B, 2);
+    预取好的已经是设备上的 tensor, 依次 yield, 最后 yield None
+    同时活着的 batch 不超过 prefetcher.capacity 个, gather 轮流复用这么多个 buffer, 不再每个 batch 分配
+    args 里的 workers / prefetch 控制预取, 没有就用默认值
+    """
+    planner.shuffle()
+    if sampler is None:
+        make_batch = planner.gather
+    else:
+        stream = sampler.streams()
+
+        def make_batch(i):
+            return stream(i).fill(planner.gather(i, width=3))
+    prefetcher = BatchPrefetcher.from_args(args, make_batch, len(planner), backend)
+    planner.reuse(prefetcher.capacity)
+    yield from prefetcher
+    yield None
+
+
+class HardNegativeSampler(NegativeSampler):
+    """
+    每一行以 hard_ratio 的概率从正样本的共现item (co_items) 里抽 hard negative, 其余的均匀抽
+    neighbours 是 item -> 共现item 的 CSR (InteractionIndex), 一个batch一起抽, 抽到交互过的item就重抽,
+    tries 次还不行 (或者正样本没有邻居) 的行退回均匀采样
+    """
+    def __init__(self, interactions, neighbours, hard_ratio=0.5, tries=3, seed=None):
+        super(HardNegativeSampler, self).__init__(interactions, seed)
+        self.neighbours = neighbours
+        self.hard_ratio = hard_ratio
+        self.tries = tries
+
+    def sample(self, users, items=None):
+        users = np.asarray(users, dtype=np.int64)
+        if items is None:
+            return super(HardNegativeSampler, self).sample(users)
+        items = np.asarray(items, dtype=np.int64)
+        neg = np.full(len(users), -1, dtype=np.int64)
+        degree = self.neighbours.degree(items)
+        rows = np.flatnonzero((self.rng.random(len(users)) < self.hard_ratio) & (degree > 0))
+        for _ in range(self.tries):
+            if len(rows) == 0:
+                break
+            pick = self.neighbours.indptr[items[rows]] + (self.rng.random(len(rows)) * degree[rows]).astype(np.int64)
+            candidates = self.neighbours.indices[pick].astype(np.int64)
+            accepted = ~self.contains(users[rows], candidates)
+            neg[rows[accepted]] = candidates[accepted]
+            rows = rows[~accepted]
+        rest = np.flatnonzero(neg < 0)
+        neg[rest] = super(HardNegativeSampler, self).sample(users[rest])
+        return neg
+
+
+class AliasTable:
+    """
+    alias method: 按任意离散分布 O(1) 抽样, 一次可以抽几百万个
+    构造也是向量化的: 概率 * n 之后 <1 的桶 (small) 按顺序由 >=1 的桶 (large) 补齐,
+    large 自己补不满的部分再由下一个 large 补, 全程只有 cumsum 和 searchsorted, 没有 python 循环
+    """
+    def __init__(self, weights):
+        self.build(weights)
+
+    def build(self, weights):
+        weights = np.asarray(weights, dtype=np.float64)
+        n = len(weights)
+        if n == 0 or weights.sum() <= 0:
+            raise Exception('alias table needs positive weights')
+        q = weights * (n / weights.sum())
+        self.prob = np.ones(n)
+        self.alias = np.arange(n, dtype=np.int64)
+        small = np.flatnonzero(q < 1)
+        large = np.flatnonzero(q >= 1)
+        if len(small) and len(large):
+            deficit_end = np.cumsum(1 - q[small])
+            deficit_start = deficit_end - (1 - q[small])
+            excess_end = np.cumsum(q[large] - 1)
+            # small 由它的 deficit 起点所在的那一段 excess 的 large 补
+            owner = np.minimum(np.searchsorted(excess_end, deficit_start, side='right'), len(large) - 1)
+            self.prob[small] = q[small]
+            self.alias[small] = large[owner]
+            # large 补给 small 的量可能超过自己的 excess, 超出的部分 (over) 由下一个 large 补回来
+            covered = np.searchsorted(deficit_start, excess_end, side='left')
+            reach = np.where(covered > 0, deficit_end[np.maximum(covered - 1, 0)], 0)
+            over = np.clip(reach - excess_end, 0, 1)
+            over[-1] = 0
+            self.prob[large] = 1 - over
+            self.alias[large[:-1]] = large[1:]
+        self.weights = weights
+
+    def update(self, delta):
+        """权重变了 (比如 item 的交互数增加了) 就整体重建一次, 代价是 O(n) 的几次向量操作"""
+        self.build(self.weights + np.asarray(delta, dtype=np.float64))
+
+    def draw(self, size, rng):
+        bucket = rng.integers(len(self.prob), size=size)
+        return np.where(rng.random(size) < self.prob[bucket], bucket, self.alias[bucket])
+
+
+class PopularityNegativeSampler(NegativeSampler):
+    """
+    负样本按 item 流行度 degree^alpha 抽 (alpha=0 就是均匀, 1 是按交互数成比例), 用 AliasTable 每个 O(1)
+    counts 一般是 train_list 里每个 item 的交互数; 一直抽到交互过的 item 的行, tries 轮后退回均匀采样
+    """
+    def __init__(self, interactions, counts, alpha=0.75, tries=10, seed=None):
+        super(PopularityNegativeSampler, self).__init__(interactions, seed)
+        self.alpha = alpha
+        self.tries = tries
+        self.counts = np.asarray(counts, dtype=np.float64)
+        self.table = AliasTable(self.counts ** alpha)
+
+    def update_counts(self, items, delta=1):
+        """有新的交互时增加对应 item 的计数并重建 alias 表"""
+        self.counts = self.counts + np.bincount(np.asarray(items, dtype=np.int64),
+                                                minlength=len(self.counts)) * delta
+        self.table.build(self.counts ** self.alpha)
+
+    def draw(self, size):
+        return self.table.draw(size, self.rng)
+
+    def sample(self, users, items=None):
+        users = np.asarray(users, dtype=np.int64)
+        neg = self.draw(len(users))
+        rows = np.flatnonzero(self.contains(users, neg))
+        for _ in range(self.tries):
+            if len(rows) == 0:
+                return neg
+            neg[rows] = self.draw(len(rows))
+            rows = rows[self.contains(users[rows], neg[rows])]
+        neg[rows] = super(PopularityNegativeSampler, self).draw(len(rows))
+        redraw = self.contains(users[rows], neg[rows])
+        while redraw.any():
+            rows = rows[redraw]
+            neg[rows] = super(PopularityNegativeSampler, self).draw(len(rows))
+            redraw = self.contains(users[rows], neg[rows])
+        return neg
@@ -0,0 +1,82 @@
+import numpy as np
+import torch
+from .metrics import RankingMetrics
+from .profiling import DISABLED
+
+
+def iter_scores(user_table, item_table, u, samples, chunk_size=2048):
+    """
+    u: (n,) user id, samples: (n, c) 每个user的候选item id
+    按 chunk_size 个user一块, 每块只gather一次embedding, 用一次 batched matmul 算 (chunk, c) 的分数
+    yield (start, end, scores)
+    """
+    device = user_table.device
+    u = torch.as_tensor(u).to(device)
+    samples = torch.as_tensor(samples).to(device)
+    with torch.no_grad():
+        for start in range(0, len(u), chunk_size):
+            end = min(start + chunk_size, len(u))
+            users = user_table[u[start:end]]  # chunk * dim
+            items = item_table[samples[start:end]]  # chunk * c * dim
+            yield start, end, torch.einsum('nd, ncd -> nc', [users, items])
+
+
+def score_candidates(user_table, item_table, u, samples, chunk_size=2048):
+    """返回 (n, c) 的numpy分数矩阵, 和逐列调 predict 的结果一致"""
+    results = None
+    for start, end, scores in iter_scores(user_table, item_table, u, samples, chunk_size):
+        scores = scores.cpu().numpy()
+        if results is None:
+            results = np.empty((len(u), scores.shape[1]), dtype=scores.dtype)
+        results[start:end] = scores
+    if results is None:
+        results = np.empty((0, np.shape(samples)[1]), dtype=np.float32)
+    return results
+
+
+def recommend(user_table, item_table, user_ids, n, interactions=None, chunk_size=2048):
+    """
+    每个user在全部item里分数最高的 n 个: 每 chunk_size 个user和整个 item 表做一次 matmul,
+    interactions (InteractionIndex) 不为 None 时先把训练集里交互过的 item 置成 -inf, 再 topk
+    返回 (len(user_ids), n) 的 int32 item id, 按分数降序; 可推荐的 item 不够 n 个时补 -1,
+    n 比 item 总数还大时也是这样, 宽度总是 n, 调用方可以直接预分配或者拼接
+    """
+    device = user_table.device
+    user_ids = np.asarray(user_ids, dtype=np.int64)
+    k = min(n, item_table.shape[0])
+    out = np.full((len(user_ids), n), -1, dtype=np.int32)
+    with torch.no_grad():
+        for start in range(0, len(user_ids), chunk_size):
+            users = user_ids[start:start + chunk_size]
+            scores = user_table[torch.from_numpy(users).to(device)] @ item_table.T  # chunk * item_size
+            if interactions is not None:
+                rows, items = interactions.pairs(users)
+                scores[torch.from_numpy(rows).to(device), torch.from_numpy(items).to(device)] = float('-inf')
+            values, ids = torch.topk(scores, k, dim=1)
+            ids[values == float('-inf')] = -1
+            out[start:start + len(users), :k] = ids.cpu().numpy()
+    return out
+
+
+def evaluate_split(user_table, item_table, u, samples, gt, chunk_size=2048):
+    """一个评估集的 auc 和 top-K 指标, 每块user打完分就更新, 不保留整个分数矩阵"""
+    metrics = RankingMetrics()
+    for start, end, scores in iter_scores(user_table, item_table, u, samples, chunk_size):
+        if torch.isnan(scores).any():
+            raise Exception('nan')
+        metrics.update(gt[start:end], scores)
+    return metrics.result()
+
+
+def evaluate_splits(splits, user_table, item_table, item_table_cold=None, chunk_size=2048, profiler=DISABLED):
+    """
+    Model.eval_splits 的每个评估集各自 evaluate_split, 冷启动的用 item_table_cold
+    返回 {评估集名字: 指标}, 顺序和 splits 一致; profiler 里按评估集记在 eval.<名字>
+    """
+    report = {}
+    with torch.no_grad():
+        for name, u, samples, gt, cold in splits:
+            with profiler.stage('eval.' + name):
+                report[name] = evaluate_split(user_table, item_table_cold if cold else item_table,
+                                              u, samples, gt, chunk_size)
+    return report
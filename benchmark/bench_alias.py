@@ -0,0 +1,54 @@
+import argparse
+import time
+import numpy as np
+from base_algorithm.interactions import InteractionIndex
+from base_algorithm.sampler import AliasTable, NegativeSampler, PopularityNegativeSampler
+from benchmark.synthetic import make_interactions
+
+parser = argparse.ArgumentParser(description='alias table vs np.random.choice for popularity sampling')
+parser.add_argument('--items', default=[10000, 1000000], type=int, nargs='*', help='number of items', dest='items')
+parser.add_argument('--draws', default=10000000, type=int, help='draws per call', dest='draws')
+parser.add_argument('--alpha', default=0.75, type=float, help='popularity exponent', dest='alpha')
+parser.add_argument('--users', default=50000, type=int, help='users for the sampler run', dest='users')
+parser.add_argument('--interactions', default=1000000, type=int, help='interactions for the sampler run',
+                    dest='interactions')
+parser.add_argument('--bsz', default=10240, type=int, help='batch_size', dest='bsz')
+
+
+def timed(fn):
+    start = time.perf_counter()
+    out = fn()
+    return out, time.perf_counter() - start
+
+
+def main():
+    args = parser.parse_args()
+    rng = np.random.default_rng(0)
+    print(f'{"items":>8} {"build s":>8} {"alias draws/s":>14} {"choice draws/s":>15} {"max |p - p_hat|":>16}')
+    for items in args.items:
+        weights = (rng.pareto(1.0, items) + 1) ** args.alpha
+        table, build = timed(lambda: AliasTable(weights))
+        drawn, alias_time = timed(lambda: table.draw(args.draws, rng))
+        _, choice_time = timed(lambda: rng.choice(items, size=args.draws, p=weights / weights.sum()))
+        # alias 表隐含的精确分布和目标分布的差
+        p = np.bincount(table.alias, weights=(1 - table.prob) / items, minlength=items) + table.prob / items
+        print(f'{items:>8} {build:>8.3f} {args.draws / alias_time:>14.0f} {args.draws / choice_time:>15.0f} '
+              f'{np.abs(p - weights / weights.sum()).max():>16.2e}')
+        # 增量更新: 一部分 item 的计数变了就重建
+        _, rebuild = timed(lambda: table.update(np.bincount(drawn[:100000], minlength=items)))
+        print(f'{"":>8} rebuild after 100k new interactions: {rebuild:.3f}s')
+
+    item_size = args.items[0]
+    train_list, train_pt = make_interactions(args.users, item_size, args.interactions)
+    index = InteractionIndex.build(train_pt, args.users, item_size)
+    counts = np.bincount(train_list[:, 1], minlength=item_size)
+    for name, sampler in [('uniform', NegativeSampler(index, seed=0)),
+                          (f'popularity^{args.alpha}', PopularityNegativeSampler(index, counts, args.alpha, seed=0))]:
+        batches = len(train_list) // args.bsz
+        _, seconds = timed(lambda: [sampler.batch(train_list[i * args.bsz:(i + 1) * args.bsz])
+                                    for i in range(batches)])
+        print(f'{name:>16}: {batches * args.bsz / seconds:12.0f} samples/sec')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,38 @@
+import argparse
+import os
+import tempfile
+import time
+import torch
+from contrastive_rec.cr_v3 import CR
+from benchmark.synthetic import make_dataset
+
+parser = argparse.ArgumentParser(description='job time of contrastive_rec.CR.train: blocking vs background evaluation')
+parser.add_argument('--users', default=20000, type=int, help='number of users', dest='users')
+parser.add_argument('--items', default=10000, type=int, help='number of items', dest='items')
+parser.add_argument('--interactions', default=200000, type=int, help='number of interactions', dest='interactions')
+parser.add_argument('--candidates', default=500, type=int, help='candidates per evaluated user', dest='candidates')
+parser.add_argument('--dim', default=64, type=int, help='the dim for item and user', dest='dim')
+parser.add_argument('--bsz', default=2048, type=int, help='batch_size', dest='bsz')
+parser.add_argument('--epochs', default=9, type=int, help='training epochs (evaluation every 2 after the first)',
+                    dest='epochs')
+parser.add_argument('--gpu', default=-1, type=int, help='gpu number to use, -1 for cpu', dest='gpu')
+
+
+def main():
+    args = parser.parse_args()
+    data = make_dataset(args.users, args.items, args.interactions, n_candidates=args.candidates)
+    directory = tempfile.mkdtemp()
+    print(f'{len(data.train_list)} interactions, {args.epochs} epochs, {args.candidates} candidates per user')
+    for async_eval in (False, True):
+        run_args = argparse.Namespace(dim=args.dim, lr=0.001, reg=0.01, epochs=args.epochs, bsz=args.bsz,
+                                      gpu=args.gpu, ih=False, seed=0, con_weight=0.1, reg_weight=0.7,
+                                      temp_value=1.382, nce_tile=2048, async_eval=async_eval)
+        torch.manual_seed(0)
+        model = CR(run_args, data, os.path.join(directory, f'async-{async_eval}.txt'))
+        start = time.perf_counter()
+        model.train()
+        print(f'{"background" if async_eval else "blocking":>10} evaluation: {time.perf_counter() - start:7.2f}s')
+
+
+if __name__ == '__main__':
+    main()
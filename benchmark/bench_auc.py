@@ -0,0 +1,68 @@
+import argparse
+import time
+import numpy as np
+import torch
+from sklearn.metrics import roc_auc_score
+from base_algorithm.device import Backend
+from base_algorithm.metrics import rank_auc
+from benchmark.bench_metrics import make_eval
+
+parser = argparse.ArgumentParser(description='per-user AUC: sklearn samples average vs rank-sum kernel')
+parser.add_argument('--users', default=[10000, 100000, 1000000], type=int, nargs='*', help='number of users',
+                    dest='users')
+parser.add_argument('--candidates', default=100, type=int, help='candidates per user', dest='candidates')
+parser.add_argument('--positives', default=5, type=int, help='max positives per user', dest='positives')
+parser.add_argument('--sklearn_max', default=100000, type=int, help='skip sklearn above this many users',
+                    dest='sklearn_max')
+parser.add_argument('--chunk', default=65536, type=int, help='users per rank_auc call', dest='chunk')
+parser.add_argument('--gpu', default=-1, type=int, help='gpu number to use, -1 for cpu', dest='gpu')
+
+
+def legacy_auc_calculate(labels, pre_ds, device='cpu'):
+    """原来 Model.auc_calculate 的写法, 用全局均值做阈值, 是个近似"""
+    labels = torch.from_numpy(labels).double().to(device)
+    pre_ds = torch.from_numpy(pre_ds).double().to(device)
+    pre_ds = torch.where(pre_ds > torch.mean(pre_ds), torch.ones_like(pre_ds), torch.zeros_like(pre_ds))
+    positive_results = torch.einsum('ij, ij->i', [labels, pre_ds]) / torch.sum(labels, dim=1)
+    negative_results = torch.einsum('ij, ij->i', [1 - labels, pre_ds]) / torch.sum(1 - labels, dim=1)
+    return float(torch.mean((negative_results + positive_results) / 2.0))
+
+
+def streaming_auc(gt, preds, device, chunk):
+    total, rows = 0.0, 0
+    for lo in range(0, len(preds), chunk):
+        auc = rank_auc(gt[lo:lo + chunk], torch.from_numpy(preds[lo:lo + chunk]).to(device))
+        valid = ~torch.isnan(auc)
+        total += float(auc[valid].sum())
+        rows += int(valid.sum())
+    return total / rows
+
+
+def main():
+    args = parser.parse_args()
+    backend = Backend(args.gpu)
+    print(f'{backend}  candidates: {args.candidates}')
+    print(f'{"users":>8} {"method":>12} {"seconds":>10} {"auc":>10}')
+    for users in args.users:
+        gt, preds = make_eval(users, args.candidates, args.positives)
+        timings = {}
+        if users <= args.sklearn_max:
+            timings['sklearn'] = lambda: roc_auc_score(gt, preds, average='samples')
+        timings['threshold'] = lambda: legacy_auc_calculate(gt, preds, backend.device)
+        timings['rank_sum'] = lambda: streaming_auc(gt, preds, backend.device, args.chunk)
+        for name, fn in timings.items():
+            start = time.perf_counter()
+            value = fn()
+            print(f'{users:>8} {name:>12} {time.perf_counter() - start:>10.3f} {value:>10.6f}')
+    # 分数有大量并列时和 sklearn 逐行的结果对比
+    gt, preds = make_eval(2000, args.candidates, args.positives, seed=1)
+    preds = np.round(preds)
+    reference = np.array([roc_auc_score(g, p) for g, p in zip(gt, preds)])
+    ours = rank_auc(gt, torch.from_numpy(preds)).numpy()
+    print(f'ties: max |rank_sum - sklearn| = {np.abs(ours - reference).max():.2e}')
+    gt[0] = 0
+    print('row without positives:', rank_auc(gt[:2], torch.from_numpy(preds[:2])).numpy())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+import argparse
+import time
+import numpy as np
+import torch
+from base_algorithm.batching import BatchPlanner
+
+parser = argparse.ArgumentParser(description='per-epoch batching: in-place shuffle vs BatchPlanner')
+parser.add_argument('--rows', default=5000000, type=int, help='rows of train_list', dest='rows')
+parser.add_argument('--bsz', default=10240, type=int, help='batch_size', dest='bsz')
+
+
+def legacy_epoch(train_list, batch_size):
+    """原来 cr_v3.CR.sample 的写法 (原地 shuffle 单独计时), 逐行拷成 python tuple"""
+    for i in range(len(train_list) // batch_size):
+        pairs = []
+        for m, j in train_list[i * batch_size:(i + 1) * batch_size, :]:
+            pairs.append((m, j))
+        yield torch.LongTensor(pairs)
+
+
+def planner_epoch(planner):
+    planner.shuffle()
+    for i in range(len(planner)):
+        yield torch.from_numpy(planner.gather(i))
+
+
+def rows_per_sec(batches):
+    n = 0
+    start = time.perf_counter()
+    for b in batches:
+        n += len(b)
+    return n / (time.perf_counter() - start)
+
+
+def main():
+    args = parser.parse_args()
+    rng = np.random.default_rng(0)
+    train_list = rng.integers(1 << 20, size=(args.rows, 2))
+    start = time.perf_counter()
+    np.random.shuffle(train_list)
+    shuffle = time.perf_counter() - start
+    start = time.perf_counter()
+    rng.permutation(args.rows)
+    permutation = time.perf_counter() - start
+    print(f'rows: {args.rows}  in-place shuffle: {shuffle:.3f}s  index permutation: {permutation:.3f}s')
+    # 原来的写法太慢, 只跑前 20 个 batch
+    legacy = rows_per_sec(b for b, _ in zip(legacy_epoch(train_list, args.bsz), range(20)))
+    readonly = train_list.copy()
+    readonly.flags.writeable = False  # planner 不会写 train_list, 只读的 memmap 也可以
+    planned = rows_per_sec(planner_epoch(BatchPlanner(readonly, args.bsz, seed=0)))
+    # 训练时 sample() 按 BatchPrefetcher.capacity (默认 8 + 2 + 2) 复用 buffer
+    reused = rows_per_sec(planner_epoch(BatchPlanner(readonly, args.bsz, seed=0).reuse(12)))
+    print(f'legacy tuples:           {legacy:12.0f} rows/sec  (plus the in-place shuffle above)')
+    print(f'BatchPlanner gather:     {planned:12.0f} rows/sec  ({planned / legacy:.1f}x, including the permutation)')
+    print(f'  with 12 reused buffers: {reused:11.0f} rows/sec  ({reused / planned:.2f}x of fresh buffers)')
+
+
+if __name__ == '__main__':
+    main()
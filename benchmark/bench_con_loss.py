@@ -0,0 +1,106 @@
+import argparse
+import time
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+from base_algorithm.device import Backend
+from base_algorithm.losses import squared_distance_sums
+from benchmark.memory import peak_memory
+
+parser = argparse.ArgumentParser(description='memory profile of the con_loss_matmul distance kernel, '
+                                             'fails unless peak memory grows ~linearly for the new kernels '
+                                             'and ~quadratically for the legacy one')
+parser.add_argument('--sizes', default=[8192, 16384, 32768], type=int, nargs='*',
+                    help='number of unique positive (= negative) items per batch for the new kernels', dest='sizes')
+parser.add_argument('--legacy_sizes', default=[256, 512, 1024], type=int, nargs='*',
+                    help='sizes for the legacy kernel, its is * js * dim tensor does not fit at --sizes',
+                    dest='legacy_sizes')
+parser.add_argument('--dim', default=64, type=int, help='embedding dim', dest='dim')
+parser.add_argument('--tile', default=256, type=int, help='negatives per tile for the tiled kernel', dest='tile')
+parser.add_argument('--tolerance', default=0.25, type=float,
+                    help='allowed deviation of the fitted log-log slope from the expected order', dest='tolerance')
+parser.add_argument('--gpu', default=-1, type=int, help='gpu number to use, -1 for cpu', dest='gpu')
+
+# 低于这个的峰值当作量不出来 (cpu 上 VmHWM 的分辨率约 1MB)
+MIN_PEAK = 4 * 2 ** 20
+
+
+def legacy_neg_scores_sum(pos_feature, neg_embedding):
+    """原来 CR.con_loss_matmul 的写法, 构造 is * js * dim 的差值张量"""
+    pos_neg_dif = pos_feature.unsqueeze(1) - neg_embedding
+    neg_scores = torch.einsum('nij, nij -> ni', [pos_neg_dif, pos_neg_dif])
+    return torch.sum(neg_scores, dim=1)
+
+
+def log_log_slope(sizes, peaks):
+    """峰值内存关于 size 的增长阶数: log(peak) 对 log(size) 的最小二乘斜率"""
+    return float(np.polyfit(np.log(sizes), np.log(peaks), 1)[0])
+
+
+def kernel(name, tile):
+    if name == 'legacy':
+        return legacy_neg_scores_sum
+    if name == 'expanded':
+        return squared_distance_sums
+    return lambda a, b: squared_distance_sums(a, b, tile)
+
+
+def measure(name, size, args):
+    """
+    在单独的进程里跑: 前面的 kernel 释放的内存 glibc 不一定还给系统, 同一个进程里接着量会被复用掉, 峰值偏低
+    返回 (一次前向+反向的秒数, 峰值内存 bytes, 和闭式解的最大相对误差)
+    """
+    backend = Backend(args.gpu)
+    fn = kernel(name, args.tile)
+    torch.manual_seed(0)
+    a = torch.randn(size, args.dim, device=backend.device, requires_grad=True)
+    b = torch.randn(size, args.dim, device=backend.device, requires_grad=True)
+    start = time.perf_counter()
+    out = fn(a, b)
+    out.sum().backward()
+    seconds = time.perf_counter() - start
+    with torch.no_grad():
+        # 闭式解 (expanded) 当参照
+        reference = squared_distance_sums(a, b)
+        err = float(((out.detach() - reference).abs() / reference.abs()).max())
+    del out
+    a.grad = b.grad = None
+    # 上面计时的那次兼做热身, 再量两次取较大值
+    peak = max(peak_memory(lambda: fn(a, b).sum().backward(), backend.device) for _ in range(2))
+    return seconds, peak, err
+
+
+def main():
+    args = parser.parse_args()
+    print(f'{Backend(args.gpu)}  dim: {args.dim}')
+    # 名字: (sizes, 期望的阶数)
+    kernels = {
+        'legacy': (args.legacy_sizes, 2),
+        'expanded': (args.sizes, 1),
+        'tiled': (args.sizes, 1),
+    }
+    print(f'{"size":>7} {"kernel":>12} {"ms":>10} {"peak MB":>10} {"max rel err":>12}')
+    ctx = mp.get_context('spawn')
+    failures = []
+    for name, (sizes, order) in kernels.items():
+        label = f'tiled({args.tile})' if name == 'tiled' else name
+        peaks = []
+        for size in sizes:
+            with ctx.Pool(1) as pool:
+                seconds, peak, err = pool.apply(measure, (name, size, args))
+            peaks.append(peak)
+            print(f'{size:>7} {label:>12} {seconds * 1000:>10.2f} {peak / 2 ** 20:>10.1f} {err:>12.2e}')
+        if min(peaks) < MIN_PEAK:
+            failures.append(f'{label}: peak memory {min(peaks) / 2 ** 20:.1f} MB is below the '
+                            f'{MIN_PEAK / 2 ** 20:.0f} MB needed to measure it, raise the sizes')
+            continue
+        slope = log_log_slope(sizes, peaks)
+        print(f'{label:>12}: peak memory ~ size^{slope:.2f} (expected {order})')
+        if abs(slope - order) > args.tolerance:
+            failures.append(f'{label}: peak memory grows as size^{slope:.2f}, expected size^{order}')
+    if failures:
+        raise Exception('\n'.join(failures))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,46 @@
+import argparse
+import time
+import torch
+from base_algorithm.cr import CR
+from base_algorithm.batching import BatchPlanner
+from benchmark.synthetic import make_dataset
+
+parser = argparse.ArgumentParser(description='cpu training/scoring throughput of CR')
+parser.add_argument('--users', default=20000, type=int, help='number of users', dest='users')
+parser.add_argument('--items', default=10000, type=int, help='number of items', dest='items')
+parser.add_argument('--interactions', default=400000, type=int, help='number of interactions', dest='interactions')
+parser.add_argument('--dim', default=64, type=int, help='the dim for item and user', dest='dim')
+parser.add_argument('--bsz', default=512, type=int, help='batch_size', dest='bsz')
+parser.add_argument('--batches', default=20, type=int, help='training batches timed per run', dest='batches')
+parser.add_argument('--threads', default=[1, 2, 4, 8], type=int, nargs='*',
+                    help='intra-op thread counts to compare', dest='threads')
+
+
+def main():
+    args = parser.parse_args()
+    data = make_dataset(args.users, args.items, args.interactions)
+    print(f'interactions: {len(data.train_list)}  bsz: {args.bsz}  dim: {args.dim}')
+    for threads in args.threads:
+        run_args = argparse.Namespace(dim=args.dim, lr=0.001, reg=0.01, epochs=1, bsz=args.bsz,
+                                      gpu=-1, threads=threads, ih=False, neg_alpha=None, seed=0)
+        torch.manual_seed(0)
+        model = CR(run_args, data, filename=None)
+        # 只跑一个 epoch 的前 batches 个 batch
+        model.planner = BatchPlanner(data.train_list[:args.batches * args.bsz], args.bsz, seed=0)
+
+        start = time.perf_counter()
+        model.train()
+        train_time = time.perf_counter() - start
+
+        u = torch.arange(model.user_size)
+        start = time.perf_counter()
+        model.compute_results(u, data.test_samples)
+        score_time = time.perf_counter() - start
+
+        train_rate = len(model.planner) * args.bsz / train_time
+        score_rate = data.test_samples.size / score_time
+        print(f'{model.backend}: train {train_rate:10.0f} samples/sec  score {score_rate:12.0f} pairs/sec')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+import argparse
+import os
+import tempfile
+import time
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from base_algorithm.load import LoadData
+from base_algorithm.packed import pack_fields, write_packed, load_dataset, _field_names
+from base_algorithm.distributed import init_process, distribute, allreduce_gradients
+from contrastive_rec.cr_v3 import CR
+from benchmark.synthetic import make_dataset
+
+parser = argparse.ArgumentParser(description='cpu data-parallel scaling of contrastive_rec.CR (gloo), '
+                                             'in-batch negatives come from the global batch, so the loss '
+                                             'cost per rank grows with the number of ranks')
+parser.add_argument('--users', default=50000, type=int, help='number of users', dest='users')
+parser.add_argument('--items', default=20000, type=int, help='number of items', dest='items')
+parser.add_argument('--interactions', default=1000000, type=int, help='number of interactions', dest='interactions')
+parser.add_argument('--dim', default=64, type=int, help='the dim for item and user', dest='dim')
+parser.add_argument('--bsz', default=2048, type=int, help='batch_size per rank', dest='bsz')
+parser.add_argument('--batches', default=30, type=int, help='timed batches per rank', dest='batches')
+parser.add_argument('--ranks', default=[1, 2, 4, 8], type=int, nargs='*', help='world sizes to run', dest='ranks')
+parser.add_argument('--threads', default=1, type=int, help='torch threads per rank', dest='threads')
+parser.add_argument('--port', default=29511, type=int, help='first tcp port for the process groups', dest='port')
+
+
+def run_rank(rank, world_size, path, args, results):
+    init_process(rank, world_size, f'tcp://127.0.0.1:{args.port + world_size}', args.threads)
+    data = load_dataset(path, LoadData)
+    run_args = argparse.Namespace(dim=args.dim, lr=0.001, reg=0.01, epochs=1, bsz=args.bsz * world_size, gpu=-1,
+                                  threads=args.threads, ih=False, seed=0, con_weight=0.1, reg_weight=0.7,
+                                  temp_value=1.382, nce_tile=2048, workers=1, prefetch=8)
+    torch.manual_seed(0)
+    model = CR(run_args, data, filename=None)
+    distribute(model, rank, world_size)
+    optimizer = torch.optim.Adam(model.parameters(), lr=run_args.lr)
+    model.planner.shuffle()
+    n_batches = min(args.batches, len(model.planner))
+
+    def step(i):
+        s = torch.from_numpy(model.planner.gather(i))
+        optimizer.zero_grad()
+        uid, iid = s[:, 0], s[:, 1]
+        loss = model.final_loss(model.projection.batch(iid), uid, iid)
+        loss.backward()
+        if world_size > 1:
+            allreduce_gradients(model.parameters(), world_size)
+        optimizer.step()
+
+    step(0)
+    dist.barrier()
+    start = time.perf_counter()
+    for i in range(1, n_batches):
+        step(i)
+    dist.barrier()
+    elapsed = time.perf_counter() - start
+    if rank == 0:
+        results.put((n_batches - 1) * args.bsz * world_size / elapsed)
+    dist.destroy_process_group()
+
+
+def main():
+    args = parser.parse_args()
+    data = make_dataset(args.users, args.items, args.interactions)
+    path = os.path.join(tempfile.mkdtemp(), 'bench.pack')
+    write_packed(path, *pack_fields({name: getattr(data, name) for name in _field_names(LoadData)}))
+    results = mp.get_context('spawn').SimpleQueue()
+    print(f'cpus: {os.cpu_count()}  threads per rank: {args.threads}  batch per rank: {args.bsz}  '
+          f'(weak scaling: efficiency = throughput_n / (n * throughput_1))')
+    base = None
+    for world_size in args.ranks:
+        mp.spawn(run_rank, args=(world_size, path, args, results), nprocs=world_size)
+        throughput = results.get()
+        base = base or throughput
+        print(f'ranks {world_size}: {throughput:12.0f} samples/sec   '
+              f'efficiency {throughput / (world_size * base):6.1%}')
+    os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,42 @@
+import argparse
+import os
+import tempfile
+import time
+import numpy as np
+from base_algorithm.export import export_embeddings, Embeddings, DTYPES
+from base_algorithm.retrieval import ExactIndex, recall_at_n
+
+parser = argparse.ArgumentParser(description='embedding export: size, open latency and accuracy per dtype')
+parser.add_argument('--users', default=1000000, type=int, help='number of users', dest='users')
+parser.add_argument('--items', default=200000, type=int, help='number of items', dest='items')
+parser.add_argument('--dim', default=64, type=int, help='the dim for item and user', dest='dim')
+parser.add_argument('--queries', default=1000, type=int, help='users checked for top-N agreement', dest='queries')
+parser.add_argument('--n', default=20, type=int, help='top-N', dest='n')
+
+
+def main():
+    args = parser.parse_args()
+    rng = np.random.default_rng(0)
+    user = (rng.normal(size=(args.users, args.dim)) * 0.1).astype(np.float32)
+    item = (rng.normal(size=(args.items, args.dim)) * 0.1).astype(np.float32)
+    cold = (rng.normal(size=(args.items, args.dim)) * 0.1).astype(np.float32)
+    queries = rng.choice(args.users, size=args.queries, replace=False)
+    truth, _ = ExactIndex(item).search(user[queries], args.n)
+    directory = tempfile.mkdtemp()
+    print(f'{args.users} users, {args.items} items (+ cold projection) x {args.dim}')
+    for dtype in DTYPES:
+        path = os.path.join(directory, f'model.{dtype}.emb')
+        start = time.perf_counter()
+        export_embeddings(path, user, item, cold, dtype)
+        write_time = time.perf_counter() - start
+        start = time.perf_counter()
+        emb = Embeddings(path)
+        open_ms = (time.perf_counter() - start) * 1000
+        found, _ = ExactIndex(emb.table('item')).search(emb.rows('user', queries), args.n)
+        print(f'{dtype:>8}: {os.path.getsize(path) / 2 ** 20:8.1f} MB  write {write_time:5.2f}s  '
+              f'open {open_ms:6.2f} ms  top-{args.n} recall vs float32 {recall_at_n(found, truth):.4f}')
+        os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
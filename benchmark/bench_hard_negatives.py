@@ -0,0 +1,42 @@
+import argparse
+import time
+import numpy as np
+from base_algorithm.sampler import NegativeSampler, HardNegativeSampler
+from benchmark.synthetic import make_dataset
+
+parser = argparse.ArgumentParser(description='hard negative sampler throughput')
+parser.add_argument('--users', default=20000, type=int, help='number of users', dest='users')
+parser.add_argument('--items', default=10000, type=int, help='number of items', dest='items')
+parser.add_argument('--interactions', default=400000, type=int, help='number of interactions', dest='interactions')
+parser.add_argument('--bsz', default=10240, type=int, help='batch_size', dest='bsz')
+parser.add_argument('--batches', default=20, type=int, help='batches timed per sampler', dest='batches')
+parser.add_argument('--ratios', default=[0.25, 0.5, 1.0], type=float, nargs='*',
+                    help='hard_ratio values to compare', dest='ratios')
+
+
+def main():
+    args = parser.parse_args()
+    data = make_dataset(args.users, args.items, args.interactions, n_candidates=2)
+    start = time.perf_counter()
+    interactions, co_items = data.interactions(), data.co_items()
+    print(f'interactions: {len(interactions)}  co_items: {len(co_items)}  '
+          f'index build: {time.perf_counter() - start:.3f}s')
+    train_list = data.train_list
+    n_batches = min(args.batches, len(train_list) // args.bsz)
+    samplers = {'uniform': NegativeSampler(interactions, seed=0)}
+    for ratio in args.ratios:
+        samplers[f'hard {ratio}'] = HardNegativeSampler(interactions, co_items, ratio, seed=0)
+    for name, sampler in samplers.items():
+        start = time.perf_counter()
+        batches = [sampler.batch(train_list[i * args.bsz:(i + 1) * args.bsz]) for i in range(n_batches)]
+        rate = n_batches * args.bsz / (time.perf_counter() - start)
+        s = np.concatenate(batches)
+        if interactions.contains(s[:, 0], s[:, 2]).any():
+            raise Exception(f'{name} returned an item the user interacted with')
+        # 实际抽到的 hard negative 比例: 负样本是不是正样本的共现邻居
+        hard = co_items.contains(s[:, 1], s[:, 2]).mean()
+        print(f'{name:>10}: {rate:12.0f} samples/sec  negatives from co_items: {hard:.3f}')
+
+
+if __name__ == '__main__':
+    main()
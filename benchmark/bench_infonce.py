@@ -0,0 +1,66 @@
+import argparse
+import time
+import torch
+from base_algorithm.device import Backend
+from base_algorithm.losses import info_nce
+from benchmark.memory import peak_memory
+
+parser = argparse.ArgumentParser(description='InfoNCE kernel microbenchmark')
+parser.add_argument('--bsz', default=[512, 1024, 2048, 4096, 10240], type=int, nargs='*',
+                    help='batch sizes to compare', dest='bsz')
+parser.add_argument('--dim', default=64, type=int, help='embedding dim', dest='dim')
+parser.add_argument('--temp_value', default=1.382, type=float, help='temperature', dest='temp_value')
+parser.add_argument('--nce_tile', default=2048, type=int, help='negatives per tile', dest='nce_tile')
+parser.add_argument('--repeat', default=5, type=int, help='timed forward+backward runs', dest='repeat')
+parser.add_argument('--gpu', default=-1, type=int, help='gpu number to use, -1 for cpu', dest='gpu')
+
+
+def legacy_contrastive_loss(tensor_anchor, tensor_pos, tensor_ll, temp):
+    """原来 cr_v3.CR.contrastive_loss 的写法"""
+    pos_score = torch.sum(tensor_anchor * tensor_pos, dim=1)
+    all_score = torch.matmul(tensor_anchor, tensor_ll.t())
+    pos_score_exp = torch.exp(pos_score / temp)
+    all_score_exp = torch.exp(all_score / temp)
+    all_score_exp_sum = torch.sum(all_score_exp, dim=1)
+    return (-torch.log(pos_score_exp / all_score_exp_sum)).mean()
+
+
+def run(loss_fn, tensors, repeat):
+    def step():
+        for t in tensors:
+            t.grad = None
+        loss_fn(*tensors).backward()
+
+    step()  # warm up
+    start = time.perf_counter()
+    for _ in range(repeat):
+        step()
+    return (time.perf_counter() - start) / repeat
+
+
+def main():
+    args = parser.parse_args()
+    backend = Backend(args.gpu)
+    kernels = {
+        'legacy': lambda a, p, c: legacy_contrastive_loss(a, p, c, args.temp_value),
+        'logsumexp': lambda a, p, c: info_nce(a, p, c, args.temp_value),
+        f'tiled({args.nce_tile})': lambda a, p, c: info_nce(a, p, c, args.temp_value, args.nce_tile),
+    }
+    print(f'{backend}  dim: {args.dim}  temp: {args.temp_value}')
+    print(f'{"bsz":>6} {"kernel":>12} {"ms/step":>10} {"peak MB":>10} {"loss":>12}')
+    for bsz in args.bsz:
+        torch.manual_seed(0)
+        tensors = [torch.randn(bsz, args.dim, device=backend.device, requires_grad=True) for _ in range(3)]
+        for name, fn in kernels.items():
+            seconds = run(fn, tensors, args.repeat)
+            peak = peak_memory(lambda: fn(*tensors).backward(), backend.device)
+            loss = float(fn(*tensors).detach())
+            print(f'{bsz:>6} {name:>12} {seconds * 1000:>10.2f} {peak / 2 ** 20:>10.1f} {loss:>12.4f}')
+    # 低温下原来的写法 exp 溢出
+    a, p, c = [torch.randn(256, args.dim, device=backend.device) * 4 for _ in range(3)]
+    print(f'temp 0.05: legacy {float(legacy_contrastive_loss(a, p, c, 0.05))}  '
+          f'tiled {float(info_nce(a, p, c, 0.05, args.nce_tile))}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+import argparse
+import time
+import numpy as np
+import torch
+from sklearn.metrics import ndcg_score
+from base_algorithm.metrics import RankingMetrics, ranking_metrics
+
+parser = argparse.ArgumentParser(description='ranking metrics: sklearn ndcg_score vs streaming top-K engine')
+parser.add_argument('--users', default=[10000, 100000], type=int, nargs='*', help='number of users', dest='users')
+parser.add_argument('--candidates', default=100, type=int, help='candidates per user', dest='candidates')
+parser.add_argument('--positives', default=5, type=int, help='max positives per user', dest='positives')
+parser.add_argument('--chunk', default=4096, type=int, help='users per streaming chunk', dest='chunk')
+
+
+def legacy_ndcg(gt, preds):
+    """原来 Metric.ndcg 的写法, 每个 K 都调一次 ndcg_score"""
+    gt = torch.from_numpy(gt)
+    preds = torch.from_numpy(preds)
+    return [ndcg_score(gt, preds, k=k) for k in [5, 10, 20]]
+
+
+def make_eval(users, candidates, positives, seed=0):
+    rng = np.random.default_rng(seed)
+    gt = np.zeros((users, candidates), dtype=np.float32)
+    n_pos = rng.integers(1, positives + 1, size=users)
+    gt[np.arange(candidates) < n_pos[:, None]] = 1
+    preds = rng.standard_normal((users, candidates)).astype(np.float32) + gt * 0.5
+    return gt, preds
+
+
+def main():
+    args = parser.parse_args()
+    print(f'{"users":>8} {"method":>10} {"seconds":>10}  ndcg@5/10/20')
+    for users in args.users:
+        gt, preds = make_eval(users, args.candidates, args.positives)
+        start = time.perf_counter()
+        reference = legacy_ndcg(gt, preds)
+        legacy = time.perf_counter() - start
+        print(f'{users:>8} {"sklearn":>10} {legacy:>10.3f}  {np.round(reference, 5)}')
+
+        start = time.perf_counter()
+        metrics = RankingMetrics()
+        for lo in range(0, users, args.chunk):
+            # 模拟 iter_scores 一块一块产生的分数
+            metrics.update(gt[lo:lo + args.chunk], torch.from_numpy(preds[lo:lo + args.chunk]))
+        scores = metrics.result()
+        streaming = time.perf_counter() - start
+        print(f'{users:>8} {"streaming":>10} {streaming:>10.3f}  {np.round(scores["ndcg"], 5)}  '
+              f'speedup {legacy / streaming:.1f}x  max diff {np.abs(np.subtract(scores["ndcg"], reference)).max():.2e}')
+        print(f'{"":>8} recall {np.round(scores["recall"], 4)}  hit {np.round(scores["hit"], 4)}  '
+              f'mrr {scores["mrr"]:.4f}')
+    # 没有正样本的行和 sklearn 一样记 0
+    gt, preds = make_eval(1000, args.candidates, args.positives, seed=1)
+    gt[::7] = 0
+    print('rows without positives, max diff:',
+          np.abs(np.subtract(ranking_metrics(gt, preds)['ndcg'], legacy_ndcg(gt, preds))).max())
+    check_ties(args.candidates, args.positives)
+
+
+def check_ties(candidates, positives):
+    """分数大量并列时 (取整到几个档) ndcg 也要和 sklearn 的并列组平均 gain 一致, 不一致就报错"""
+    gt, preds = make_eval(1000, candidates, positives, seed=2)
+    for levels in (2, 5):
+        tied = np.floor(preds * levels / 4).astype(np.float32)
+        diff = np.abs(np.subtract(ranking_metrics(gt, tied)['ndcg'], legacy_ndcg(gt, tied))).max()
+        print(f'tied scores ({levels} levels per 4 units), max diff: {diff:.2e}')
+        if diff > 1e-9:
+            raise Exception(f'ndcg differs from sklearn by {diff} on tied scores')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+import argparse
+import time
+import numpy as np
+import torch
+from base_algorithm.cr import CR
+from base_algorithm.prefetch import BatchPrefetcher
+from benchmark.synthetic import make_dataset
+
+parser = argparse.ArgumentParser(description='epoch throughput: synchronous sampling vs BatchPrefetcher')
+parser.add_argument('--users', default=20000, type=int, help='number of users', dest='users')
+parser.add_argument('--items', default=10000, type=int, help='number of items', dest='items')
+parser.add_argument('--interactions', default=400000, type=int, help='number of interactions', dest='interactions')
+parser.add_argument('--dim', default=64, type=int, help='the dim for item and user', dest='dim')
+parser.add_argument('--bsz', default=2048, type=int, help='batch_size', dest='bsz')
+parser.add_argument('--batches', default=50, type=int, help='batches per timed epoch', dest='batches')
+parser.add_argument('--workers', default=[1, 2, 4], type=int, nargs='*', help='prefetch worker threads', dest='workers')
+parser.add_argument('--gpu', default=-1, type=int, help='gpu number to use, -1 for cpu', dest='gpu')
+parser.add_argument('--legacy_sampler', action='store_true',
+                    help='sample with the old per-row python loop to make sampling the bottleneck')
+
+
+def main():
+    args = parser.parse_args()
+    data = make_dataset(args.users, args.items, args.interactions)
+    run_args = argparse.Namespace(dim=args.dim, lr=0.001, reg=0.01, epochs=1, bsz=args.bsz, gpu=args.gpu,
+                                  ih=False, neg_alpha=None, seed=0)
+    torch.manual_seed(0)
+    model = CR(run_args, data, filename=None)
+    optimizer = torch.optim.Adam(model.parameters(), lr=run_args.lr)
+    train_pt, train_list = data.train_pt, data.train_list
+    n_batches = min(args.batches, len(train_list) // args.bsz)
+
+    def make_batch(i):
+        sub_train_list = train_list[i * args.bsz:(i + 1) * args.bsz, :]
+        if not args.legacy_sampler:
+            return model.sampler.batch(sub_train_list)
+        pairs = []
+        for m, j in sub_train_list:
+            m_neg = j
+            while m_neg in train_pt[m]:
+                m_neg = np.random.randint(model.item_size)
+            pairs.append((m, j, m_neg))
+        return np.array(pairs, dtype=np.int64)
+
+    def step(s):
+        optimizer.zero_grad()
+        uid, iid, jid = s[:, 0], s[:, 1], s[:, 2]
+        item_fixed = model.projection.batch(torch.cat([iid, jid]))
+        loss = model.bpr_loss(uid, iid, jid) + model.regs(uid, iid, jid) \
+            + model.con_loss_matmul(item_fixed, iid, jid)
+        loss.backward()
+        optimizer.step()
+
+    def timed(fn):
+        start = time.perf_counter()
+        fn()
+        if model.backend.accelerated:
+            torch.cuda.synchronize()
+        return time.perf_counter() - start
+
+    def sample_only():
+        for i in range(n_batches):
+            make_batch(i)
+
+    fixed = model.backend.to(torch.from_numpy(make_batch(0)))
+
+    def compute_only():
+        for _ in range(n_batches):
+            step(fixed)
+
+    def synchronous():
+        # 原来 CR.train 的顺序: 采样完一个batch, 拷到设备, 再算
+        for i in range(n_batches):
+            step(model.backend.to(torch.from_numpy(make_batch(i))))
+
+    def prefetched(workers):
+        for s in BatchPrefetcher(make_batch, n_batches, model.backend, workers=workers):
+            step(s)
+
+    samples = n_batches * args.bsz
+    print(f'{model.backend}  batches: {n_batches} x {args.bsz}  sampler: '
+          f'{"legacy loop" if args.legacy_sampler else "NegativeSampler"}')
+    for name, fn in [('sample only', sample_only), ('compute only', compute_only), ('synchronous', synchronous)] + \
+            [(f'prefetch x{w}', lambda w=w: prefetched(w)) for w in args.workers]:
+        print(f'{name:>14}: {samples / timed(fn):12.0f} samples/sec')
+
+
+if __name__ == '__main__':
+    main()
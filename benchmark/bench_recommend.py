@@ -0,0 +1,39 @@
+import argparse
+import time
+import numpy as np
+import torch
+from base_algorithm.interactions import InteractionIndex
+from base_algorithm.scoring import recommend
+from benchmark.synthetic import make_interactions
+
+parser = argparse.ArgumentParser(description='batch top-N recommendation for every user (nightly scoring)')
+parser.add_argument('--users', default=100000, type=int, help='number of users', dest='users')
+parser.add_argument('--items', default=50000, type=int, help='number of items', dest='items')
+parser.add_argument('--interactions', default=2000000, type=int, help='number of interactions', dest='interactions')
+parser.add_argument('--dim', default=64, type=int, help='the dim for item and user', dest='dim')
+parser.add_argument('--n', default=50, type=int, help='top-N', dest='n')
+parser.add_argument('--chunks', default=[256, 1024, 4096], type=int, nargs='*', help='users per matmul',
+                    dest='chunks')
+parser.add_argument('--gpu', default=-1, type=int, help='gpu number to use, -1 for cpu', dest='gpu')
+
+
+def main():
+    args = parser.parse_args()
+    device = torch.device(f'cuda:{args.gpu}' if args.gpu >= 0 and torch.cuda.is_available() else 'cpu')
+    train_list, train_pt = make_interactions(args.users, args.items, args.interactions)
+    index = InteractionIndex.build(train_pt, args.users, args.items)
+    gen = torch.Generator().manual_seed(0)
+    user_table = torch.randn(args.users, args.dim, generator=gen).to(device)
+    item_table = torch.randn(args.items, args.dim, generator=gen).to(device)
+    users = np.arange(args.users)
+    print(f'{args.users} users x {args.items} items, dim {args.dim}, top-{args.n} on {device}')
+    for chunk in args.chunks:
+        for interactions, name in [(None, 'all items'), (index, 'exclude seen')]:
+            start = time.perf_counter()
+            recommend(user_table, item_table, users, args.n, interactions, chunk)
+            elapsed = time.perf_counter() - start
+            print(f'chunk {chunk:>5} {name:>13}: {args.users / elapsed:10.0f} users/sec')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,47 @@
+import argparse
+import time
+import numpy as np
+from base_algorithm.retrieval import ExactIndex, IVFIndex, recall_at_n
+
+parser = argparse.ArgumentParser(description='top-N retrieval: exact blocked brute force vs IVF, recall@N vs queries/sec')
+parser.add_argument('--items', default=200000, type=int, help='number of items', dest='items')
+parser.add_argument('--dim', default=64, type=int, help='the dim for item and user', dest='dim')
+parser.add_argument('--queries', default=5000, type=int, help='number of user queries', dest='queries')
+parser.add_argument('--n', default=20, type=int, help='top-N', dest='n')
+parser.add_argument('--n_lists', default=None, type=int, help='IVF clusters, sqrt(items) if unset', dest='n_lists')
+parser.add_argument('--probes', default=[1, 4, 8, 16, 32, 64], type=int, nargs='*', help='n_probe values',
+                    dest='probes')
+
+
+def clustered(n, dim, clusters=256, noise=0.5, seed=0):
+    """embedding 一般是成簇的, 用高斯混合来模拟 item / user 向量"""
+    rng = np.random.default_rng(seed)
+    centres = rng.normal(size=(clusters, dim))
+    return (centres[rng.integers(clusters, size=n)] + noise * rng.normal(size=(n, dim))).astype(np.float32)
+
+
+def main():
+    args = parser.parse_args()
+    items = clustered(args.items, args.dim)
+    queries = clustered(args.queries, args.dim, seed=1)
+
+    exact = ExactIndex(items)
+    start = time.perf_counter()
+    truth, _ = exact.search(queries, args.n)
+    exact_qps = args.queries / (time.perf_counter() - start)
+    print(f'{args.items} items x {args.dim}, {args.queries} queries, top-{args.n}')
+    print(f'{"exact":>14}: recall@{args.n} 1.0000  {exact_qps:10.0f} queries/sec')
+
+    start = time.perf_counter()
+    ivf = IVFIndex(items, args.n_lists)
+    print(f'ivf build ({ivf.n_lists} lists): {time.perf_counter() - start:.2f}s')
+    for n_probe in args.probes:
+        start = time.perf_counter()
+        found, _ = ivf.search(queries, args.n, n_probe)
+        qps = args.queries / (time.perf_counter() - start)
+        print(f'{f"ivf probe {n_probe}":>14}: recall@{args.n} {recall_at_n(found, truth):.4f}  '
+              f'{qps:10.0f} queries/sec')
+
+
+if __name__ == '__main__':
+    main()
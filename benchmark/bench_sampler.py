@@ -0,0 +1,78 @@
+import argparse
+import time
+import numpy as np
+import torch
+from base_algorithm.sampler import NegativeSampler
+from base_algorithm.interactions import InteractionIndex
+from benchmark.synthetic import make_interactions
+
+parser = argparse.ArgumentParser(description='negative sampler benchmark')
+parser.add_argument('--users', default=50000, type=int, help='number of users', dest='users')
+parser.add_argument('--items', default=20000, type=int, help='number of items', dest='items')
+parser.add_argument('--interactions', default=1000000, type=int, help='number of interactions', dest='interactions')
+parser.add_argument('--bsz', default=10240, type=int, help='batch_size', dest='bsz')
+parser.add_argument('--batches', default=20, type=int, help='batches timed per sampler', dest='batches')
+
+
+def legacy_batches(train_list, train_pt, item_size, batch_size, n_batches):
+    """原来 CR.sample 里逐行拒绝采样的写法"""
+    for i in range(n_batches):
+        pairs = []
+        sub_train_list = train_list[i * batch_size:(i + 1) * batch_size, :]
+        for m, j in sub_train_list:
+            m_neg = j
+            while m_neg in train_pt[m]:
+                m_neg = np.random.randint(item_size)
+            pairs.append((m, j, m_neg))
+        yield torch.LongTensor(pairs)
+
+
+def vectorized_batches(sampler, train_list, batch_size, n_batches):
+    for i in range(n_batches):
+        sub_train_list = train_list[i * batch_size:(i + 1) * batch_size, :]
+        yield torch.from_numpy(sampler.batch(sub_train_list))
+
+
+def samples_per_sec(batches):
+    n = 0
+    start = time.perf_counter()
+    for b in batches:
+        n += len(b)
+    return n / (time.perf_counter() - start)
+
+
+def main():
+    args = parser.parse_args()
+    train_list, train_pt = make_interactions(args.users, args.items, args.interactions)
+    n_batches = min(args.batches, len(train_list) // args.bsz)
+
+    start = time.perf_counter()
+    index = InteractionIndex.build(train_pt, args.users, args.items)
+    build = time.perf_counter() - start
+    sampler = NegativeSampler(index)
+
+    legacy = samples_per_sec(legacy_batches(train_list, train_pt, args.items, args.bsz, n_batches))
+    vectorized = samples_per_sec(vectorized_batches(sampler, train_list, args.bsz, n_batches))
+    print(f'interactions: {len(train_list)}  batches: {n_batches} x {args.bsz}  index build: {build:.3f}s')
+    print(f'legacy loop:      {legacy:12.0f} samples/sec')
+    print(f'NegativeSampler:  {vectorized:12.0f} samples/sec  ({vectorized / legacy:.1f}x)')
+
+    # 成员查询: python 集合逐个 `in` vs CSR 上整批二分
+    rng = np.random.default_rng(1)
+    users = rng.integers(args.users, size=args.bsz * n_batches)
+    items = rng.integers(args.items, size=len(users))
+    start = time.perf_counter()
+    expected = np.array([i in train_pt[u] for u, i in zip(users, items)])
+    python_in = len(users) / (time.perf_counter() - start)
+    start = time.perf_counter()
+    found = index.contains(users, items)
+    batched = len(users) / (time.perf_counter() - start)
+    if not np.array_equal(found, expected):
+        raise Exception('InteractionIndex.contains disagrees with train_pt')
+    print(f'membership `in`:  {python_in:12.0f} queries/sec')
+    print(f'index.contains:   {batched:12.0f} queries/sec  ({batched / python_in:.1f}x)  '
+          f'index: {(index.indptr.nbytes + index.indices.nbytes) / 2 ** 20:.1f} MB')
+
+
+if __name__ == '__main__':
+    main()
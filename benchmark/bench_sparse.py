@@ -0,0 +1,54 @@
+import argparse
+import time
+import torch
+import torch.nn.functional as fun
+from base_algorithm.optim import lookup
+
+parser = argparse.ArgumentParser(description='optimizer step time vs catalogue size: dense vs sparse embedding gradients')
+parser.add_argument('--sizes', default=[10000, 100000, 1000000], type=int, nargs='*',
+                    help='users = items per run', dest='sizes')
+parser.add_argument('--dim', default=64, type=int, help='the dim for item and user', dest='dim')
+parser.add_argument('--bsz', default=2048, type=int, help='batch_size', dest='bsz')
+parser.add_argument('--steps', default=20, type=int, help='timed steps', dest='steps')
+parser.add_argument('--threads', default=None, type=int, help='torch intra-op threads', dest='threads')
+
+OPTIMIZERS = {
+    'adam dense': (False, lambda p: torch.optim.Adam(p, lr=0.001)),
+    'sparse adam': (True, lambda p: torch.optim.SparseAdam(p, lr=0.001)),
+    'adagrad dense': (False, lambda p: torch.optim.Adagrad(p, lr=0.01)),
+    'adagrad sparse': (True, lambda p: torch.optim.Adagrad(p, lr=0.01)),
+}
+
+
+def step_time(size, dim, bsz, steps, sparse, make_optimizer):
+    """bpr loss 一步 (前向, 反向, optimizer.step) 的平均秒数"""
+    gen = torch.Generator().manual_seed(0)
+    users = torch.nn.Parameter(torch.randn(size, dim, generator=gen) * 0.01)
+    items = torch.nn.Parameter(torch.randn(size, dim, generator=gen) * 0.01)
+    optimizer = make_optimizer([users, items])
+    batches = [torch.randint(size, (3, bsz), generator=gen) for _ in range(steps + 1)]
+    for i, (uid, iid, jid) in enumerate(batches):
+        if i == 1:
+            start = time.perf_counter()
+        optimizer.zero_grad()
+        u = lookup(users, uid, sparse)
+        loss = fun.softplus(-(u * (lookup(items, iid, sparse) - lookup(items, jid, sparse))).sum(dim=1)).sum()
+        loss.backward()
+        optimizer.step()
+    return (time.perf_counter() - start) / steps
+
+
+def main():
+    args = parser.parse_args()
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    print(f'batch {args.bsz}  dim {args.dim}  ms per step')
+    print(f'{"users=items":>12}' + ''.join(f'{name:>16}' for name in OPTIMIZERS))
+    for size in args.sizes:
+        row = [step_time(size, args.dim, args.bsz, args.steps, sparse, make) * 1000
+               for sparse, make in OPTIMIZERS.values()]
+        print(f'{size:>12}' + ''.join(f'{t:16.2f}' for t in row))
+
+
+if __name__ == '__main__':
+    main()
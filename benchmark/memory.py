@@ -0,0 +1,57 @@
+import ctypes
+import torch
+
+# glibc mallopt 的 M_MMAP_THRESHOLD
+_M_MMAP_THRESHOLD = -3
+_mmap_fixed = False
+
+
+def _fix_mmap_threshold(threshold=1 << 20):
+    """
+    glibc 默认的 mmap 阈值是动态的, 释放过一个大块以后会涨到 32MB, 之后的张量从堆里复用,
+    RSS 不再增长, 峰值就量成 0; 固定阈值后 >= 1MB 的张量都单独 mmap, free 时立刻还给系统
+    """
+    global _mmap_fixed
+    if _mmap_fixed:
+        return
+    try:
+        ctypes.CDLL('libc.so.6').mallopt(_M_MMAP_THRESHOLD, threshold)
+    except OSError:
+        pass
+    _mmap_fixed = True
+
+
+def _vm_hwm():
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmHWM'):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def _vm_rss():
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmRSS'):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def peak_memory(fn, device):
+    """
+    跑一次 fn, 返回这期间新增的峰值内存 (bytes)
+    cuda 上用 max_memory_allocated, cpu 上先清零 /proc/self 的 VmHWM 再读 (只支持 linux), 分辨率约 1MB
+    """
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+        torch.cuda.reset_peak_memory_stats(device)
+        base = torch.cuda.memory_allocated(device)
+        fn()
+        torch.cuda.synchronize(device)
+        return torch.cuda.max_memory_allocated(device) - base
+    _fix_mmap_threshold()
+    with open('/proc/self/clear_refs', 'w') as f:
+        f.write('5')
+    base = _vm_rss()
+    fn()
+    return _vm_hwm() - base
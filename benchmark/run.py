@@ -0,0 +1,172 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import numpy as np
+import torch
+from base_algorithm.cr import CR
+from base_algorithm.metrics import ranking_metrics, auc_score
+from contrastive_rec.cr_v3 import CR as CRv3
+from benchmark.synthetic import make_dataset
+
+# (users, items, interactions)
+SCALES = {
+    'small': (2000, 1000, 20000),
+    'medium': (20000, 10000, 200000),
+    'large': (100000, 50000, 2000000),
+}
+
+parser = argparse.ArgumentParser(description='reproducible cpu benchmark of the training and evaluation hot paths, '
+                                             'results as JSON for tracking regressions between versions')
+parser.add_argument('--scales', default=['small', 'medium'], nargs='*', choices=list(SCALES) + ['custom'],
+                    help='preset data scales to run, custom uses --users/--items/--interactions', dest='scales')
+parser.add_argument('--users', default=50000, type=int, help='number of users for the custom scale', dest='users')
+parser.add_argument('--items', default=20000, type=int, help='number of items for the custom scale', dest='items')
+parser.add_argument('--interactions', default=500000, type=int,
+                    help='number of interactions for the custom scale', dest='interactions')
+parser.add_argument('--candidates', default=100, type=int, help='candidates per evaluated user', dest='candidates')
+parser.add_argument('--dim', default=64, type=int, help='the dim for item and user', dest='dim')
+parser.add_argument('--bsz', default=512, type=int,
+                    help='batch_size, as in main_c (con_loss builds a bsz^3 tensor, keep it small)', dest='bsz')
+parser.add_argument('--repeat', default=5, type=int, help='timed repetitions per case', dest='repeat')
+parser.add_argument('--warmup', default=1, type=int, help='untimed repetitions before timing', dest='warmup')
+parser.add_argument('--threads', default=None, type=int, help='torch intra-op threads', dest='threads')
+parser.add_argument('--seed', default=0, type=int, help='seed of the data, the models and the batch order',
+                    dest='seed')
+parser.add_argument('--output', default=None, type=str, help='write the JSON report here instead of stdout',
+                    dest='output')
+parser.add_argument('--baseline', default=None, type=str,
+                    help='JSON report of an earlier version, prints the median time ratio of every case',
+                    dest='baseline')
+
+
+def measure(fn, repeat, warmup):
+    """fn 先跑 warmup 次不计时, 再计时跑 repeat 次, 返回秒数的统计"""
+    for _ in range(warmup):
+        fn()
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        seconds.append(time.perf_counter() - start)
+    return {'median': float(np.median(seconds)), 'min': min(seconds), 'mean': float(np.mean(seconds)),
+            'repeat': repeat}
+
+
+def first_batch(model):
+    generator = model.sample()
+    s = next(generator)
+    generator.close()
+    # sample() 的 batch 在 BatchPlanner 复用的 buffer 里, 之后的 epoch 会覆盖它
+    return s.clone()
+
+
+def epoch_of_batches(model):
+    """sample() 的一整个 epoch: 打乱, 抽负样本, 预取, 只取 batch 不训练"""
+    generator = model.sample()
+    batches = 0
+    while next(generator) is not None:
+        batches += 1
+    return batches
+
+
+def cases(data, args):
+    """{名字: 无参数的函数}, 每个函数做一次被计时的操作"""
+    run_args = argparse.Namespace(dim=args.dim, lr=0.001, reg=0.01, epochs=1, bsz=args.bsz, gpu=-1, ih=False,
+                                  hard_ratio=0.0, neg_alpha=None, seed=args.seed, con_weight=0.1, reg_weight=0.7,
+                                  temp_value=1.382, nce_tile=2048, threads=args.threads)
+    torch.manual_seed(args.seed)
+    cr = CR(run_args, data, filename=None)
+    cr_v3 = CRv3(run_args, data, filename=None)
+    s = first_batch(cr)
+    uid, iid, jid = s[:, 0], s[:, 1], s[:, 2]
+    pairs = torch.cat([iid, jid])
+
+    def backward(loss):
+        # 训练里的一步: item_mlp 投影 (con loss 才要) + loss 前向 + 反向
+        def run():
+            cr.zero_grad()
+            loss().backward()
+        return run
+
+    def contrastive_loss():
+        cr_v3.zero_grad()
+        anchor, pos = cr_v3.item_matrix[iid], cr_v3.user_matrix[uid]
+        cr_v3.contrastive_loss(anchor, pos, cr_v3.user_matrix[torch.unique(uid)]).backward()
+
+    u = torch.arange(cr.user_size)
+    results = cr.compute_results(u, data.test_samples)
+    gt = data.test_gt
+    return {
+        'sample': lambda: epoch_of_batches(cr),
+        'item_mlp': lambda: cr.projection.batch(pairs),
+        'bpr_loss': backward(lambda: cr.bpr_loss(uid, iid, jid)),
+        'con_loss': backward(lambda: cr.con_loss(cr.projection.batch(pairs), uid, iid, jid)),
+        'con_loss_matmul': backward(lambda: cr.con_loss_matmul(cr.projection.batch(pairs), iid, jid)),
+        'contrastive_loss': contrastive_loss,
+        'compute_results': lambda: cr.compute_results(u, data.test_samples),
+        'ranking_metrics': lambda: ranking_metrics(gt, results),
+        'auc_score': lambda: auc_score(gt, results),
+        'evaluate': cr.evaluate,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(report, baseline):
+    """每个 (scale, case) 的 median 和 baseline 的比值, > 1 就是变慢了"""
+    print(f'{"scale":>8} {"case":>18} {"baseline s":>12} {"current s":>12} {"ratio":>8}', file=sys.stderr)
+    for scale, results in report['results'].items():
+        for name, stats in results['cases'].items():
+            old = baseline.get('results', {}).get(scale, {}).get('cases', {}).get(name)
+            if old is None:
+                continue
+            ratio = stats['median'] / old['median']
+            print(f'{scale:>8} {name:>18} {old["median"]:>12.4f} {stats["median"]:>12.4f} {ratio:>8.2f}',
+                  file=sys.stderr)
+
+
+def main():
+    args = parser.parse_args()
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    report = {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'torch': torch.__version__,
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'threads': torch.get_num_threads(),
+        'config': {k: v for k, v in vars(args).items() if k not in ('output', 'baseline')},
+        'results': {},
+    }
+    for scale in args.scales:
+        users, items, interactions = SCALES.get(scale, (args.users, args.items, args.interactions))
+        data = make_dataset(users, items, interactions, n_candidates=args.candidates, seed=args.seed)
+        results = {'users': users, 'items': items, 'interactions': len(data.train_list), 'cases': {}}
+        for name, fn in cases(data, args).items():
+            results['cases'][name] = measure(fn, args.repeat, args.warmup)
+            print(f'{scale:>8} {name:>18}: {results["cases"][name]["median"] * 1000:10.2f} ms', file=sys.stderr)
+        report['results'][scale] = results
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(report, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+import numpy as np
+import torch
+
+
+def make_interactions(user_size, item_size, n_interactions, alpha=0.8, seed=0):
+    """
+    随机生成 (user, item) 交互, item 按 rank^-alpha 的长尾分布抽,
+    返回和 LoadData 一样的 train_list (N, 2) 和 train_pt (user -> item集合)
+    """
+    rng = np.random.default_rng(seed)
+    weights = 1.0 / np.arange(1, item_size + 1) ** alpha
+    users = rng.integers(user_size, size=n_interactions)
+    items = rng.choice(item_size, size=n_interactions, p=weights / weights.sum())
+    train_list = np.unique(np.stack([users, items], axis=1), axis=0)
+    train_pt = {u: set() for u in range(user_size)}
+    for u, i in train_list:
+        train_pt[u].add(i)
+    rng.shuffle(train_list)
+    return train_list, train_pt
+
+
+def co_occurrence(train_list, item_size, k=10):
+    """每个 item 和它共现次数最多的 k 个 item (同一个用户交互过), 和 co_items.pt 一样是 item -> list"""
+    from scipy import sparse
+    users = train_list[:, 0]
+    x = sparse.csr_matrix((np.ones(len(train_list)), (users, train_list[:, 1])),
+                          shape=(users.max() + 1, item_size))
+    counts = (x.T @ x).tolil()
+    counts.setdiag(0)
+    counts = counts.tocsr()
+    neighbours = {}
+    for i in range(item_size):
+        row = counts.indices[counts.indptr[i]:counts.indptr[i + 1]]
+        weights = counts.data[counts.indptr[i]:counts.indptr[i + 1]]
+        neighbours[i] = row[np.argsort(-weights, kind='stable')[:k]].tolist()
+    return neighbours
+
+
+def make_dataset(user_size, item_size, n_interactions, feature_dim=64, n_candidates=100, seed=0):
+    """
+    合成一个完整的 LoadData: 训练交互, item特征, 以及 val/test/warm/cold 的候选集和gt
+    每个用户的候选集里第一个是正样本, 其余随机
+    """
+    from base_algorithm.load import LoadData
+    rng = np.random.default_rng(seed)
+    train_list, train_pt = make_interactions(user_size, item_size, n_interactions, seed=seed)
+    item_set = rng.normal(size=(item_size, feature_dim))
+
+    def split(users):
+        samples = rng.integers(item_size, size=(len(users), n_candidates))
+        gt = np.zeros((len(users), n_candidates), dtype=np.int64)
+        gt[:, 0] = 1
+        return samples, gt
+
+    all_users = np.arange(user_size)
+    warm_u = torch.from_numpy(all_users[::2].copy())
+    cold_u = torch.from_numpy(all_users[1::2].copy())
+    test_samples, test_gt = split(all_users)
+    val_samples, val_gt = split(all_users)
+    test_warm_samples, test_warm_gt = split(warm_u)
+    test_cold_samples, test_cold_gt = split(cold_u)
+    val_warm_samples, val_warm_gt = split(warm_u)
+    val_cold_samples, val_cold_gt = split(cold_u)
+    hard_negatives = co_occurrence(train_list, item_size)
+    return LoadData(list(range(user_size)), item_set, train_pt, train_list,
+                    test_cold_gt, test_cold_samples, cold_u, test_samples,
+                    test_warm_gt, test_warm_samples, warm_u,
+                    val_cold_gt, val_cold_samples, cold_u,
+                    val_warm_gt, val_warm_samples, warm_u,
+                    val_samples, val_gt, test_gt, hard_negatives)
@@ -1,11 +1,21 @@
 import torch
+import torch.multiprocessing as mp
 import argparse
 from tqdm import tqdm
 import torch.nn as nn
 import torch.nn.functional as fun
 import numpy as np
-from sklearn.metrics import roc_auc_score, ndcg_score, \
-    recall_score, precision_score, average_precision_score
+from sklearn.metrics import recall_score, precision_score, average_precision_score
+from base_algorithm.sampler import NegativeSampler, HardNegativeSampler, PopularityNegativeSampler, epoch_batches
+from base_algorithm.interactions import InteractionIndex
+from base_algorithm.device import Backend
+from base_algorithm.batching import BatchPlanner
+from base_algorithm.metrics import ranking_metrics, auc_score
+from base_algorithm.distributed import shard_planner
+from base_algorithm.optim import lazy_adagrad_
+from base_algorithm.export import export_embeddings
+from base_algorithm.profiling import Profiler, DISABLED
+from base_algorithm.metrics_sink import MetricsSink
 
 parser = argparse.ArgumentParser(description='PyTorch ImageNet Training')
 parser.add_argument('--lr', '--learning-rate', default=0.01, type=float,
@@ -16,15 +26,35 @@ parser.add_argument('--reg', '--regularization', default=0.001, type=float,
                     metavar='reg', help='regularization', dest='reg')
 parser.add_argument('--epoch', '--epoch number', default=100, type=int,
                     metavar='epoch', help='epoch', dest='epoch')
+parser.add_argument('--gpu', default=0, type=int,
+                    metavar='GPU', help='gpu number to use, -1 for cpu', dest='gpu')
+parser.add_argument('--threads', default=None, type=int,
+                    metavar='threads', help='torch intra-op threads when running on cpu', dest='threads')
+parser.add_argument('--hard_ratio', default=0.0, type=float,
+                    metavar='hard_ratio', help='share of co_items negatives, 0 for uniform', dest='hard_ratio')
+parser.add_argument('--neg_alpha', default=None, type=float,
+                    metavar='neg_alpha', help='draw negatives by item popularity^alpha, uniform if unset', dest='neg_alpha')
+parser.add_argument('--seed', default=None, type=int,
+                    metavar='seed', help='seed of the per-epoch batch order and the negative sampling', dest='seed')
+parser.add_argument('--hogwild', default=0, type=int,
+                    metavar='hogwild', help='processes for lock-free parallel training, 0 for one process', dest='hogwild')
+parser.add_argument('--timing', action='store_true',
+                    help='time sample/loss/backward/step/eval per epoch and print the breakdown', dest='timing')
+parser.add_argument('--profile', default=None, type=str,
+                    metavar='profile', help='directory for a torch.profiler trace of the first batches', dest='profile')
+parser.add_argument('--profile_steps', default=20, type=int,
+                    metavar='profile_steps', help='batches recorded in the torch.profiler trace', dest='profile_steps')
+parser.add_argument('--log', default=None, type=str,
+                    metavar='log', help='JSON-lines metrics log for the per-epoch timing breakdown', dest='log')
 
 
 class Model(nn.Module):
 
     def compute_results(self, u, test_samples):
-        u = u.cuda()
+        u = u.to(self.device)
         if type(test_samples) != torch.Tensor:
             test_samples = torch.from_numpy(test_samples)
-        test_samples = test_samples.cuda()
+        test_samples = test_samples.to(self.device)
         rs = []
         for i in test_samples.T:
             # lt = torch.LongTensor(i)
@@ -38,36 +68,8 @@ class Model(nn.Module):
             raise Exception('nan')
         return results
 
-    @staticmethod
-    def auc_calculate(labels, pre_ds, n_bins=100):
-        print('.auc')
-        labels = torch.from_numpy(labels)
-        labels = labels.cuda()
-        result_tensor = torch.Tensor(len(labels))
-        pre_ds = torch.from_numpy(pre_ds)
-        pre_ds = pre_ds.cuda()
-        # 计算tp，阈值设置为0.0，即预测集中，值大于0的样例设置为1，小于0的样例 设置为0
-        one = torch.ones_like(pre_ds)
-        zero = torch.zeros_like(pre_ds)
-        boundary = torch.mean(pre_ds)
-        pre_ds = torch.where(pre_ds > boundary, one, zero)
-        positive_lens = torch.sum(labels, dim=1)
-        negative_lens = torch.abs(torch.sum(labels - 1, dim=1))
-        positive_samples = torch.einsum('ij, ij->i', [labels, pre_ds])
-        negative_samples = torch.einsum('ij, ij->i', [torch.abs[labels - 1], pre_ds])
-        positive_results = positive_samples / positive_lens
-        negative_results = negative_samples / negative_lens
-        results = torch.mean((negative_results + positive_results) / 2.0)
-        results = results.cpu()
-        return np.array(results)
-
     def compute_scores(self, gt, preds):
-        ret = {
-            'auc':  self.auc_calculate(gt, preds),
-            'ndcg': Metric.ndcg(gt, preds)
-
-        }
-        return ret
+        return ranking_metrics(gt, preds)
 
     def __logscore(self, scores):
         metrics = list(scores.keys())
@@ -78,10 +80,10 @@ class Model(nn.Module):
     def test(self):
         print('----- test -----begin-----')
         u = torch.LongTensor(range(self.user_size))
-        u = u.cuda()
+        u = u.to(self.device)
         test_arr = self.test_samples
         test_tensor = torch.from_numpy(test_arr)
-        test_tensor = test_tensor.cuda()
+        test_tensor = test_tensor.to(self.device)
         results = self.compute_results(u, test_tensor)
         scores = self.compute_scores(self.test_gt, results)
         self.__logscore(scores)
@@ -98,7 +100,7 @@ class Model(nn.Module):
     def test_warm(self):
         print('----- test_warm -----begin-----')
         u = self.test_warm_u
-        u = u.cuda()
+        u = u.to(self.device)
         results = self.compute_results(u, self.test_warm_samples)
         scores = self.compute_scores(self.test_warm_gt, results)
         self.__logscore(scores)
@@ -107,7 +109,7 @@ class Model(nn.Module):
     def test_cold(self):
         print('----- test_cold -----begin-----')
         u = self.test_cold_u
-        u = u.cuda()
+        u = u.to(self.device)
         results = self.compute_results(u, self.test_cold_samples)
         scores = self.compute_scores(self.test_cold_gt, results)
         self.__logscore(scores)
@@ -122,8 +124,9 @@ class Model(nn.Module):
     def predict(self):
         raise Exception('no implementation')
 
-    def save(self):
-        raise Exception('no implementation')
+    def save(self, path, dtype='float32'):
+        """user/item embedding 导出成可以 mmap 的文件 (float32/float16/int8), 见 base_algorithm.export"""
+        export_embeddings(path, self.user_matrix.weight, self.item_matrix.weight, dtype=dtype)
 
 
 class Metric:
@@ -141,19 +144,13 @@ class Metric:
     @staticmethod
     def ndcg(gt, preds):
         print('.ndcg')
-        gt = torch.from_numpy(gt)
-        preds = torch.from_numpy(preds)
         K = [5, 10, 20, 50, 100, 150, 200]
-        return [ndcg_score(gt, preds, k=k) for k in K]  # 看这个地方具体怎么写的 修改这个地方的具体实现
+        return ranking_metrics(gt, preds, K)['ndcg']  # 一次 argpartition 同时得到所有 K
 
     @staticmethod
     def auc(gt, preds):
         print('.auc')
-        gt = torch.from_numpy(gt)
-        gt = gt.cuda()
-        preds = torch.from_numpy(preds)
-        preds = preds.cuda()
-        return roc_auc_score(gt, preds, average='samples')  # 两个nd-array 进行auc计算
+        return auc_score(gt, preds)  # 每个user秩和算精确的auc, 再平均
 
 
 class BPR(Model):
@@ -163,8 +160,16 @@ class BPR(Model):
                  reg,
                  k,
                  epoch,
-                 data):
+                 data,
+                 backend=None,
+                 hard_ratio=0.0,
+                 neg_alpha=None,
+                 seed=None,
+                 profiler=None,
+                 sink=None):
         super(BPR, self).__init__()
+        self.backend = backend or Backend()
+        self.device = self.backend.device
 
         self.k = k
         self.lr = lr
@@ -175,7 +180,21 @@ class BPR(Model):
         self.train_pt = data.train_pt
         self.train_list = data.train_list
         self.sz = self.train_list.shape[0]
+        interactions = InteractionIndex.build(self.train_pt, self.user_size, self.item_size)
+        if hard_ratio > 0:
+            co_items = InteractionIndex.build(data.hard_negatives, self.item_size, self.item_size)
+            self.sampler = HardNegativeSampler(interactions, co_items, hard_ratio, seed=seed)
+        elif neg_alpha is not None:
+            counts = np.bincount(np.asarray(self.train_list[:, 1]), minlength=self.item_size)
+            self.sampler = PopularityNegativeSampler(interactions, counts, neg_alpha, seed=seed)
+        else:
+            self.sampler = NegativeSampler(interactions, seed=seed)
         self.batch_size = 512  # 这个参数应该从args里面获取啊
+        self.seed = seed
+        self.planner = BatchPlanner(self.train_list, self.batch_size, seed=seed)
+        # 分阶段计时 (profiling.Profiler) 和写分阶段耗时的指标日志 (metrics_sink.MetricsSink), 都可以不给
+        self.profiler = profiler or DISABLED
+        self.sink = sink
         self.test_cold_gt = data.test_cold_gt
         self.test_cold_samples = data.test_cold_samples
         self.test_cold_u = data.test_cold_u
@@ -193,13 +212,15 @@ class BPR(Model):
         self.val_gt = data.val_gt
         self.test_gt = data.test_gt
 
-        self.user_matrix = nn.Embedding(self.user_size, self.k)  # k default value is 32
-        self.user_matrix = self.user_matrix.cuda()
+        # sparse=True: 梯度只含 batch 碰到的行, Adagrad 只更新这些行和它们的累计平方和
+        # (weight_decay=0 时和 dense 梯度的结果一样, 没碰到的行本来就不会变)
+        self.user_matrix = nn.Embedding(self.user_size, self.k, sparse=True)  # k default value is 32
+        self.user_matrix = self.user_matrix.to(self.device)
         # user_matrix 可以视为用户关于某个latent factor的权重
         nn.init.normal_(self.user_matrix.weight, std=0.01)  # 进行正则化操作
 
-        self.item_matrix = nn.Embedding(self.item_size, self.k)  # k default value is 32
-        self.item_matrix = self.item_matrix.cuda()
+        self.item_matrix = nn.Embedding(self.item_size, self.k, sparse=True)  # k default value is 32
+        self.item_matrix = self.item_matrix.to(self.device)
         # item_matrix 可以视为item在某个latent factor的值的大小
         nn.init.normal_(self.item_matrix.weight, std=0.01)  # 进行正则化操作
         # self.item_matrix.weight.data[list(self.cold_start), :] = 0
@@ -242,41 +263,106 @@ class BPR(Model):
         optimizer = torch.optim.Adagrad([self.user_matrix.weight, self.item_matrix.weight],
                                         lr=learning_rate, weight_decay=0)
         epochs = self.epochs
+        self.profiler.start()
         for epoch in tqdm(range(epochs)):
-            generator = self.sample()
-            while True:
-                optimizer.zero_grad()
+            self.train_epoch(optimizer)
+            if epoch % 5 == 0 and epoch > 1:
+                # print(f 'self.user.weight is {self.user_matrix.weight} \n
+                # self.item.weight is {self.item_matrix.weight}')
+                print(f'epoch is {epoch}')
+                for split in (self.val, self.test, self.test_warm, self.test_cold):
+                    with self.profiler.stage('eval.' + split.__name__):
+                        split()
+            self.log_timings(epoch)
+        self.profiler.stop()
+        if self.sink is not None:
+            self.sink.close()
+
+    def log_timings(self, epoch):
+        """profiler 开着时打印这个 epoch 的分阶段耗时, 有 sink 的话同时写进指标日志"""
+        if not self.profiler.enabled:
+            return
+        print(f'=={epoch}===> {self.profiler}')
+        timings = self.profiler.epoch_timings()
+        if self.sink is not None:
+            self.sink.log_timings(epoch, timings)
+
+    def train_epoch(self, optimizer):
+        profiler = self.profiler
+        generator = self.sample()
+        while True:
+            optimizer.zero_grad()
+            with profiler.stage('sample'):
                 s = next(generator)
-                if s is None:
-                    break
-                uid, iid, jid = s[:, 0], s[:, 1], s[:, 2]
-                uid = uid.cuda()
-                iid = iid.cuda()
-                jid = jid.cuda()
+            if s is None:
+                break
+            uid, iid, jid = s[:, 0], s[:, 1], s[:, 2]
+            with profiler.stage('loss'):
                 loss = self.bpr_loss(uid, iid, jid) + self.regs(uid, iid, jid)
 
+            with profiler.stage('backward'):
                 loss.backward()
+            with profiler.stage('step'):
                 optimizer.step()
-            if epoch % 5 == 0 and epoch > 1:
-                # print(f 'self.user.weight is {self.user_matrix.weight} \n
-                # self.item.weight is {self.item_matrix.weight}')
-                print(f'epoch is {epoch}')
-                self.val(), self.test(), self.test_warm(), self.test_cold()
+            profiler.step(len(s))
+
+    def train_hogwild(self, workers):
+        """
+        hogwild: workers 个进程共享 user/item 矩阵和 Adagrad 的累计平方和, 各自在 train_list 的分片上采样,
+        更新不加锁; 每 5 个 epoch 回到主进程评估一次
+        """
+        accumulators = self.share_for_hogwild()
+        for start in tqdm(range(0, self.epochs, 5)):
+            epochs = min(5, self.epochs - start)
+            self.hogwild_epochs(workers, epochs, accumulators, start)
+            print(f'epoch is {start + epochs}')
+            self.val(), self.test(), self.test_warm(), self.test_cold()
+
+    def share_for_hogwild(self):
+        """把 user/item 矩阵挪到共享内存, 返回和它们一样大的 Adagrad 累计平方和 (也在共享内存里)"""
+        if self.backend.accelerated:
+            raise Exception('hogwild training runs on cpu')
+        self.share_memory()
+        return [torch.zeros_like(self.user_matrix.weight).share_memory_(),
+                torch.zeros_like(self.item_matrix.weight).share_memory_()]
+
+    def hogwild_epochs(self, workers, epochs, accumulators, start=0):
+        """起 workers 个进程各跑 epochs 个 epoch, 等它们都结束; start 只用来给每一轮不同的随机种子"""
+        processes = [mp.Process(target=hogwild_worker, args=(self, accumulators, rank, workers, epochs, start))
+                     for rank in range(workers)]
+        for p in processes:
+            p.start()
+        for p in processes:
+            p.join()
+        if any(p.exitcode != 0 for p in processes):
+            raise Exception('hogwild worker failed')
 
     # , self.train_list, self.sz, self.batch_size, self.train, self.item_size
     def sample(self):
-        np.random.shuffle(self.train_list)
-        for i in range(self.sz // self.batch_size):
-            pairs = []
-            sub_train_list = self.train_list[i * self.batch_size:(i + 1) * self.batch_size, :]
-            for m, j in sub_train_list:
-                m_neg = j
-                while m_neg in self.train_pt[m]:
-                    m_neg = np.random.randint(self.item_size)
-                pairs.append((m, j, m_neg))
-
-            yield torch.LongTensor(pairs)  # this position added cuda for test
-        yield None
+        return epoch_batches(self.planner, self.sampler, self.backend)
+
+
+def hogwild_worker(model, accumulators, rank, workers, epochs, start):
+    """
+    一个 hogwild 进程: 单线程, 自己抽 batch 和负样本, 反向得到稀疏梯度后用 lazy_adagrad_
+    直接改共享内存里的行, 和其它进程之间不同步
+    """
+    torch.set_num_threads(1)
+    # fork 出来的 rng 状态都一样, 每个进程每一轮重新播种
+    rng = np.random.default_rng(None if model.seed is None else [model.seed, start, rank])
+    planner = shard_planner(model.train_list, model.batch_size, rank, workers)
+    planner.rng = model.sampler.rng = rng
+    user_acc, item_acc = accumulators
+    for _ in range(epochs):
+        planner.shuffle()
+        for i in range(len(planner)):
+            s = torch.from_numpy(model.sampler.fill(planner.gather(i, width=3)))
+            uid, iid, jid = s[:, 0], s[:, 1], s[:, 2]
+            model.zero_grad()
+            loss = model.bpr_loss(uid, iid, jid) + model.regs(uid, iid, jid)
+            loss.backward()
+            lazy_adagrad_(model.user_matrix.weight, user_acc, model.user_matrix.weight.grad, model.lr)
+            lazy_adagrad_(model.item_matrix.weight, item_acc, model.item_matrix.weight.grad, model.lr)
 
 
 class Dataset:
@@ -299,7 +385,8 @@ class Dataset:
                  val_warm_u,
                  val_samples,
                  val_gt,
-                 test_gt):
+                 test_gt,
+                 hard_negatives=None):
         super(Dataset, self).__init__()
         self.user_set = user_set
         self.item_set = item_set
@@ -321,6 +408,7 @@ class Dataset:
         self.val_samples = val_samples
         self.val_gt = val_gt
         self.test_gt = test_gt
+        self.hard_negatives = hard_negatives
 
 
 def main():
@@ -357,6 +445,7 @@ def main():
     val_samples = torch.load('.\\pt\\val_samples.pt')
     val_gt = torch.load('.\\pt\\val_gt.pt')
     test_gt = torch.load('.\\pt\\test_gt.pt')
+    hard_negatives = torch.load('.\\pt\\co_items.pt') if args.hard_ratio > 0 else None
 
     data = Dataset(user_set,
                    item_set,
@@ -377,18 +466,26 @@ def main():
                    val_warm_u,
                    val_samples,
                    val_gt,
-                   test_gt)
-    device = torch.device("cuda:0")
-    torch.cuda.device(device)
+                   test_gt,
+                   hard_negatives)
+    backend = Backend(args.gpu, args.threads)
     bpr = BPR(lr_main,
               reg_main,
               k_main,
               epoch_main,
-              data
+              data,
+              backend,
+              args.hard_ratio,
+              args.neg_alpha,
+              args.seed,
+              Profiler.from_args(args, backend.device),
+              MetricsSink(args.log) if args.log else None
               )
-    print('bpr is ready')
-    bpr = bpr.cuda()
-    bpr.train()
+    print(f'bpr is ready on {backend}')
+    if args.hogwild > 0:
+        bpr.train_hogwild(args.hogwild)
+    else:
+        bpr.train()
 
 
 if __name__ == '__main__':
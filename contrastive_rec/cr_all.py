@@ -1,9 +1,17 @@
+import threading
 import torch
 import torch.nn as nn
 import numpy as np
-from sklearn.metrics import roc_auc_score, ndcg_score
 import argparse
-import os
+from base_algorithm.projection import ProjectionCache
+from base_algorithm.device import Backend
+from base_algorithm.batching import BatchPlanner
+from base_algorithm.sampler import epoch_batches
+from base_algorithm.losses import info_nce
+from base_algorithm.metrics import ranking_metrics, auc_score
+from base_algorithm.packed import load_dataset
+from base_algorithm.metrics_sink import MetricsSink
+from base_algorithm.profiling import Profiler
 
 parser = argparse.ArgumentParser(description='contrastive training for recommendation')
 parser.add_argument('--ih', '--if_hard', default=False, type=bool,
@@ -20,23 +28,71 @@ parser.add_argument('--reg_weight', '--reg_weight', default=0.5, type=float,
                     metavar='reg_weight', help='reg_weight', dest='reg_weight')
 parser.add_argument('--temp_value', '--temp_value', default=2, type=float,
                     metavar='temp_value', help='temp_value', dest='temp_value')
+parser.add_argument('--nce_tile', default=2048, type=int,
+                    metavar='nce_tile', help='negatives per tile in the contrastive loss, 0 for no tiling', dest='nce_tile')
 parser.add_argument('--epochs', '--epoch_number', default=200, type=int,
                     metavar='epochs', help='training epochs', dest='epochs')
 parser.add_argument('--dp', '--data_path', default='../../dataset/amazon/amazon/', type=str,
-                    metavar='dp', help='the path of dataset', dest='dp')
+                    metavar='dp', help='dataset directory of *.pt files or a packed dataset file', dest='dp')
 parser.add_argument('--gpu', default=0, type=int,
-                    metavar='GPU', help='gpu number to use', dest='gpu')
+                    metavar='GPU', help='gpu number to use, -1 for cpu', dest='gpu')
+parser.add_argument('--threads', default=None, type=int,
+                    metavar='threads', help='torch intra-op threads when running on cpu', dest='threads')
+parser.add_argument('--workers', default=2, type=int,
+                    metavar='workers', help='background threads preparing training batches', dest='workers')
+parser.add_argument('--prefetch', default=8, type=int,
+                    metavar='prefetch', help='max number of prepared batches waiting in the queue', dest='prefetch')
+parser.add_argument('--seed', default=None, type=int,
+                    metavar='seed', help='seed of the per-epoch batch order', dest='seed')
 parser.add_argument('--bsz', default=10240, type=int,
                     metavar='bsz', help='batch_size', dest='bsz')
+parser.add_argument('--timing', action='store_true',
+                    help='time sample/item_mlp/loss/backward/step/eval per epoch and log the breakdown', dest='timing')
+parser.add_argument('--profile', default=None, type=str,
+                    metavar='profile', help='directory for a torch.profiler trace of the first batches', dest='profile')
+parser.add_argument('--profile_steps', default=20, type=int,
+                    metavar='profile_steps', help='batches recorded in the torch.profiler trace', dest='profile_steps')
+
+
+# 保护 Model.metrics_sink 的懒创建
+_sink_lock = threading.Lock()
 
 
 class Model(nn.Module):
 
+    # 训练循环在评估前设置, val()/test() 写的记录用它标 epoch
+    epoch = None
+    sink = None
+
+    def metrics_sink(self):
+        """
+        JSON-lines 的指标日志 (见 metrics_sink.py), 第一次用到时打开 self.filename, 之后一直用这一个句柄
+        AsyncEvaluator 的线程 (log_report) 和训练线程 (log_timings) 都可能第一个用到, 加锁保证只打开一个
+        """
+        if self.sink is None:
+            with _sink_lock:
+                if self.sink is None:
+                    self.sink = MetricsSink(self.filename)
+        return self.sink
+
+    def close_metrics(self):
+        """把还在队列里的记录写完并关掉文件, 训练结束时调用"""
+        if self.sink is not None:
+            self.sink.close()
+            self.sink = None
+
+    def log_timings(self, epoch, profiler):
+        """profiler 开着时把这个 epoch 的分阶段耗时写进指标日志, 终端上打印一行"""
+        if not profiler.enabled:
+            return
+        print(f'=={epoch}===> {profiler}')
+        self.metrics_sink().log_timings(epoch, profiler.epoch_timings())
+
     def compute_results(self, u, test_samples):
-        u = u.cuda()
+        u = u.to(self.device)
         if type(test_samples) != torch.Tensor:
             test_samples = torch.from_numpy(test_samples)
-        test_samples = test_samples.cuda()
+        test_samples = test_samples.to(self.device)
         rs = []
         for i in test_samples.T:
             # lt = torch.LongTensor(i)
@@ -51,10 +107,10 @@ class Model(nn.Module):
         return results
 
     def compute_results_cold(self, u, test_samples):
-        u = u.cuda()
+        u = u.to(self.device)
         if type(test_samples) != torch.Tensor:
             test_samples = torch.from_numpy(test_samples)
-        test_samples = test_samples.cuda()
+        test_samples = test_samples.to(self.device)
         rs = []
         for i in test_samples.T:
             # lt = torch.LongTensor(i)
@@ -68,83 +124,48 @@ class Model(nn.Module):
             raise Exception('nan')
         return results
 
-    @staticmethod
-    def auc_calculate(labels, pre_ds):
-        print('.auc')
-        labels = (torch.from_numpy(labels)).double()
-        labels = labels.cuda()
-        pre_ds = (torch.from_numpy(pre_ds)).double()
-        pre_ds = pre_ds.cuda()
-        # 计算tp，阈值设置为0.0，即预测集中，值大于0的样例设置为1，小于0的样例 设置为0
-        one = torch.ones_like(pre_ds)
-        zero = torch.zeros_like(pre_ds)
-        boundary = torch.mean(pre_ds) * 0.3
-        pre_ds = torch.where(pre_ds > boundary, one, zero)
-        positive_lens = torch.sum(labels, dim=1)
-        negative_lens = torch.abs(torch.sum(labels - 1, dim=1))
-        positive_samples = torch.einsum('ij, ij->i', [labels, pre_ds])
-        negative_samples = torch.einsum('ij, ij->i', [torch.abs(labels - 1), pre_ds])
-        positive_results = positive_samples / positive_lens
-        negative_results = negative_samples / negative_lens
-        results = torch.mean((negative_results + positive_results) / 2.0)
-        results = results.cpu()
-        return np.array(results)
-
     def compute_scores(self, gt, preds):
-        ret = {
-            'auc':  Metric.auc(gt, preds),
-            'ndcg': Metric.ndcg(gt, preds)
-
-        }
-        return ret
+        return ranking_metrics(gt, preds)
 
-    def __logscore(self, scores):
+    def __logscore(self, name, scores):
         metrics = list(scores.keys())
         metrics.sort()
-        file_path = open(self.filename, 'a')
-        print(' '.join(['%s: %s' % (m, str(scores[m])) for m in metrics]), file=file_path)  #
+        print(' '.join(['%s: %s' % (m, str(scores[m])) for m in metrics]))
+        self.metrics_sink().log_scores(self.epoch, name, scores)
         # self.logging.info(' '.join(['%s: %s' % (m,str(scores[m])) for m in metrics]))
 
     def test(self):
-        file_path = open(self.filename, 'a')
-        print('----- test', file=file_path)
         u = torch.LongTensor(range(self.user_size))
-        u = u.cuda()
+        u = u.to(self.device)
         test_arr = self.data_list.test_samples
         test_tensor = torch.from_numpy(test_arr)
-        test_tensor = test_tensor.cuda()
+        test_tensor = test_tensor.to(self.device)
         results = self.compute_results(u, test_tensor)
         scores = self.compute_scores(self.data_list.test_gt, results)
-        self.__logscore(scores)
+        self.__logscore('test', scores)
         print('----- test -----end-----')
 
     def val(self):
-        file_path = open(self.filename, 'a')
-        print('----- val', file=file_path)
         u = torch.LongTensor(range(self.user_size))
         results = self.compute_results(u, self.data_list.val_samples)
         scores = self.compute_scores(self.data_list.val_gt, results)
-        self.__logscore(scores)
+        self.__logscore('val', scores)
         print('----- val -----end-----')
 
     def test_warm(self):
-        file_path = open(self.filename, 'a')
-        print('----- test_warm', file=file_path)
         u = self.data_list.test_warm_u
-        u = u.cuda()
+        u = u.to(self.device)
         results = self.compute_results(u, self.data_list.test_warm_samples)
         scores = self.compute_scores(self.data_list.test_warm_gt, results)
-        self.__logscore(scores)
+        self.__logscore('test_warm', scores)
         print('----- test_warm -----end-----')
 
     def test_cold(self):
-        file_path = open(self.filename, 'a')
-        print('----- test_cold', file=file_path)
         u = self.data_list.test_cold_u
-        u = u.cuda()
+        u = u.to(self.device)
         results = self.compute_results_cold(u, self.data_list.test_cold_samples)  # _cold
         scores = self.compute_scores(self.data_list.test_cold_gt, results)
-        self.__logscore(scores)
+        self.__logscore('test_cold', scores)
         print('----- test_cold -----end-----')
 
     def train(self):
@@ -178,19 +199,13 @@ class Metric:
     @staticmethod
     def ndcg(gt, preds):
         print('.ndcg')
-        gt = torch.from_numpy(gt)
-        preds = torch.from_numpy(preds)
         K = [5, 10, 20]
-        return [ndcg_score(gt, preds, k=k) for k in K]  # 看这个地方具体怎么写的 修改这个地方的具体实现
+        return ranking_metrics(gt, preds, K)['ndcg']  # 一次 argpartition 同时得到所有 K
 
     @staticmethod
     def auc(gt, preds):
         print('.auc')
-        gt = torch.from_numpy(gt)
-        # gt = gt.cuda()
-        preds = torch.from_numpy(preds)
-        # preds = preds.cuda()
-        return roc_auc_score(gt, preds, average='samples')  # 两个nd-array 进行auc计算
+        return auc_score(gt, preds)  # 每个user秩和算精确的auc, 再平均
 
 
 class LoadData:
@@ -246,29 +261,33 @@ class CR(Model):
         self.batch_size = self.args.bsz
         self.filename = filename
         self.data_list = dataset
+        self.backend = Backend.from_args(args)
+        self.device = self.backend.device
         self.user_size = len(self.data_list.user_set)
         self.item_size = len(self.data_list.item_set)
         self.sz = self.data_list.train_list.shape[0]
+        self.planner = BatchPlanner(self.data_list.train_list, self.batch_size, seed=self.args.seed)
 
         # user id embedding
         self.user_matrix = nn.Embedding(self.user_size, self.args.dim)
-        self.user_matrix = self.user_matrix.cuda()
+        self.user_matrix = self.user_matrix.to(self.device)
         self.user_matrix = nn.init.normal_(self.user_matrix.weight, std=0.01)
 
         # item id embedding
         self.item_matrix = nn.Embedding(self.item_size, self.args.dim)
-        self.item_matrix = self.item_matrix.cuda()
+        self.item_matrix = self.item_matrix.to(self.device)
         self.item_matrix = nn.init.normal_(self.item_matrix.weight, std=0.01)
 
         # item feature vectors 需要对这个加一层mlp 和 relu函数，使输出后的结果尽可能靠近embedding
         # positive sample 是 item_matrix里面
         self.item_features = torch.from_numpy(self.data_list.item_set)
         self.item_features.requires_grad = False
-        self.item_features = self.item_features.cuda()
+        self.item_features = self.item_features.to(self.device)
         dim_mlp = self.item_features.shape[1]
         self.item_features = self.item_features.float()
         self.item_mlp = nn.Sequential(nn.Linear(dim_mlp, dim_mlp), nn.LeakyReLU(), nn.Linear(dim_mlp, dim_mlp))  #
-        self.item_mlp = self.item_mlp.cuda()
+        self.item_mlp = self.item_mlp.to(self.device)
+        self.projection = ProjectionCache(self.item_mlp, self.item_features)
 
     def predict(self, uid, iid):
         """
@@ -287,7 +306,7 @@ class CR(Model):
         :return:
         """
         p1 = self.user_matrix[uid]
-        item_fixed = self.item_mlp(self.item_features)
+        item_fixed = self.projection.full()
         p2 = item_fixed[iid]
         return torch.sum(p1 * p2, dim=1)
 
@@ -313,14 +332,8 @@ class CR(Model):
         return (contrastive_loss_1 + contrastive_loss_2) / 2, reg_loss
 
     def contrastive_loss(self, tensor_anchor, tensor_pos, tensor_ll):
-        """"""
-        pos_score = torch.sum(tensor_anchor * tensor_pos, dim=1)
-        all_score = torch.matmul(tensor_anchor, tensor_ll.t())
-        pos_score_exp = torch.exp(pos_score / self.args.temp_value)
-        all_score_exp = torch.exp(all_score / self.args.temp_value)
-        all_score_exp_sum = torch.sum(all_score_exp, dim=1)
-        contrastive_loss = (-torch.log(pos_score_exp / all_score_exp_sum)).mean()
-        return contrastive_loss
+        """InfoNCE, 用 logsumexp 按 nce_tile 分块算, 不用把 exp(all_score) 整个存下来"""
+        return info_nce(tensor_anchor, tensor_pos, tensor_ll, self.args.temp_value, self.args.nce_tile)
 
     def final_loss(self, item_fixed, user_ids, item_ids):
 
@@ -343,43 +356,46 @@ class CR(Model):
         lr = self.args.lr
         optimizer = torch.optim.Adam(self.parameters(), lr=lr, weight_decay=0)
         epochs = self.args.epochs
+        # --timing / --profile: 每个阶段计时, 每个 epoch 的分阶段耗时写进指标日志
+        profiler = Profiler.from_args(self.args, self.device)
+        profiler.start()
         for epoch in range(epochs):
 
             generator = self.sample()  # 这里生成的
             while True:
 
                 optimizer.zero_grad()
-                item_fixed = self.item_mlp(self.item_features)
 
-                s = next(generator)
+                with profiler.stage('sample'):
+                    s = next(generator)
                 if s is None:
                     break
 
                 uid, iid = s[:, 0], s[:, 1]
-                uid = uid.cuda()
-                iid = iid.cuda()
+                with profiler.stage('item_mlp'):
+                    item_fixed = self.projection.batch(iid)
                 # current_loop += 1
-                loss = self.final_loss(item_fixed, uid, iid)
-                loss.backward()
-                optimizer.step()
+                with profiler.stage('loss'):
+                    loss = self.final_loss(item_fixed, uid, iid)
+                with profiler.stage('backward'):
+                    loss.backward()
+                with profiler.stage('step'):
+                    optimizer.step()
+                    self.projection.invalidate()
+                profiler.step(len(s))
 
             if epoch % 2 == 0 and epoch > 1:  #
                 print(f'=={epoch}===>loss_bpr is {loss}======<')
-                file_path = open(self.filename, 'a')
-                print(f'epoch is {epoch}-----', file=file_path)
-                self.val(), self.test(), self.test_warm(), self.test_cold()
+                self.epoch = epoch
+                for split in (self.val, self.test, self.test_warm, self.test_cold):
+                    with profiler.stage('eval.' + split.__name__):
+                        split()
+            self.log_timings(epoch, profiler)
+        profiler.stop()
+        self.close_metrics()
 
     def sample(self):
-        np.random.shuffle(self.data_list.train_list)
-        loop_size = self.sz // self.batch_size
-        for i in range(loop_size):
-            pairs = []
-            sub_train_list = self.data_list.train_list[i * self.batch_size:(i + 1) * self.batch_size, :]
-            for m, j in sub_train_list:
-                pairs.append((m, j))
-
-            yield torch.LongTensor(pairs)
-        yield None
+        return epoch_batches(self.planner, None, self.backend, self.args)
 
 
 """
@@ -394,66 +410,17 @@ def main():
     reg_weight_params = f'reg_weight-{args.reg_weight}'
     temp_value_params = f'temp_value-{args.temp_value}'
     bsz_params = f'bsz-{args.bsz}-'
-    filename = f'./result/cr-3-{lr_params}-{con_weight_params}-{reg_weight_params}-{temp_value_params}-{bsz_params}.txt'
-
-    if not os.path.exists(filename):
-        open(filename, 'x')
+    filename = f'./result/cr-3-{lr_params}-{con_weight_params}-{reg_weight_params}-{temp_value_params}-{bsz_params}.jsonl'
 
     if args.gpu is None:
         args.gpu = 0
-    torch.cuda.set_device(args.gpu)
-
-    base_path = args.dp
-    # 读取预处理的数据
-    user_set = torch.load(base_path + 'user_set.pt')
-    item_set = torch.load(base_path + 'item_set.pt')
-    train_pt = torch.load(base_path + 'train.pt')
-    train_list = torch.load(base_path + 'train_list_as_array.pt')
-
-    test_cold_gt = torch.load(base_path + 'test_cold_gt.pt')
-    test_cold_samples = torch.load(base_path + 'test_cold_samples.pt')
-    test_cold_u = torch.load(base_path + 'test_cold_u.pt')
-    test_samples = torch.load(base_path + 'test_samples.pt')
-    test_set = torch.load(base_path + 'test_set.pt')
-    test_warm_gt = torch.load(base_path + 'test_warm_gt.pt')
-    test_warm_samples = torch.load(base_path + 'test_warm_samples.pt')
-    test_warm_u = torch.load(base_path + 'test_warm_u.pt')
-    val_cold_gt = torch.load(base_path + 'val_cold_gt.pt')
-    val_cold_samples = torch.load(base_path + 'val_cold_samples.pt')
-    val_cold_u = torch.load(base_path + 'val_cold_u.pt')
-
-    val_set = torch.load(base_path + 'val_set.pt')
-    val_warm_gt = torch.load(base_path + 'val_warm_gt.pt')
-    val_warm_samples = torch.load(base_path + 'val_warm_samples.pt')
-    val_warm_u = torch.load(base_path + 'val_warm_u.pt')
-
-    val_samples = torch.load(base_path + 'val_samples.pt')
-    val_gt = torch.load(base_path + 'val_gt.pt')
-    test_gt = torch.load(base_path + 'test_gt.pt')
-
-    data = LoadData(user_set,
-                    item_set,
-                    train_pt,
-                    train_list,
-                    test_cold_gt,
-                    test_cold_samples,
-                    test_cold_u,
-                    test_samples,
-                    test_warm_gt,
-                    test_warm_samples,
-                    test_warm_u,
-                    val_cold_gt,
-                    val_cold_samples,
-                    val_cold_u,
-                    val_warm_gt,
-                    val_warm_samples,
-                    val_warm_u,
-                    val_samples,
-                    val_gt,
-                    test_gt)
+
+    # dp 是目录就逐个 torch.load *.pt, 是 python -m base_algorithm.packed 打包出来的文件就直接 mmap
+    data = load_dataset(args.dp, LoadData)
     print('data is ready')
     cr_model = CR(args, data, filename)
-    cr_model = cr_model.cuda()
+    cr_model = cr_model.to(cr_model.device)
+    print(f'cr is running on {cr_model.backend}')
     cr_model.train()
 
 
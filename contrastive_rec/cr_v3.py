@@ -1,8 +1,17 @@
-import numpy as np
+import time
 import torch.nn as nn
 import torch
 import torch.nn.functional as fun
 from .base_model_v3 import Model
+from base_algorithm.projection import ProjectionCache
+from base_algorithm.device import Backend
+from base_algorithm.sampler import HardNegativeSampler, epoch_batches
+from base_algorithm.batching import BatchPlanner
+from base_algorithm.losses import info_nce
+from base_algorithm.distributed import allreduce_gradients, gather_unique
+from base_algorithm.optim import lookup, SplitOptimizer
+from base_algorithm.async_eval import AsyncEvaluator
+from base_algorithm.profiling import Profiler
 from tensorboardX import SummaryWriter
 
 
@@ -15,29 +24,40 @@ class CR(Model):
         self.batch_size = self.args.bsz
         self.filename = filename
         self.data_list = dataset
+        self.backend = Backend.from_args(args)
+        self.device = self.backend.device
         self.user_size = len(self.data_list.user_set)
         self.item_size = len(self.data_list.item_set)
         self.sz = self.data_list.train_list.shape[0]
+        self.planner = BatchPlanner(self.data_list.train_list, self.batch_size, seed=self.args.seed)
+        # --sparse: embedding 表的梯度只含 batch 碰到的行, 用 SparseAdam 按行更新
+        self.sparse = getattr(self.args, 'sparse', False)
+        # 负样本默认是 batch 内的其它 item, --ih 时每个正样本再带一个 co_items 里的 hard negative
+        self.sampler = None
+        if self.args.ih:
+            self.sampler = HardNegativeSampler(self.data_list.interactions(), self.data_list.co_items(),
+                                               self.args.hard_ratio, seed=self.args.seed)
 
         # user id embedding
         self.user_matrix = nn.Embedding(self.user_size, self.args.dim)
-        self.user_matrix = self.user_matrix.cuda()
+        self.user_matrix = self.user_matrix.to(self.device)
         self.user_matrix = nn.init.normal_(self.user_matrix.weight, std=0.01)
 
         # item id embedding
         self.item_matrix = nn.Embedding(self.item_size, self.args.dim)
-        self.item_matrix = self.item_matrix.cuda()
+        self.item_matrix = self.item_matrix.to(self.device)
         self.item_matrix = nn.init.normal_(self.item_matrix.weight, std=0.01)
 
         # item feature vectors 需要对这个加一层mlp 和 relu函数，使输出后的结果尽可能靠近embedding
         # positive sample 是 item_matrix里面
         self.item_features = torch.from_numpy(self.data_list.item_set)
         self.item_features.requires_grad = False
-        self.item_features = self.item_features.cuda()
+        self.item_features = self.item_features.to(self.device)
         dim_mlp = self.item_features.shape[1]
         self.item_features = self.item_features.float()
         self.item_mlp = nn.Sequential(nn.Linear(dim_mlp, dim_mlp), nn.LeakyReLU(), nn.Linear(dim_mlp, dim_mlp))  #
-        self.item_mlp = self.item_mlp.cuda()
+        self.item_mlp = self.item_mlp.to(self.device)
+        self.projection = ProjectionCache(self.item_mlp, self.item_features)
 
     def predict(self, uid, iid):
         """
@@ -56,24 +76,37 @@ class CR(Model):
         :return:
         """
         p1 = self.user_matrix[uid]
-        item_fixed = self.item_mlp(self.item_features)
+        item_fixed = self.projection.full()
         p2 = item_fixed[iid]
         return torch.sum(p1 * p2, dim=1)
 
-    def forward(self, item_fixed, user_ids, item_ids):
+    def item_table_cold(self):
+        return self.projection.full()
+
+    def forward(self, item_fixed, user_ids, item_ids, neg_ids=None):
         user_ids_unique = torch.unique(user_ids)
         item_ids_unique = torch.unique(item_ids)
+        # hard negative 只加到 item 侧的候选里
+        candidate_ids = item_ids_unique if neg_ids is None else torch.unique(torch.cat([item_ids, neg_ids]))
 
-        pos_item_embedding = self.item_matrix[item_ids]
-        all_item_embedding = self.item_matrix[item_ids_unique]
+        pos_item_embedding = lookup(self.item_matrix, item_ids, self.sparse)
+        all_item_embedding = lookup(self.item_matrix, item_ids_unique, self.sparse)
 
-        pos_user_embedding = self.user_matrix[user_ids]
-        all_user_embedding = self.user_matrix[user_ids_unique]
+        pos_user_embedding = lookup(self.user_matrix, user_ids, self.sparse)
+        all_user_embedding = lookup(self.user_matrix, user_ids_unique, self.sparse)
 
         pos_feature = item_fixed[item_ids]
         all_feature = item_fixed[item_ids_unique]
-
-        contrastive_loss_1 = self.contrastive_loss(pos_item_embedding, pos_feature, all_feature) * self.args.con_weight
+        candidate_feature = item_fixed[candidate_ids]
+        if self.world_size > 1:
+            # 每个 rank 只有 bsz // world_size 行, 负样本集合拼回整个全局 batch 的, 不随 world_size 变小
+            _, candidate_feature = gather_unique(candidate_ids, candidate_feature)
+            _, all_user_embedding = gather_unique(user_ids_unique, all_user_embedding)
+            _, all_item_embedding = gather_unique(item_ids_unique, all_item_embedding)
+            _, all_feature = gather_unique(item_ids_unique, all_feature)
+
+        contrastive_loss_1 = self.contrastive_loss(pos_item_embedding, pos_feature, candidate_feature) \
+            * self.args.con_weight
         contrastive_loss_2 = self.contrastive_loss(pos_feature, pos_user_embedding, all_user_embedding)
         contrastive_loss_3 = self.contrastive_loss(pos_item_embedding, pos_user_embedding, all_user_embedding)
 
@@ -82,18 +115,12 @@ class CR(Model):
         return (contrastive_loss_1 + contrastive_loss_2 + contrastive_loss_3) / 3, reg_loss
 
     def contrastive_loss(self, tensor_anchor, tensor_pos, tensor_ll):
-        """"""
-        pos_score = torch.sum(tensor_anchor * tensor_pos, dim=1)
-        all_score = torch.matmul(tensor_anchor, tensor_ll.t())
-        pos_score_exp = torch.exp(pos_score / self.args.temp_value)
-        all_score_exp = torch.exp(all_score / self.args.temp_value)
-        all_score_exp_sum = torch.sum(all_score_exp, dim=1)
-        contrastive_loss = (-torch.log(pos_score_exp / all_score_exp_sum)).mean()
-        return contrastive_loss
-
-    def final_loss(self, item_fixed, user_ids, item_ids):
-
-        contrastive_loss, reg_loss = self.forward(item_fixed, user_ids, item_ids)
+        """InfoNCE, 用 logsumexp 按 nce_tile 分块算, 不用把 exp(all_score) 整个存下来"""
+        return info_nce(tensor_anchor, tensor_pos, tensor_ll, self.args.temp_value, self.args.nce_tile)
+
+    def final_loss(self, item_fixed, user_ids, item_ids, neg_ids=None):
+
+        contrastive_loss, reg_loss = self.forward(item_fixed, user_ids, item_ids, neg_ids)
         reg_loss = self.args.reg_weight * reg_loss
         return contrastive_loss + reg_loss
 
@@ -110,42 +137,62 @@ class CR(Model):
 
         print('cr is training')
         lr = self.args.lr
-        optimizer = torch.optim.Adam(self.parameters(), lr=lr, weight_decay=0)
+        if self.sparse:
+            optimizer = SplitOptimizer([self.user_matrix, self.item_matrix], self.parameters(), lr)
+        else:
+            optimizer = torch.optim.Adam(self.parameters(), lr=lr, weight_decay=0)
         epochs = self.args.epochs
+        # --async_eval: 评估在后台线程里对 embedding 快照做, 训练不停
+        evaluator = None
+        if getattr(self.args, 'async_eval', False) and self.rank == 0:
+            evaluator = AsyncEvaluator(self.eval_splits(), self.log_report, chunk_size=self.eval_chunk_size)
+        # --timing / --profile: 每个阶段计时, 每个 epoch 的分阶段耗时写进指标日志
+        profiler = Profiler.from_args(self.args, self.device)
+        profiler.start()
         for epoch in range(epochs):
 
             generator = self.sample()  # 这里生成的
             while True:
 
                 optimizer.zero_grad()
-                item_fixed = self.item_mlp(self.item_features)
 
-                s = next(generator)
+                with profiler.stage('sample'):
+                    s = next(generator)
                 if s is None:
                     break
 
                 uid, iid = s[:, 0], s[:, 1]
-                uid = uid.cuda()
-                iid = iid.cuda()
+                jid = s[:, 2] if s.shape[1] > 2 else None
+                with profiler.stage('item_mlp'):
+                    item_fixed = self.projection.batch(iid if jid is None else torch.cat([iid, jid]))
                 # current_loop += 1
-                loss = self.final_loss(item_fixed, uid, iid)
-                loss.backward()
-                optimizer.step()
-
-            if epoch % 2 == 0 and epoch > 1:  #
+                with profiler.stage('loss'):
+                    loss = self.final_loss(item_fixed, uid, iid, jid)
+                with profiler.stage('backward'):
+                    loss.backward()
+                if self.world_size > 1:
+                    with profiler.stage('allreduce'):
+                        allreduce_gradients(self.parameters(), self.world_size)
+                with profiler.stage('step'):
+                    optimizer.step()
+                    self.projection.invalidate()
+                profiler.step(len(s))
+
+            if epoch % 2 == 0 and epoch > 1 and self.rank == 0:  #
                 print(f'=={epoch}===>loss is {loss}======<')
-                file_path = open(self.filename, 'a')
-                print(f'epoch is {epoch}-----', file=file_path)
-                self.val(), self.test(), self.test_warm(), self.test_cold()
+                if evaluator is not None:
+                    evaluator.submit(epoch, *self.snapshot())
+                else:
+                    # val/test/test_warm/test_cold 合成一份报告写进指标日志
+                    start = time.perf_counter()
+                    report = self.evaluate(profiler)
+                    self.log_report(epoch, report, {'eval': time.perf_counter() - start})
+            if self.rank == 0:
+                self.log_timings(epoch, profiler)
+        profiler.stop()
+        if evaluator is not None:
+            evaluator.close()
+        self.close_metrics()
 
     def sample(self):
-        np.random.shuffle(self.data_list.train_list)
-        loop_size = self.sz // self.batch_size
-        for i in range(loop_size):
-            pairs = []
-            sub_train_list = self.data_list.train_list[i * self.batch_size:(i + 1) * self.batch_size, :]
-            for m, j in sub_train_list:
-                pairs.append((m, j))
-
-            yield torch.LongTensor(pairs)
-        yield None
+        return epoch_batches(self.planner, self.sampler, self.backend, self.args)
@@ -1,12 +1,16 @@
 import argparse
-import torch
-import os
+import torch.distributed as dist
+import torch.multiprocessing as mp
 from base_algorithm.load import LoadData
 from contrastive_rec.cr_v3 import CR
+from base_algorithm.packed import load_dataset
+from base_algorithm.distributed import init_process, distribute
 
 parser = argparse.ArgumentParser(description='contrastive training for recommendation')
 parser.add_argument('--ih', '--if_hard', default=False, type=bool,
                     metavar='IH', help='whether use hard negative samples', dest='ih')
+parser.add_argument('--hard_ratio', default=0.5, type=float,
+                    metavar='hard_ratio', help='share of negatives drawn from co_items with --ih', dest='hard_ratio')
 parser.add_argument('--dim', '--dim_fea', default=64, type=int,
                     metavar='dim', help='the dim for item and user', dest='dim')
 parser.add_argument('--lr', '--learning_rate_bpr', default=0.001, type=float,
@@ -19,19 +23,61 @@ parser.add_argument('--reg_weight', '--reg_weight', default=0.7, type=float,
                     metavar='reg_weight', help='reg_weight', dest='reg_weight')
 parser.add_argument('--temp_value', '--temp_value', default=1.382, type=float,
                     metavar='temp_value', help='temp_value', dest='temp_value')
+parser.add_argument('--nce_tile', default=2048, type=int,
+                    metavar='nce_tile', help='negatives per tile in the contrastive loss, 0 for no tiling', dest='nce_tile')
 parser.add_argument('--epochs', '--epoch_number', default=200, type=int,
                     metavar='epochs', help='training epochs', dest='epochs')
 parser.add_argument('--dp', '--data_path', default='..\\dataset\\amazon\\', type=str,
-                    metavar='dp', help='the path of dataset', dest='dp')
+                    metavar='dp', help='dataset directory of *.pt files or a packed dataset file', dest='dp')
 parser.add_argument('--gpu', default=0, type=int,
-                    metavar='GPU', help='gpu number to use', dest='gpu')
+                    metavar='GPU', help='gpu number to use, -1 for cpu', dest='gpu')
+parser.add_argument('--threads', default=None, type=int,
+                    metavar='threads', help='torch intra-op threads when running on cpu', dest='threads')
+parser.add_argument('--workers', default=2, type=int,
+                    metavar='workers', help='background threads preparing training batches', dest='workers')
+parser.add_argument('--prefetch', default=8, type=int,
+                    metavar='prefetch', help='max number of prepared batches waiting in the queue', dest='prefetch')
+parser.add_argument('--seed', default=None, type=int,
+                    metavar='seed', help='seed of the per-epoch batch order and the negative sampling', dest='seed')
 parser.add_argument('--bsz', default=10240, type=int,
                     metavar='bsz', help='batch_size', dest='bsz')
+parser.add_argument('--sparse', action='store_true',
+                    help='sparse embedding gradients updated row-wise by SparseAdam', dest='sparse')
+parser.add_argument('--world_size', default=1, type=int,
+                    metavar='world_size',
+                    help='local cpu processes for data-parallel training (gloo), '
+                         'in-batch negatives are gathered from all processes', dest='world_size')
+parser.add_argument('--dist_url', default='tcp://127.0.0.1:23456', type=str,
+                    metavar='dist_url', help='url used to set up distributed training', dest='dist_url')
+parser.add_argument('--async_eval', action='store_true',
+                    help='evaluate a snapshot of the embeddings in a background thread while training goes on',
+                    dest='async_eval')
+parser.add_argument('--timing', action='store_true',
+                    help='time sample/item_mlp/loss/backward/step/eval per epoch and log the breakdown', dest='timing')
+parser.add_argument('--profile', default=None, type=str,
+                    metavar='profile', help='directory for a torch.profiler trace of the first batches', dest='profile')
+parser.add_argument('--profile_steps', default=20, type=int,
+                    metavar='profile_steps', help='batches recorded in the torch.profiler trace', dest='profile_steps')
+parser.add_argument('--eval_bsz', default=2048, type=int,
+                    metavar='eval_bsz', help='users scored per chunk in evaluation', dest='eval_bsz')
 """
 如果是随机选择negative samples，那么neg__num不能为None
 """
 
 
+def train_rank(rank, args, filename):
+    """--world_size > 1 时每个进程跑一个 rank, 在 train_list 的分片上训练, 梯度每个 batch all_reduce 一次"""
+    init_process(rank, args.world_size, args.dist_url, args.threads or 1)
+    data = load_dataset(args.dp, LoadData)
+    cr_model = CR(args, data, filename)
+    cr_model.eval_chunk_size = args.eval_bsz
+    distribute(cr_model, rank, args.world_size)
+    if rank == 0:
+        print(f'cr is running on {args.world_size} processes')
+    cr_model.train()
+    dist.destroy_process_group()
+
+
 def main():
     args = parser.parse_args()
     lr_params = f'lr-{args.lr}-'
@@ -39,69 +85,24 @@ def main():
     reg_weight_params = f'reg_weight-{args.reg_weight}'
     temp_value_params = f'temp_value-{args.temp_value}'
     bsz_params = f'bsz-{args.bsz}-'
-    filename = f'cr-no l3-{lr_params}-{con_weight_params}-{reg_weight_params}-{temp_value_params}-{bsz_params}.txt'
-
-    if not os.path.exists(filename):
-        open(filename, 'x')
+    filename = f'cr-no l3-{lr_params}-{con_weight_params}-{reg_weight_params}-{temp_value_params}-{bsz_params}.jsonl'
 
     if args.gpu is None:
         args.gpu = 0
-    torch.cuda.set_device(args.gpu)
-
-    base_path = args.dp
-    # 读取预处理的数据
-    user_set = torch.load(base_path + 'user_set.pt')
-    item_set = torch.load(base_path + 'item_set.pt')
-    train_pt = torch.load(base_path + 'train.pt')
-    train_list = torch.load(base_path + 'train_list_as_array.pt')
-
-    test_cold_gt = torch.load(base_path + 'test_cold_gt.pt')
-    test_cold_samples = torch.load(base_path + 'test_cold_samples.pt')
-    test_cold_u = torch.load(base_path + 'test_cold_u.pt')
-    test_samples = torch.load(base_path + 'test_samples.pt')
-    test_set = torch.load(base_path + 'test_set.pt')
-    test_warm_gt = torch.load(base_path + 'test_warm_gt.pt')
-    test_warm_samples = torch.load(base_path + 'test_warm_samples.pt')
-    test_warm_u = torch.load(base_path + 'test_warm_u.pt')
-    val_cold_gt = torch.load(base_path + 'val_cold_gt.pt')
-    val_cold_samples = torch.load(base_path + 'val_cold_samples.pt')
-    val_cold_u = torch.load(base_path + 'val_cold_u.pt')
-
-    val_set = torch.load(base_path + 'val_set.pt')
-    val_warm_gt = torch.load(base_path + 'val_warm_gt.pt')
-    val_warm_samples = torch.load(base_path + 'val_warm_samples.pt')
-    val_warm_u = torch.load(base_path + 'val_warm_u.pt')
-
-    val_samples = torch.load(base_path + 'val_samples.pt')
-    val_gt = torch.load(base_path + 'val_gt.pt')
-    test_gt = torch.load(base_path + 'test_gt.pt')
 
-    hard_negatives = torch.load(base_path + 'co_items.pt')
+    if args.world_size > 1:
+        # gloo 只在 cpu 上做数据并行
+        args.gpu = -1
+        mp.spawn(train_rank, args=(args, filename), nprocs=args.world_size)
+        return
 
-    data = LoadData(user_set,
-                    item_set,
-                    train_pt,
-                    train_list,
-                    test_cold_gt,
-                    test_cold_samples,
-                    test_cold_u,
-                    test_samples,
-                    test_warm_gt,
-                    test_warm_samples,
-                    test_warm_u,
-                    val_cold_gt,
-                    val_cold_samples,
-                    val_cold_u,
-                    val_warm_gt,
-                    val_warm_samples,
-                    val_warm_u,
-                    val_samples,
-                    val_gt,
-                    test_gt,
-                    hard_negatives)
+    # dp 是目录就逐个 torch.load *.pt, 是 python -m base_algorithm.packed 打包出来的文件就直接 mmap
+    data = load_dataset(args.dp, LoadData)
     print('data is ready')
     cr_model = CR(args, data, filename)
-    cr_model = cr_model.cuda()
+    cr_model = cr_model.to(cr_model.device)
+    print(f'cr is running on {cr_model.backend}')
+    cr_model.eval_chunk_size = args.eval_bsz
     cr_model.train()
 
 
@@ -1,5 +1,8 @@
 #!/usr/bin/env bash
 
+# cr_all.py 用到了 base_algorithm 里的模块
+export PYTHONPATH=..:$PYTHONPATH
+
 for lr in 0.1 0.01 0.001 0.0001
  do
    for con_weight in 0.3